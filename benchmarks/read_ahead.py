@@ -0,0 +1,143 @@
+"""Benchmark of reading gzip inputs with and without read-ahead decompression.
+
+Writes a STAR ReadsPerGene file and an SJ.out.tab file of realistic size as
+plain gzip and as BGZF, then times `merge_counts.load_star_file` and
+`merge_junctions.load_junction_file` reading each one with `gzip.open` and
+with `utils.ReadAheadReader`.
+
+Usage: python benchmarks/read_ahead.py [--genes N] [--junctions N] [--repeat N]
+"""
+
+import argparse
+import gzip
+import os
+import random
+import tempfile
+import time
+from collections import OrderedDict
+
+from gdc_rnaseq_tools.bgzf import ParallelBgzfWriter
+from gdc_rnaseq_tools.merge_counts import load_star_file
+from gdc_rnaseq_tools.merge_junctions import load_junction_file
+from gdc_rnaseq_tools.utils import configure_gzip
+
+CHROMOSOMES = ["chr{0}".format(i) for i in list(range(1, 23)) + ["X", "Y", "M"]]
+
+
+def star_counts_lines(n_genes, rng):
+    """
+    Lines of a ReadsPerGene file: four summary rows, then one row per gene.
+    """
+    lines = [
+        "N_unmapped\t2451\t2451\t2451\n",
+        "N_multimapping\t44823\t44823\t44823\n",
+        "N_noFeature\t17312\t1123442\t19320\n",
+        "N_ambiguous\t56221\t1022\t50113\n",
+    ]
+    for i in range(n_genes):
+        count = int(rng.expovariate(1 / 400)) if rng.random() < 0.6 else 0
+        lines.append(
+            "ENSG{0:011d}.{1}\t{2}\t{3}\t{4}\n".format(
+                i, rng.randint(1, 20), count, count // 2, count - count // 2
+            )
+        )
+    return lines
+
+
+def junction_lines(n_junctions, rng):
+    """
+    Lines of an SJ.out.tab file, sorted by chromosome and position.
+    """
+    per_chromosome = n_junctions // len(CHROMOSOMES) + 1
+    lines = []
+    for chromosome in CHROMOSOMES:
+        start = 10000
+        for _ in range(per_chromosome):
+            start += rng.randint(1, 2000)
+            lines.append(
+                "{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}\t{8}\n".format(
+                    chromosome,
+                    start,
+                    start + rng.randint(60, 50000),
+                    rng.randint(0, 2),
+                    rng.randint(0, 6),
+                    rng.randint(0, 1),
+                    int(rng.expovariate(1 / 30)),
+                    rng.randint(0, 5),
+                    rng.randint(10, 75),
+                )
+            )
+    return lines[:n_junctions]
+
+
+def write_inputs(tmp, name, lines):
+    """
+    Write lines as plain gzip and as BGZF.
+    :returns: dict of format to path
+    """
+    data = "".join(lines).encode()
+    paths = {
+        "gzip": os.path.join(tmp, name + ".gz"),
+        "bgzf": os.path.join(tmp, name + ".bgz.gz"),
+    }
+    with gzip.open(paths["gzip"], "wb", compresslevel=6) as o:
+        o.write(data)
+    with ParallelBgzfWriter(paths["bgzf"]) as o:
+        o.write(data)
+    return paths
+
+
+def best_time(load, path, repeat):
+    """
+    Best wall time of loading a file `repeat` times.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        load(path)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--genes", type=int, default=60660)
+    parser.add_argument("--junctions", type=int, default=400000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threads", type=int, help="BGZF inflate threads")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    loaders = {
+        "ReadsPerGene": lambda fil: load_star_file(fil, OrderedDict()),
+        "SJ.out.tab": lambda fil: load_junction_file(fil, dict()),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        inputs = {
+            "ReadsPerGene": write_inputs(
+                tmp, "ReadsPerGene.out.tab", star_counts_lines(args.genes, rng)
+            ),
+            "SJ.out.tab": write_inputs(
+                tmp, "SJ.out.tab", junction_lines(args.junctions, rng)
+            ),
+        }
+        print(
+            "{0:14}{1:6}{2:>12}{3:>12}{4:>9}".format(
+                "file", "format", "gzip.open", "read-ahead", "speedup"
+            )
+        )
+        for name, paths in inputs.items():
+            for fmt, path in paths.items():
+                configure_gzip(threads=args.threads, read_ahead=False)
+                serial = best_time(loaders[name], path, args.repeat)
+                configure_gzip(threads=args.threads, read_ahead=True)
+                read_ahead = best_time(loaders[name], path, args.repeat)
+                print(
+                    "{0:14}{1:6}{2:11.3f}s{3:11.3f}s{4:8.2f}x".format(
+                        name, fmt, serial, read_ahead, serial / read_ahead
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
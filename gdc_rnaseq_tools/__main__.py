@@ -1,82 +1,338 @@
 """Main entrypoint for the gdc-rnaseq-tools package.
 
+Subcommands are registered in `TOOLS` with the module implementing them and
+a function adding their arguments. A tool module is only imported once its
+subcommand is selected, so the pure Python tools do not pay for importing
+pandas and NumPy at startup.
+
 @author: Kyle Hernandez <kmhernan@uchicago.edu>
 """
 
 import argparse
+import importlib
+from collections import namedtuple
 
-import gdc_rnaseq_tools.augment_star_counts as augment_star_counts
-import gdc_rnaseq_tools.merge_counts as merge_star_gene_counts
-import gdc_rnaseq_tools.merge_junctions as merge_star_junctions
 from gdc_rnaseq_tools import __version__
-from gdc_rnaseq_tools.utils import get_logger
+from gdc_rnaseq_tools.utils import configure_gzip, get_logger
+
+# Subcommand name, module with its main function, parser description and
+# function adding its arguments to a parser
+Tool = namedtuple("Tool", ["name", "module", "description", "add_arguments"])
+
+# Counts columns of augment_star_counts.CountsColumns, without the import
+COUNTS_COLUMNS = ["unstranded", "stranded_first", "stranded_second"]
 
 
-def load_args():
+def add_cache_arguments(parser):
     """
-    Loads the argument parser object.
-    :return: argparse.ArgParser
+    Adds the result cache arguments shared by several tools.
     """
-    parser = argparse.ArgumentParser(
-        description="Utility functions for the GDC RNA-Seq workflow"
+    parser.add_argument(
+        "--cache-dir",
+        metavar="DIR",
+        help="Directory caching outputs by subcommand, options, package "
+        + "version and input file contents, shared by concurrent runs. A run "
+        + "matching a cached one copies its outputs instead of "
+        + "recomputing them.",
     )
-    parser.add_argument("--version", action="version", version=__version__)
-    sp = parser.add_subparsers(description="Select a tool", dest="choice")
-    sp.required = True
-
-    # Merge star counts
-    gcounts = sp.add_parser(
-        "merge_star_gene_counts",
-        description="Formats and merges STAR gene " + "counts files.",
+    parser.add_argument(
+        "--cache-size",
+        metavar="SIZE",
+        default="10G",
+        help="Size limit of the result cache, e.g. 512M. Least recently used "
+        + "outputs are removed first.",
     )
-    gcounts.add_argument(
+
+
+def add_merge_star_gene_counts_arguments(parser):
+    """
+    Adds the arguments of merge_star_gene_counts.
+    """
+    parser.add_argument(
         "-i",
         "--input",
         action="append",
         required=True,
         help="Path to STAR gene counts file. Use one or " + "more times.",
     )
-    gcounts.add_argument(
+    parser.add_argument(
         "-o",
         "--output",
         required=True,
         help="Path to the merged/formatted output file.",
     )
-
-    # Merge junctions
-    jmerge = sp.add_parser(
-        "merge_star_junctions",
-        description="Formats and merges STAR junction "
-        + "count files from the same sample.",
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Merge inputs that list genes in the same order, such as lanes "
+        + "aligned with the same STAR index, by reading them line by line "
+        + "together in constant memory. Falls back to the keyed merge if the "
+        + "gene order differs.",
     )
-    jmerge.add_argument(
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of worker processes used to parse inputs in parallel.",
+    )
+    parser.add_argument(
+        "--fan-in",
+        type=int,
+        metavar="N",
+        help="Merge inputs with a tree reduction: groups of N inputs are "
+        + "merged in the worker processes set by --processes, then the "
+        + "partial results are merged N at a time until one remains. At most "
+        + "one input per worker is open at a time.",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["python", "numpy"],
+        default="python",
+        help="Engine for merging. 'numpy' parses inputs into count arrays "
+        + "aligned on a shared gene index and sums them with vectorized "
+        + "operations. Cannot be combined with --fan-in.",
+    )
+    add_cache_arguments(parser)
+
+
+def add_merge_star_junctions_arguments(parser):
+    """
+    Adds the arguments of merge_star_junctions.
+    """
+    parser.add_argument(
         "-i",
         "--input",
         action="append",
         required=True,
         help="Path to STAR junction counts file. Use one " + "or more times.",
     )
-    jmerge.add_argument(
+    parser.add_argument(
         "-o",
         "--output",
         required=True,
         help="Path to the merged/formatted output file.",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Merge inputs already sorted by chromosome, intron start and "
+        + "intron end with a streaming k-way merge in constant memory. "
+        + "Output follows --chrom-order if given, else the chromosome order "
+        + "of the inputs, which must then share it, as STAR writes them. Give "
+        + "--chrom-order when inputs may each lack some chromosomes. Falls "
+        + "back to the in-memory merge if an input is not sorted in that "
+        + "order.",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["python", "numpy"],
+        default="python",
+        help="Engine for the in-memory merge. 'numpy' parses inputs into "
+        + "typed arrays and merges them with vectorized operations, and "
+        + "cannot be combined with --max-memory or --fan-in.",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of worker processes used to parse inputs in parallel.",
+    )
+    parser.add_argument(
+        "--fan-in",
+        type=int,
+        metavar="N",
+        help="Merge inputs with a tree reduction: groups of N inputs are "
+        + "merged in the worker processes set by --processes, then the "
+        + "partial results are merged N at a time until one remains. At most "
+        + "one input per worker is open at a time.",
+    )
+    parser.add_argument(
+        "--max-memory",
+        metavar="SIZE",
+        help="Memory budget for the in-memory merge, e.g. 512M or 2G. When "
+        + "exceeded, sorted runs are spilled to temporary files and merged "
+        + "back at the end, at most --run-fan-in runs at a time. Cannot be "
+        + "combined with --fan-in.",
+    )
+    parser.add_argument(
+        "--run-fan-in",
+        type=int,
+        default=16,
+        metavar="N",
+        help="Number of sorted runs spilled under --max-memory that are "
+        + "merged at a time, which bounds the number of open files. Defaults "
+        + "to 16.",
+    )
+    parser.add_argument(
+        "--tmp-dir",
+        help="Directory for the sorted runs spilled under --max-memory. "
+        + "Defaults to the system temporary directory.",
+    )
+    parser.add_argument(
+        "--chrom-order",
+        metavar="PATH",
+        help="A .fai index or list of chromosome names. Merged output is "
+        + "sorted in this chromosome order instead of by chromosome name.",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        help="Write the output as BGZF with a tabix-compatible .tbi index "
+        + "for region queries. The output file name must end with .gz.",
+    )
+    parser.add_argument(
+        "--min-unique",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Only output junctions with at least N uniquely mapped reads "
+        + "summed over all inputs.",
+    )
+    parser.add_argument(
+        "--annotation",
+        choices=["annotated", "unannotated"],
+        help="Only keep junctions with this annotation status.",
+    )
+    parser.add_argument(
+        "--canonical-only",
+        action="store_true",
+        help="Drop junctions with a non-canonical intron motif (0).",
+    )
+    parser.add_argument(
+        "--exclude-contig",
+        action="append",
+        metavar="NAME",
+        help="Drop junctions on this chromosome. Glob patterns such as "
+        + "'*_decoy' or 'chrUn_*' are allowed. Use one or more times.",
+    )
+    add_cache_arguments(parser)
 
-    # Augment STAR counts table
-    augct = sp.add_parser(
-        "augment_star_counts",
-        description="Adds FPKM/FPKM-UQ/TPM and gene info columns to STAR"
-        + " counts output",
+
+def add_query_junctions_arguments(parser):
+    """
+    Adds the arguments of query_junctions.
+    """
+    parser.add_argument(
+        "-i",
+        "--input",
+        required=True,
+        help="Path to the indexed merged junction counts file.",
+    )
+    parser.add_argument(
+        "-r",
+        "--region",
+        action="append",
+        required=True,
+        help="Region as chr, chr:start or chr:start-end with 1-based, "
+        + "inclusive coordinates. Use one or more times.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Path to the output file. Defaults to standard output.",
     )
-    augct.add_argument(
+    parser.add_argument(
+        "--header",
+        action="store_true",
+        help="Print the header line before the junctions.",
+    )
+
+
+def add_build_junction_matrix_arguments(parser):
+    """
+    Adds the arguments of build_junction_matrix.
+    """
+    parser.add_argument(
+        "-i",
+        "--input",
+        action="append",
+        help="Path to a merged STAR junction counts file of one sample. "
+        + "Use one or more times.",
+    )
+    parser.add_argument(
+        "-l",
+        "--input-list",
+        help="File listing one merged STAR junction counts file per line, "
+        + "optionally followed by a tab and the sample ID.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        help="Path to the output .npz file.",
+    )
+    parser.add_argument(
+        "--multi",
+        action="store_true",
+        help="Also store the n_multi_map counts.",
+    )
+    parser.add_argument(
+        "--tmp-dir",
+        help="Directory for temporary files. Defaults to the system "
+        + "temporary directory.",
+    )
+
+
+def add_build_counts_matrix_arguments(parser):
+    """
+    Adds the arguments of build_counts_matrix.
+    """
+    parser.add_argument(
         "-i",
         "--input",
+        action="append",
+        help="Path to a STAR, merged or augmented gene counts file of one "
+        + "sample. Use one or more times.",
+    )
+    parser.add_argument(
+        "-l",
+        "--input-list",
+        help="File listing one gene counts file per line, optionally "
+        + "followed by a tab and the sample ID.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
         required=True,
-        default="ReadsPerGene.out.tab",
-        help="Path to STAR gene counts file.",
+        help="Path to the output .npy matrix. Gene and sample IDs are "
+        + "written to a .index.json file next to it.",
+    )
+    parser.add_argument(
+        "-c",
+        "--column",
+        choices=COUNTS_COLUMNS,
+        default=COUNTS_COLUMNS[0],
+        help="Counts column to collect.",
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Add the samples to an existing matrix.",
+    )
+
+
+def add_augment_star_counts_arguments(parser):
+    """
+    Adds the arguments of augment_star_counts.
+    """
+    parser.add_argument(
+        "-i",
+        "--input",
+        action="append",
+        help="Path to STAR gene counts file. Use more than once for a batch "
+        + "written to --output-dir.",
     )
-    augct.add_argument(
+    parser.add_argument(
+        "-l",
+        "--input-list",
+        help="Batch mode: file listing one STAR gene counts file per line, "
+        + "optionally followed by a tab and its output file name.",
+    )
+    parser.add_argument(
         "-g",
         "--gene-info",
         required=True,
@@ -84,37 +340,212 @@ def load_args():
         help="Table of gene information with columns: gene_id, "
         + "total_exon_length, gene_name, gene_type, Chromosome",
     )
-    augct.add_argument(
+    parser.add_argument(
         "-o",
         "--output",
         required=False,
         default="counts_report.tsv",
         help="Output file name.",
     )
-    augct.add_argument(
+    parser.add_argument(
+        "--output-dir",
+        help="Batch mode: directory for outputs not named in --input-list, "
+        + "named after each input with a .augmented.tsv suffix.",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Batch mode: number of worker processes augmenting samples. "
+        + "Failed samples are reported and the rest of the batch carries on.",
+    )
+    parser.add_argument(
         "-v",
         "--gencode-version",
         required=True,
         action="store",
         help="adds a pragma line storing the gencode version to output",
     )
+    parser.add_argument(
+        "--gene-info-cache",
+        metavar="DIR",
+        help="Directory caching parsed gene info tables by file content and "
+        + "gencode version, shared by concurrent runs.",
+    )
+    parser.add_argument(
+        "--gene-info-cache-size",
+        metavar="SIZE",
+        default="1G",
+        help="Size limit of the gene info cache, e.g. 512M. Least recently "
+        + "used tables are removed first.",
+    )
+    parser.add_argument(
+        "--all-strands",
+        action="store_true",
+        help="Also add TPM, FPKM and FPKM-UQ columns for the stranded_first "
+        + "and stranded_second counts.",
+    )
+    parser.add_argument(
+        "--report-memory",
+        action="store_true",
+        help="Log the peak resident memory of the process after each stage. "
+        + "With --processes, log the peak of the worker process after each "
+        + "sample.",
+    )
+    add_cache_arguments(parser)
+
+
+def add_normalize_counts_matrix_arguments(parser):
+    """
+    Adds the arguments of normalize_counts_matrix.
+    """
+    parser.add_argument(
+        "-i",
+        "--input",
+        required=True,
+        help="Path to a .npy raw counts matrix written by build_counts_matrix.",
+    )
+    parser.add_argument(
+        "-g",
+        "--gene-info",
+        required=True,
+        help="Table of gene information with columns: gene_id, "
+        + "total_exon_length, gene_name, gene_type, Chromosome",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        required=True,
+        help="Output prefix. Writes <prefix>.tpm.npy, <prefix>.fpkm.npy, "
+        + "<prefix>.fpkm_uq.npy and <prefix>.index.json.",
+    )
+    parser.add_argument(
+        "--max-memory",
+        metavar="SIZE",
+        default="1G",
+        help="Memory budget of the samples normalized at a time, e.g. 512M.",
+    )
 
-    return parser.parse_args()
 
+TOOLS = [
+    Tool(
+        name="merge_star_gene_counts",
+        module="gdc_rnaseq_tools.merge_counts",
+        description="Formats and merges STAR gene " + "counts files.",
+        add_arguments=add_merge_star_gene_counts_arguments,
+    ),
+    Tool(
+        name="merge_star_junctions",
+        module="gdc_rnaseq_tools.merge_junctions",
+        description="Formats and merges STAR junction "
+        + "count files from the same sample.",
+        add_arguments=add_merge_star_junctions_arguments,
+    ),
+    Tool(
+        name="query_junctions",
+        module="gdc_rnaseq_tools.query_junctions",
+        description="Prints the junctions overlapping regions of a merged "
+        + "STAR junction counts file written with --index.",
+        add_arguments=add_query_junctions_arguments,
+    ),
+    Tool(
+        name="build_junction_matrix",
+        module="gdc_rnaseq_tools.junction_matrix",
+        description="Builds a sparse junction-by-sample count matrix from "
+        + "merged STAR junction counts files of many samples.",
+        add_arguments=add_build_junction_matrix_arguments,
+    ),
+    Tool(
+        name="build_counts_matrix",
+        module="gdc_rnaseq_tools.counts_matrix",
+        description="Builds or extends a memory-mapped genes-by-samples raw "
+        + "counts matrix from the gene counts files of many samples.",
+        add_arguments=add_build_counts_matrix_arguments,
+    ),
+    Tool(
+        name="augment_star_counts",
+        module="gdc_rnaseq_tools.augment_star_counts",
+        description="Adds FPKM/FPKM-UQ/TPM and gene info columns to STAR"
+        + " counts output",
+        add_arguments=add_augment_star_counts_arguments,
+    ),
+    Tool(
+        name="normalize_counts_matrix",
+        module="gdc_rnaseq_tools.normalize_matrix",
+        description="Computes TPM, FPKM and FPKM-UQ of every sample of a "
+        + "genes-by-samples raw counts matrix.",
+        add_arguments=add_normalize_counts_matrix_arguments,
+    ),
+]
 
-def main() -> None:
+
+def load_args(argv=None):
+    """
+    Loads the argument parser object.
+    :param argv: optional list of arguments, defaults to the command line
+    :return: argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(
+        description="Utility functions for the GDC RNA-Seq workflow"
+    )
+    parser.add_argument("--version", action="version", version=__version__)
+    parser.add_argument(
+        "--gzip-threads",
+        type=int,
+        metavar="N",
+        help="Number of threads compressing .gz outputs, including indexed "
+        + "ones. Defaults to one per CPU.",
+    )
+    parser.add_argument(
+        "--gzip-level",
+        type=int,
+        default=6,
+        choices=range(1, 10),
+        metavar="LEVEL",
+        help="Compression level of .gz outputs, including indexed ones, from "
+        + "1 to 9 [6].",
+    )
+    parser.add_argument(
+        "--gzip-read-ahead",
+        choices=["auto", "on", "off"],
+        default="auto",
+        help="Decompress .gz inputs in a background thread while they are "
+        + "parsed. With auto, only on hosts with more than one CPU [auto].",
+    )
+    sp = parser.add_subparsers(description="Select a tool", dest="choice")
+    sp.required = True
+    for tool in TOOLS:
+        tool.add_arguments(sp.add_parser(tool.name, description=tool.description))
+
+    return parser.parse_args(argv)
+
+
+def load_tool(name):
+    """
+    Imports the module of a subcommand.
+    :param name: subcommand name
+    :return: module with a main function
+    """
+    for tool in TOOLS:
+        if tool.name == name:
+            return importlib.import_module(tool.module)
+    raise ValueError("Unknown tool {0}".format(name))
+
+
+def main(argv=None) -> None:
     """Main entry point for CLI"""
     logger = get_logger("gdc-rnaseq-tools")
-    args = load_args()
+    args = load_args(argv)
 
+    configure_gzip(
+        threads=args.gzip_threads,
+        level=args.gzip_level,
+        read_ahead={"auto": None, "on": True, "off": False}[args.gzip_read_ahead],
+    )
     logger.info("Loading tool {0}".format(args.choice))
-    tool = None
-    if args.choice == "merge_star_gene_counts":
-        tool = merge_star_gene_counts
-    elif args.choice == "merge_star_junctions":
-        tool = merge_star_junctions
-    elif args.choice == "augment_star_counts":
-        tool = augment_star_counts
+    tool = load_tool(args.choice)
 
     tool.main(args)
     logger.info("Finished!")
@@ -1,15 +1,58 @@
+import hashlib
+import io
 import logging
+import os
+import pickle
 from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from enum import Enum
-from typing import List, Optional, Text, Union
+from typing import Dict, List, Optional, Text, Tuple, Union
 
 import numpy as np
 import pandas as pd
 
-from gdc_rnaseq_tools.utils import DataFormatError, get_logger
+from gdc_rnaseq_tools.cache import (
+    DiskCache,
+    cached_run,
+    fetch_result,
+    file_digest,
+    publish_result,
+    result_cache,
+    result_key,
+)
+from gdc_rnaseq_tools.utils import (
+    DataFormatError,
+    Error,
+    get_logger,
+    get_open_function,
+    parse_size,
+    peak_rss,
+)
 
 # from tests.fakearg import FakeArgs
 
+# Bump when the cached gene info table changes shape or parsing rules.
+GENE_INFO_CACHE_FORMAT = 2
+
+# Parser engine of typed loading, used when installed and the table has no
+# comment lines
+FAST_ENGINE = "pyarrow"
+
+# Suffix of outputs written to --output-dir in batch mode
+BATCH_OUTPUT_SUFFIX = ".augmented.tsv"
+
+# Rows formatted at a time by write_table
+WRITE_CHUNK_ROWS = 1 << 14
+
+# Characters that make DataFrame.to_csv quote a TSV cell
+QUOTED_CHARACTERS = frozenset('\t"\r\n')
+
+# Chromosomes excluded from the autosomal genes of FPKM-UQ
+NON_AUTOSOMES = ["chrX", "chrY", "chrM"]
+
+# Gene info and settings shared by the samples handled in a batch worker
+_batch_state: Dict = dict()
+
 
 class ColumnNames(Enum):
     @classmethod
@@ -26,6 +69,19 @@ class ColumnNames(Enum):
         """
         return [member.value for member in cls]
 
+    @classmethod
+    def dtypes(cls) -> Dict[Text, object]:
+        """
+        Returns the types of the columns for typed loading with `load_table`.
+
+        Args:
+            None
+
+        Returns:
+            dict of column name to dtype, in column order
+        """
+        return {col: COLUMN_DTYPES[col] for col in cls.cols()}
+
 
 class CountsColumns(ColumnNames):
     GENE_ID = "gene_id"
@@ -65,8 +121,34 @@ class FinalColumns(ColumnNames):
     FPKM_UQ_UNSTRANDED = "fpkm_uq_unstranded"
 
 
+# Types of the input columns. Low-cardinality text columns are categorical,
+# which keeps one copy of each value and makes comparisons work on codes.
+COLUMN_DTYPES: Dict[Text, object] = {
+    "gene_id": str,
+    "total_exon_length": np.int64,
+    "gene_name": str,
+    "gene_type": "category",
+    "chromosome": "category",
+    "unstranded": np.int64,
+    "stranded_first": np.int64,
+    "stranded_second": np.int64,
+}
+
+
+class StrandedColumns(ColumnNames):
+    TPM_STRANDED_FIRST = "tpm_stranded_first"
+    TPM_STRANDED_SECOND = "tpm_stranded_second"
+    FPKM_STRANDED_FIRST = "fpkm_stranded_first"
+    FPKM_STRANDED_SECOND = "fpkm_stranded_second"
+    FPKM_UQ_STRANDED_FIRST = "fpkm_uq_stranded_first"
+    FPKM_UQ_STRANDED_SECOND = "fpkm_uq_stranded_second"
+
+
 def load_table(
-    table_filename: Text, colnames: Optional[List[Text]] = None
+    table_filename: Text,
+    colnames: Optional[List[Text]] = None,
+    dtypes: Optional[Dict[Text, object]] = None,
+    engine: Optional[Text] = None,
 ) -> pd.DataFrame:
     """
     Loads tabular data into a DataFrame.
@@ -74,11 +156,91 @@ def load_table(
     Args:
         table_filename: file name of the tabular data
         colnames: a list of column names to be used when the table has no column headers.
+        dtypes: optional dict of column name to dtype, see
+            `ColumnNames.dtypes`. Only these columns are read, with these
+            types, instead of every column with inferred types.
+        engine: optional pandas parser engine. The pyarrow engine does not
+            skip comments, so it is only used for tables without any, and
+            only if pyarrow is installed; the default engine is used otherwise.
+            It reads every column, which are then named, selected and
+            converted.
+    Returns:
+        pandas DataFrame
+    Throws:
+        DataFormatError if typed columns are missing or hold other types
+    """
+    if dtypes is None and engine is None:
+        return pd.read_table(table_filename, names=colnames, comment="#")
+
+    if engine == "pyarrow":
+        source = uncommented_table(table_filename)
+        if source is not None:
+            try:
+                return load_arrow_table(source, colnames, dtypes)
+            except (KeyError, ValueError, TypeError) as e:
+                raise DataFormatError("Cannot load {}: {}".format(table_filename, e))
+        engine = None
+
+    options = {"names": colnames, "comment": "#"}
+    if dtypes is not None:
+        options.update(dtype=dtypes, usecols=list(dtypes))
+    try:
+        return pd.read_table(table_filename, engine=engine, **options)
+    except (ValueError, TypeError) as e:
+        raise DataFormatError("Cannot load {}: {}".format(table_filename, e))
+
+
+def load_arrow_table(
+    source: io.BytesIO,
+    colnames: Optional[List[Text]] = None,
+    dtypes: Optional[Dict[Text, object]] = None,
+) -> pd.DataFrame:
+    """
+    Loads a table with the pyarrow engine, which does not support selecting
+    columns by the names given in `colnames`: every column is read, then
+    named, selected and converted.
+
+    Args:
+        source: table without comments
+        colnames: a list of column names to be used when the table has no column headers.
+        dtypes: optional dict of column name to dtype of the columns to keep
     Returns:
         pandas DataFrame
     """
+    df = pd.read_table(source, engine="pyarrow", header=None if colnames else "infer")
+    if colnames:
+        if len(colnames) != len(df.columns):
+            raise ValueError(
+                "Expected {} columns but found {}".format(
+                    len(colnames), len(df.columns)
+                )
+            )
+        df.columns = colnames
+    if dtypes is not None:
+        df = df[list(dtypes)].astype(dtypes)
+    return df
+
+
+def uncommented_table(table_filename: Text) -> Optional[io.BytesIO]:
+    """
+    Reads a table for parsers that do not skip comments.
 
-    return pd.read_table(table_filename, names=colnames, comment="#")
+    Args:
+        table_filename: file name of the tabular data
+    Returns:
+        the decompressed table, or None if pyarrow is not installed or the
+        table has a comment character
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return None
+    reader = get_open_function(table_filename)
+    with reader(table_filename, "rb") as fh:
+        data = fh.read()
+    if b"#" in data:
+        return None
+    return io.BytesIO(data)
 
 
 def validate_table(df: pd.DataFrame, expected_columns: List[Text]) -> None:
@@ -96,6 +258,66 @@ def validate_table(df: pd.DataFrame, expected_columns: List[Text]) -> None:
         raise DataFormatError("Expected columns not found")
 
 
+def gene_info_cache_key(
+    gene_info_file: Text, gencode_version: Optional[int] = None
+) -> Text:
+    """
+    Cache key of a parsed gene info table. Depends on the file content, the
+    gencode version, the cache format and the pandas version used to pickle
+    the table.
+
+    Args:
+        gene_info_file: file name of the gene info table
+        gencode_version: gencode version of the gene info
+    Returns:
+        cache entry name
+    """
+    digest = hashlib.sha256()
+    digest.update(
+        "{0}\t{1}\t{2}\n".format(
+            GENE_INFO_CACHE_FORMAT, gencode_version, pd.__version__
+        ).encode()
+    )
+    digest = file_digest(gene_info_file, digest)
+    return "gene_info-{0}.pkl".format(digest.hexdigest())
+
+
+def load_gene_info(
+    gene_info_file: Text,
+    gencode_version: Optional[int] = None,
+    cache: Optional[DiskCache] = None,
+) -> pd.DataFrame:
+    """
+    Loads and validates the gene info table. With a cache, a table parsed by
+    an earlier run is unpickled instead, and a newly parsed table is added.
+    Pickles are only read from the cache directory, which must be trusted.
+
+    Args:
+        gene_info_file: file name of the gene info table
+        gencode_version: gencode version of the gene info
+        cache: optional cache of parsed gene info tables
+    Returns:
+        pandas DataFrame of the validated gene info
+    """
+    if cache is not None:
+        key = gene_info_cache_key(gene_info_file, gencode_version)
+        path = cache.get(key)
+        if path is not None:
+            try:
+                return pd.read_pickle(path)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                # evicted by another process, or unreadable; parse again
+                pass
+
+    gene_info = load_table(
+        gene_info_file, dtypes=GeneInfoColumns.dtypes(), engine=FAST_ENGINE
+    )
+    validate_table(gene_info, GeneInfoColumns.cols())
+    if cache is not None:
+        cache.put(key, gene_info.to_pickle)
+    return gene_info
+
+
 def merge_tables(df1: pd.DataFrame, df2: pd.DataFrame, on: Text) -> pd.DataFrame:
     """
     Performs an inner-join on data frames
@@ -111,6 +333,134 @@ def merge_tables(df1: pd.DataFrame, df2: pd.DataFrame, on: Text) -> pd.DataFrame
     return pd.merge(df1, df2, on=on, how="inner")
 
 
+class GeneAlignment:
+    """
+    Joins counts tables to a gene info table by row position instead of a
+    hash join on gene_id. The rows of the counts table matching each gene
+    info row are found once for a counts gene order and reused for every
+    counts table with the same order, as for all samples aligned with the
+    same STAR index. The result is the same as `merge_tables` with the gene
+    info on the left.
+    """
+
+    def __init__(self, gene_info: pd.DataFrame) -> None:
+        self.gene_info = gene_info
+        self.gene_ids = gene_info[GeneInfoColumns.GENE_ID.value].to_numpy()
+        self.gene_id_set = set(self.gene_ids)
+        self.unique = len(self.gene_id_set) == len(self.gene_ids)
+        self.protein_coding, self.autosomal_protein_coding = gene_selections(
+            gene_info[GeneInfoColumns.GENE_TYPE.value],
+            gene_info[GeneInfoColumns.CHROMOSOME.value],
+        )
+        self.counts_ids = None
+        self.rows = None
+        self.masks = None
+        self.merged_masks = None
+
+    def align(
+        self, counts_ids: np.ndarray
+    ) -> Optional[Tuple[Union[slice, np.ndarray], Union[slice, np.ndarray]]]:
+        """
+        Finds the gene info rows found in the counts table and the matching
+        counts rows, both in gene info order.
+
+        Args:
+            counts_ids: gene_id column of the counts table
+        Returns:
+            tuple of gene info rows and counts rows, as slices when the
+            counts list the gene info genes in the same order after their
+            leading rows, or None if counts gene IDs are not unique
+        """
+        if self.counts_ids is not None and np.array_equal(counts_ids, self.counts_ids):
+            return self.rows
+
+        offset = len(counts_ids) - len(self.gene_ids)
+        if (
+            offset >= 0
+            and np.array_equal(counts_ids[offset:], self.gene_ids)
+            and not self.gene_id_set.intersection(counts_ids[:offset])
+        ):
+            rows = (slice(None), slice(offset, None))
+        else:
+            index = pd.Index(counts_ids)
+            if not index.is_unique:
+                return None
+            found = index.get_indexer(self.gene_ids)
+            info_rows = np.flatnonzero(found >= 0)
+            rows = (info_rows, found[info_rows])
+
+        self.counts_ids = counts_ids
+        self.rows = rows
+        info_rows = rows[0]
+        self.masks = (
+            self.protein_coding[info_rows],
+            self.autosomal_protein_coding[info_rows],
+        )
+        return rows
+
+    def merge(self, counts: pd.DataFrame) -> pd.DataFrame:
+        """
+        Inner-join a counts table to the gene info with one gather per
+        column, falling back to `merge_tables` if gene IDs are not unique.
+
+        Args:
+            counts: the counts data frame
+        Returns:
+            A pandas.DataFrame of the gene info columns then the counts
+            columns, in gene info order
+        """
+        key = GeneInfoColumns.GENE_ID.value
+        rows = self.align(counts[key].to_numpy()) if self.unique else None
+        if rows is None:
+            self.merged_masks = None
+            return merge_tables(self.gene_info, counts, on=key)
+
+        self.merged_masks = self.masks
+        info_rows, counts_rows = rows
+        data = {col: self.gene_info[col].array[info_rows] for col in self.gene_info}
+        for col in counts.columns:
+            if col != key:
+                data[col] = counts[col].array[counts_rows]
+        return pd.DataFrame(data)
+
+    def selections(self, merged: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Gene selections of the normalized counts for the last merged table,
+        taken from the masks computed once per gene order when possible.
+
+        Args:
+            merged: the data frame returned by the last call to `merge`
+        Returns:
+            tuple of protein coding and autosomal protein coding boolean
+            arrays, see `gene_selections`
+        """
+        if self.merged_masks is not None:
+            return self.merged_masks
+        return gene_selections(
+            merged[MergedColumns.GENE_TYPE.value],
+            merged[MergedColumns.CHROMOSOME.value],
+        )
+
+
+def gene_selections(
+    gene_type: pd.Series, chromosome: pd.Series
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Selects the genes counted by the FPKM and FPKM-UQ normalizations.
+
+    Args:
+        gene_type: gene biotypes
+        chromosome: chromosome name on which gene is found
+    Returns:
+        tuple of boolean arrays of the protein coding genes and of the
+        protein coding genes on autosomes
+    """
+    # on categorical columns both compare category codes
+    protein_coding = (gene_type == "protein_coding").to_numpy()
+    autosomes = ~chromosome.isin(NON_AUTOSOMES).to_numpy()
+    return protein_coding, protein_coding & autosomes
+
+
 def get_extras(df: pd.DataFrame) -> pd.DataFrame:
     """
     STAR counts have 4 extra lines at the top reporting unmapped,
@@ -208,7 +558,7 @@ def calc_fpkm_uq(
     """
     # selections for U and G
     sel_prot = gene_type == "protein_coding"
-    sel_autosomes = ~chromosome.isin(["chrX", "chrY", "chrM"])
+    sel_autosomes = ~chromosome.isin(NON_AUTOSOMES)
     sel_nonzero = expression > 0
     # combine selections
     sel_U = sel_prot & sel_autosomes & sel_nonzero
@@ -223,11 +573,148 @@ def calc_fpkm_uq(
     return fpkm_uq
 
 
+def calc_normalized(
+    expression: np.ndarray,
+    feature_effective_length: np.ndarray,
+    protein_coding: np.ndarray,
+    autosomal_protein_coding: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    TPM, FPKM and FPKM-UQ of several counts columns in one pass over
+    preallocated arrays. Each row of the results is equal to `calc_tpm`,
+    `calc_fpkm` and `calc_fpkm_uq` of the same counts column: the operations
+    are done in the same order and sums are taken over contiguous rows.
+
+    Args:
+        expression: counts columns by genes array of raw counts
+        feature_effective_length: lengths of unified exons of each gene
+        protein_coding: selection of the protein coding genes
+        autosomal_protein_coding: selection of the protein coding genes on
+            autosomes, see `gene_selections`
+    Returns:
+        tuple of TPM, FPKM and FPKM-UQ arrays shaped like expression
+    """
+    expression = np.atleast_2d(expression)
+    out = np.empty((3,) + expression.shape)
+    tpm, fpkm, fpkm_uq = out
+    G = np.count_nonzero(autosomal_protein_coding)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # TPM: RPK scaled to the sum of RPK of each column
+        np.multiply(expression, 1e3, out=tpm)
+        np.divide(tpm, feature_effective_length, out=tpm)
+        M = np.array([[row.sum()] for row in tpm])
+        np.multiply(tpm, 1e6, out=tpm)
+        np.divide(tpm, M, out=tpm)
+
+        # FPKM: N is the sum of counts in protein coding genes
+        N = expression[:, protein_coding].sum(axis=1)
+        np.multiply(expression, 1e9, out=fpkm)
+        np.divide(fpkm, N[:, np.newaxis] * feature_effective_length, out=fpkm)
+
+        # FPKM-UQ: U is the upper quartile of the nonzero autosomal protein
+        # coding counts of each column
+        for row, counts in enumerate(expression):
+            U = np.quantile(counts[autosomal_protein_coding & (counts > 0)], 0.75)
+            np.multiply(counts, 1e9, out=fpkm_uq[row])
+            np.divide(fpkm_uq[row], U * G * feature_effective_length, out=fpkm_uq[row])
+    return tpm, fpkm, fpkm_uq
+
+
+def write_table(
+    df: pd.DataFrame,
+    out,
+    float_format: Text = "%.4f",
+    chunk_rows: int = WRITE_CHUNK_ROWS,
+) -> None:
+    """
+    Writes a table as TSV with a header line, byte for byte like
+    ``df.to_csv(out, sep="\\t", index=False, float_format=float_format)``
+    on a POSIX system. Each chunk of rows is formatted with a single string
+    operation on one format string per row instead of cell by cell. Lines
+    of rows with missing values, written as empty cells, are then rewritten
+    one at a time, and chunks with cells that to_csv would quote, as well as single
+    column tables and unusual column types, are left to to_csv.
+
+    Args:
+        df: the table to write
+        out: text file handle
+        float_format: format of float columns
+        chunk_rows: number of rows formatted at a time
+    """
+    formats = []
+    for dtype in df.dtypes:
+        if dtype.kind == "f":
+            formats.append(float_format)
+        elif dtype.kind in "iu":
+            formats.append("%d")
+        elif dtype.kind in "bO":
+            formats.append("%s")
+        else:
+            break
+    if len(formats) < 2 or len(formats) != len(df.columns):
+        df.to_csv(out, sep="\t", header=True, index=False, float_format=float_format)
+        return
+    row_format = "\t".join(formats) + "\n"
+
+    header = "\t".join(str(col) for col in df.columns) + "\n"
+    if QUOTED_CHARACTERS.intersection(header[:-1]):
+        df.iloc[:0].to_csv(out, sep="\t", header=True, index=False)
+    else:
+        out.write(header)
+
+    values = []
+    for col in df.columns:
+        column = df[col]
+        if column.dtype.kind in "iuf" and not isinstance(column.dtype, np.dtype):
+            # nullable numbers hold pd.NA, which %d and %f reject; rows with
+            # missing values are rewritten after the bulk format anyway
+            values.append(column.to_numpy(column.dtype.numpy_dtype, na_value=0))
+        else:
+            values.append(column.to_numpy())
+    missing_cells = df.isna().to_numpy()
+    missing = missing_cells.any(axis=1)
+    width = len(values)
+    for start in range(0, len(df), chunk_rows):
+        end = min(start + chunk_rows, len(df))
+        # cells in row order, interleaving the columns
+        cells = [None] * ((end - start) * width)
+        for i, column in enumerate(values):
+            cells[i::width] = column[start:end].tolist()
+        text = (row_format * (end - start)) % tuple(cells)
+        if (
+            text.count("\n") != end - start
+            or text.count("\t") != (end - start) * (width - 1)
+            or '"' in text
+            or "\r" in text
+        ):
+            df.iloc[start:end].to_csv(
+                out, sep="\t", header=False, index=False, float_format=float_format
+            )
+            continue
+
+        rows = np.flatnonzero(missing[start:end]).tolist()
+        if rows:
+            # rewrite the lines of rows with missing values
+            lines = text.split("\n")
+            for row in rows:
+                lines[row] = "\t".join(
+                    "" if na else fmt % cell
+                    for fmt, cell, na in zip(
+                        formats,
+                        cells[row * width : (row + 1) * width],
+                        missing_cells[start + row],
+                    )
+                )
+            text = "\n".join(lines)
+        out.write(text)
+
+
 def save_result(
     df: pd.DataFrame, outfile: Text, gencode_version: Optional[int] = None
 ) -> None:
     """
-    Write output table as TSV with 4 places of floating point precision
+    Write output table as TSV with 4 places of floating point precision,
+    gzip compressed if the file name ends with .gz
 
     Args:
         df: final results table
@@ -235,10 +722,11 @@ def save_result(
         pragma_line: informational line to be added to top of output file
     """
 
-    with open(outfile, "w") as out:
+    writer = get_open_function(outfile)
+    with writer(outfile, "wt") as out:
         if gencode_version is not None:
             out.write("# gene-model: GENCODE v{}\n".format(gencode_version))
-        df.to_csv(out, sep="\t", header=True, index=False, float_format="%.4f")
+        write_table(df, out, float_format="%.4f")
 
 
 def augment(
@@ -247,6 +735,11 @@ def augment(
     outfile: Text,
     gencode_version: int,
     logger: logging.Logger,
+    gene_info_cache: Optional[DiskCache] = None,
+    gene_info: Optional[pd.DataFrame] = None,
+    alignment: Optional[GeneAlignment] = None,
+    all_strands: bool = False,
+    report_memory: bool = False,
 ) -> None:
     """
     Augment STAR read counts with normalized counts and gene info
@@ -263,53 +756,368 @@ def augment(
         outfile: output file name
         pragma_line: free-text string to be added to top of results file
         logger: logging.Logger object used to communicate messages
+        gene_info_cache: optional cache of parsed gene info tables
+        gene_info: optional gene info table already loaded with
+            `load_gene_info`, used instead of reading gene_info_file
+        alignment: optional `GeneAlignment` of the gene info, reused across
+            samples, used instead of gene_info and gene_info_file
+        all_strands: whether to also add the normalized counts of the
+            stranded_first and stranded_second columns
+        report_memory: whether to log the peak RSS after each stage
     """
 
     # load data
     logger.info("Reading counts file {}".format(counts_file))
-    counts = load_table(counts_file, CountsColumns.cols())
+    counts = load_table(
+        counts_file,
+        CountsColumns.cols(),
+        dtypes=CountsColumns.dtypes(),
+        engine=FAST_ENGINE,
+    )
     validate_table(counts, CountsColumns.cols())
+    if report_memory:
+        log_peak_memory(logger, "reading counts")
 
-    logger.info("Reading gene info file {}".format(gene_info_file))
-    gene_info = load_table(gene_info_file)
-    validate_table(gene_info, GeneInfoColumns.cols())
+    if alignment is None:
+        if gene_info is None:
+            logger.info("Reading gene info file {}".format(gene_info_file))
+            gene_info = load_gene_info(gene_info_file, gencode_version, gene_info_cache)
+        alignment = GeneAlignment(gene_info)
+        if report_memory:
+            log_peak_memory(logger, "reading gene info")
 
     # merge counts with gene info
     logger.info("Merging counts and gene info tables")
-    merged = merge_tables(gene_info, counts, on=GeneInfoColumns.GENE_ID.value)
+    merged = alignment.merge(counts)
     validate_table(merged, MergedColumns.cols())
+    # only the extra alignment stats are needed from the counts from here on
+    misalign_stats = get_extras(counts)
+    del counts
+    if report_memory:
+        log_peak_memory(logger, "merging")
 
     # calculate new normalized counts
     logger.info("Calculating normalized counts")
-    # FPKM
-    merged[FinalColumns.FPKM_UNSTRANDED.value] = calc_fpkm(
-        expression=merged[MergedColumns.UNSTRANDED.value],
-        feature_effective_length=merged[MergedColumns.TOTAL_EXON_LENGTH.value],
-        gene_type=merged[MergedColumns.GENE_TYPE.value],
+    strands = [MergedColumns.UNSTRANDED.value]
+    if all_strands:
+        strands += [
+            MergedColumns.STRANDED_FIRST.value,
+            MergedColumns.STRANDED_SECOND.value,
+        ]
+    tpm, fpkm, fpkm_uq = calc_normalized(
+        np.stack([merged[strand].to_numpy() for strand in strands]),
+        merged[MergedColumns.TOTAL_EXON_LENGTH.value].to_numpy(),
+        *alignment.selections(merged),
     )
+    normalized = dict()
+    for i, strand in enumerate(strands):
+        normalized["tpm_" + strand] = tpm[i]
+        normalized["fpkm_" + strand] = fpkm[i]
+        normalized["fpkm_uq_" + strand] = fpkm_uq[i]
+    if report_memory:
+        log_peak_memory(logger, "normalizing")
+
+    # add back extra alignment stats, copying each output column once
+    columns = FinalColumns.cols()
+    if all_strands:
+        columns += StrandedColumns.cols()
+    final = pd.DataFrame(
+        {
+            col: prepend_rows(
+                misalign_stats.get(col),
+                normalized[col] if col in normalized else merged[col],
+                len(misalign_stats),
+            )
+            for col in columns
+        },
+        copy=False,
+    )
+    del merged, normalized, tpm, fpkm, fpkm_uq
+    if report_memory:
+        log_peak_memory(logger, "assembling output")
+
+    # write output table
+    logger.info("Saving results to {}".format(outfile))
+    save_result(df=final, outfile=outfile, gencode_version=gencode_version)
+    if report_memory:
+        log_peak_memory(logger, "saving results")
+
+
+def prepend_rows(
+    head: Optional[pd.Series], body: Union[pd.Series, np.ndarray], n_head: int
+) -> pd.Series:
+    """
+    Builds an output column from the leading rows and the gene rows, like
+    one column of `pd.concat` of the two tables.
+
+    Args:
+        head: the column of the leading rows, or None if they do not have it
+        body: the column of the gene rows
+        n_head: number of leading rows
+    Returns:
+        pandas.Series of the leading rows, missing values if they do not
+        have the column, then the gene rows
+    """
+    if isinstance(body, np.ndarray):
+        body = pd.Series(body)
+    if head is None:
+        # missing values of the same type, keeping categories
+        head = body.iloc[:0].reindex(range(n_head))
+    return pd.concat([head, body], ignore_index=True)
+
+
+def log_peak_memory(logger: logging.Logger, stage: Text) -> None:
+    """
+    Logs the peak resident set size of the process after a stage of
+    `augment`.
+
+    Args:
+        logger: logging.Logger object used to communicate messages
+        stage: name of the stage that just finished
+    """
+    logger.info("Peak RSS after {}: {}".format(stage, format_rss(peak_rss())))
+
+
+def format_rss(peak: Optional[int]) -> Text:
+    """
+    Formats a peak RSS from `peak_rss` in MiB, or "unknown" if it is None.
+    """
+    return "unknown" if peak is None else "{:.1f} MiB".format(peak / (1 << 20))
+
+
+def batch_output_name(counts_file: Text) -> Text:
+    """
+    File name of the output for a counts file written to an output directory:
+    its base name without compression and table extensions plus
+    `BATCH_OUTPUT_SUFFIX`.
+    """
+    name = os.path.basename(counts_file)
+    for ext in [".gz", ".tsv", ".tab", ".txt"]:
+        if name.endswith(ext):
+            name = name[: -len(ext)]
+    return name + BATCH_OUTPUT_SUFFIX
+
+
+def load_batch_jobs(
+    inputs: List[Text],
+    input_list: Optional[Text] = None,
+    output_dir: Optional[Text] = None,
+) -> List[Tuple[Text, Text]]:
+    """
+    Pairs each counts file with its output file.
 
-    # FPKM-UQ
-    merged[FinalColumns.FPKM_UQ_UNSTRANDED.value] = calc_fpkm_uq(
-        expression=merged[MergedColumns.UNSTRANDED.value],
-        feature_effective_length=merged[MergedColumns.TOTAL_EXON_LENGTH.value],
-        gene_type=merged[MergedColumns.GENE_TYPE.value],
-        chromosome=merged[MergedColumns.CHROMOSOME.value],
+    Args:
+        inputs: counts file names
+        input_list: optional file with one counts file name per line,
+            optionally followed by a tab and the output file name
+        output_dir: directory for outputs not named in the input list
+    Returns:
+        list of counts file and output file name pairs
+    Throws:
+        ValueError if an output is not named and there is no output_dir, or
+        two counts files share an output
+    """
+    pairs = [(fil, None) for fil in inputs]
+    if input_list:
+        with open(input_list, "rt") as fh:
+            for line in fh:
+                cols = line.rstrip("\r\n").split("\t")
+                if cols[0] and not cols[0].startswith("#"):
+                    pairs.append((cols[0], cols[1] if len(cols) > 1 else None))
+
+    jobs = []
+    for counts_file, outfile in pairs:
+        if not outfile:
+            if not output_dir:
+                raise ValueError(
+                    "No output for {} and no output directory".format(counts_file)
+                )
+            outfile = os.path.join(output_dir, batch_output_name(counts_file))
+        jobs.append((counts_file, outfile))
+
+    outputs = [outfile for _, outfile in jobs]
+    if len(set(outputs)) < len(outputs):
+        raise ValueError("Several counts files have the same output file")
+    return jobs
+
+
+def augment_sample(
+    job: Tuple[Text, Text],
+    alignment: GeneAlignment,
+    gencode_version: int,
+    logger: logging.Logger,
+    all_strands: bool = False,
+    report_memory: bool = False,
+) -> Optional[Text]:
+    """
+    Augment one sample of a batch, catching any failure so that the rest of
+    the batch carries on.
+
+    Args:
+        job: counts file and output file name
+        alignment: `GeneAlignment` of the validated gene info table
+        gencode_version: gencode version for the pragma line
+        logger: logging.Logger object used to communicate messages
+        all_strands: whether to add normalized counts of all strands
+        report_memory: whether to log the peak RSS after each stage
+    Returns:
+        None on success, otherwise a description of the error
+    """
+    counts_file, outfile = job
+    try:
+        augment(
+            counts_file=counts_file,
+            gene_info_file=None,
+            outfile=outfile,
+            gencode_version=gencode_version,
+            logger=logger,
+            alignment=alignment,
+            all_strands=all_strands,
+            report_memory=report_memory,
+        )
+    except Exception as e:
+        return "{}: {}".format(type(e).__name__, e)
+    return None
+
+
+def _init_batch_worker(
+    gene_info: pd.DataFrame,
+    gencode_version: int,
+    all_strands: bool,
+    report_memory: bool,
+) -> None:
+    """
+    Keeps the gene info in the worker process so it is sent once per worker
+    rather than once per sample. Workers only log warnings, so with
+    report_memory the peak RSS is returned to the parent after each sample
+    instead of logged after each stage.
+    """
+    logger = logging.getLogger("augment_counts_table.batch")
+    logger.setLevel(logging.WARNING)
+    _batch_state.update(
+        alignment=GeneAlignment(gene_info),
+        gencode_version=gencode_version,
+        logger=logger,
+        all_strands=all_strands,
+        report_memory=report_memory,
     )
 
-    # TPM
-    merged[FinalColumns.TPM_UNSTRANDED.value] = calc_tpm(
-        expression=merged[MergedColumns.UNSTRANDED.value],
-        feature_effective_length=merged[MergedColumns.TOTAL_EXON_LENGTH.value],
+
+def _augment_in_worker(job: Tuple[Text, Text]) -> Tuple[Optional[Text], Optional[int]]:
+    error = augment_sample(
+        job,
+        _batch_state["alignment"],
+        _batch_state["gencode_version"],
+        _batch_state["logger"],
+        _batch_state["all_strands"],
     )
+    return error, peak_rss() if _batch_state["report_memory"] else None
 
-    # add back extra alignment stats
-    misalign_stats = get_extras(counts)
-    final = pd.concat([misalign_stats, merged], axis=0)
-    final = final[FinalColumns.cols()].copy()
 
-    # write output table
-    logger.info("Saving results to {}".format(outfile))
-    save_result(df=final, outfile=outfile, gencode_version=gencode_version)
+def augment_batch(
+    jobs: List[Tuple[Text, Text]],
+    gene_info_file: Text,
+    gencode_version: int,
+    logger: logging.Logger,
+    processes: int = 1,
+    gene_info_cache: Optional[DiskCache] = None,
+    all_strands: bool = False,
+    report_memory: bool = False,
+) -> List[Tuple[Text, Text]]:
+    """
+    Augment many samples with one load of the gene info, in a pool of worker
+    processes when more than one process is requested. A failed sample is
+    logged and the batch carries on.
+
+    Args:
+        jobs: counts file and output file name pairs
+        gene_info_file: file name for gene info
+        gencode_version: gencode version for the pragma line
+        logger: logging.Logger object used to communicate messages
+        processes: number of worker processes
+        gene_info_cache: optional cache of parsed gene info tables
+        all_strands: whether to add normalized counts of all strands
+        report_memory: whether to log the peak RSS after each stage of
+            each sample, or with worker processes the peak RSS of the worker
+            after each sample
+    Returns:
+        list of counts file and error description of the failed samples
+    """
+    logger.info("Reading gene info file {}".format(gene_info_file))
+    gene_info = load_gene_info(gene_info_file, gencode_version, gene_info_cache)
+
+    failures = []
+
+    def report(job: Tuple[Text, Text], error: Optional[Text]) -> None:
+        if error is None:
+            logger.info("Augmented {} to {}".format(*job))
+        else:
+            logger.error("Failed to augment {}: {}".format(job[0], error))
+            failures.append((job[0], error))
+
+    if not processes or processes < 2 or len(jobs) < 2:
+        alignment = GeneAlignment(gene_info)
+        for job in jobs:
+            report(
+                job,
+                augment_sample(
+                    job,
+                    alignment,
+                    gencode_version,
+                    logger,
+                    all_strands,
+                    report_memory,
+                ),
+            )
+        return failures
+
+    with ProcessPoolExecutor(
+        max_workers=min(processes, len(jobs)),
+        initializer=_init_batch_worker,
+        initargs=(gene_info, gencode_version, all_strands, report_memory),
+    ) as pool:
+        futures = {pool.submit(_augment_in_worker, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                error, peak = future.result()
+            except Exception as e:
+                # the worker process died, e.g. killed for running out of memory
+                error, peak = "{}: {}".format(type(e).__name__, e), None
+            report(futures[future], error)
+            if report_memory and error is None:
+                logger.info(
+                    "Peak RSS of the worker after {}: {}".format(
+                        futures[future][0], format_rss(peak)
+                    )
+                )
+    order = {job[0]: i for i, job in enumerate(jobs)}
+    return sorted(failures, key=lambda failure: order[failure[0]])
+
+
+def augment_result_key(
+    job: Tuple[Text, Text],
+    gene_info_file: Text,
+    gencode_version: int,
+    all_strands: bool = False,
+) -> Text:
+    """
+    Result cache key of augmenting one sample.
+
+    Args:
+        job: counts file and output file name
+        gene_info_file: file name for gene info
+        gencode_version: gencode version for the pragma line
+        all_strands: whether to add normalized counts of all strands
+    Returns:
+        cache entry name
+    """
+    counts_file, outfile = job
+    options = {
+        "gencode_version": str(gencode_version),
+        "all_strands": bool(all_strands),
+        "gzip": outfile.endswith(".gz"),
+    }
+    return result_key("augment_star_counts", options, [counts_file, gene_info_file])
 
 
 def main(args: Union[Namespace, object]) -> None:
@@ -321,15 +1129,103 @@ def main(args: Union[Namespace, object]) -> None:
               attributes input, gene_info, output, gencode_version
     """
     logger = get_logger("augment_counts_table")
-    logger.info("Augmenting STAR gene counts file {}.".format(args.input))
 
-    augment(
-        counts_file=args.input,
-        gene_info_file=args.gene_info,
-        outfile=args.output,
-        gencode_version=args.gencode_version,
-        logger=logger,
+    gene_info_cache = None
+    if getattr(args, "gene_info_cache", None):
+        max_size = getattr(args, "gene_info_cache_size", None)
+        gene_info_cache = DiskCache(
+            args.gene_info_cache, parse_size(max_size) if max_size else None
+        )
+
+    cache = result_cache(args)
+    all_strands = getattr(args, "all_strands", False)
+    report_memory = getattr(args, "report_memory", False)
+    inputs = [args.input] if isinstance(args.input, str) else list(args.input or [])
+    input_list = getattr(args, "input_list", None)
+    output_dir = getattr(args, "output_dir", None)
+    if not inputs and not input_list:
+        raise ValueError("No STAR gene counts file given")
+    if input_list or output_dir or len(inputs) != 1:
+        jobs = load_batch_jobs(inputs, input_list, output_dir)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        logger.info("Augmenting {} STAR gene counts files.".format(len(jobs)))
+
+        keys = dict()
+        pending = jobs
+        failures = []
+        if cache is not None:
+            pending = []
+            for job in jobs:
+                try:
+                    keys[job] = augment_result_key(
+                        job, args.gene_info, args.gencode_version, all_strands
+                    )
+                except Exception as e:
+                    # e.g. a missing counts file, reported like any sample error
+                    error = "{}: {}".format(type(e).__name__, e)
+                    logger.error("Failed to augment {}: {}".format(job[0], error))
+                    failures.append((job[0], error))
+                    continue
+                if not fetch_result(cache, keys[job], [job[1]]):
+                    pending.append(job)
+            logger.info(
+                "Served {} samples from the result cache.".format(
+                    len(jobs) - len(pending) - len(failures)
+                )
+            )
+
+        failures += augment_batch(
+            pending,
+            gene_info_file=args.gene_info,
+            gencode_version=args.gencode_version,
+            logger=logger,
+            processes=getattr(args, "processes", 1),
+            gene_info_cache=gene_info_cache,
+            all_strands=all_strands,
+            report_memory=report_memory,
+        )
+        if failures:
+            order = {job[0]: i for i, job in enumerate(jobs)}
+            failures.sort(key=lambda failure: order[failure[0]])
+        if cache is not None:
+            failed = set(counts_file for counts_file, _ in failures)
+            for job in pending:
+                if job[0] not in failed:
+                    publish_result(cache, keys[job], [job[1]])
+        if failures:
+            raise Error(
+                "{} of {} samples failed: {}".format(
+                    len(failures),
+                    len(jobs),
+                    ", ".join(counts_file for counts_file, _ in failures),
+                )
+            )
+        return
+
+    logger.info("Augmenting STAR gene counts file {}.".format(inputs[0]))
+    key = None
+    if cache is not None:
+        key = augment_result_key(
+            (inputs[0], args.output), args.gene_info, args.gencode_version, all_strands
+        )
+    served = cached_run(
+        cache,
+        key,
+        [args.output],
+        lambda: augment(
+            counts_file=inputs[0],
+            gene_info_file=args.gene_info,
+            outfile=args.output,
+            gencode_version=args.gencode_version,
+            logger=logger,
+            gene_info_cache=gene_info_cache,
+            all_strands=all_strands,
+            report_memory=report_memory,
+        ),
     )
+    if served:
+        logger.info("Served {} from the result cache.".format(args.output))
 
 
 # def main(args: Union[FakeArgs, Namespace]) -> None:
@@ -0,0 +1,382 @@
+"""Reading and writing BGZF, the blocked gzip format used by tabix and htslib.
+
+A BGZF file is a series of gzip members of at most 64 KiB each, so standard
+gzip readers can read it while indexed readers can seek straight to a block.
+Positions are virtual offsets: the compressed offset of a block shifted left
+16 bits, plus the offset of a byte within the uncompressed block.
+
+Blocks are compressed independently, so `ParallelBgzfWriter` compresses them
+and `inflate_chunks` decompresses them in a thread pool; zlib releases the
+GIL while it works.
+"""
+
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from gdc_rnaseq_tools.utils import DataFormatError
+
+# Uncompressed bytes per block, as in htslib, so a block of incompressible
+# data still fits in the 64 KiB limit.
+BLOCK_SIZE = 0xFF00
+COMPRESS_LEVEL = 6
+
+HEADER = struct.Struct("<4BI2BH2BHH")
+HEADER_SIZE = HEADER.size
+FOOTER = struct.Struct("<II")
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def compress_block(data, level=COMPRESS_LEVEL):
+    """
+    Compress up to `BLOCK_SIZE` bytes into one BGZF block.
+
+    :param data: uncompressed bytes
+    :param level: zlib compression level
+    :return: bytes of the complete block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = HEADER.pack(
+        31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + HEADER_SIZE + 7
+    )
+    return header + cdata + FOOTER.pack(zlib.crc32(data), len(data))
+
+
+def read_block(handle, path):
+    """
+    Read the next BGZF block of a file.
+
+    :param handle: binary file handle positioned at the start of a block
+    :param path: file path, for error messages
+    :return: tuple of the raw deflate data, the CRC32 and size of the
+    uncompressed data and the size of the block, or None at end of file
+    :raises DataFormatError: if the block is not a BGZF block
+    """
+    header = handle.read(HEADER_SIZE)
+    if not header:
+        return None
+    if len(header) < HEADER_SIZE or header[:4] != b"\x1f\x8b\x08\x04":
+        raise DataFormatError("{0} is not a BGZF file".format(path))
+    xlen = struct.unpack("<H", header[10:12])[0]
+    extra = header[12:] + handle.read(xlen - 6)
+    bsize = None
+    pos = 0
+    while pos + 4 <= len(extra):
+        si1, si2, slen = struct.unpack("<BBH", extra[pos : pos + 4])
+        if si1 == 66 and si2 == 67 and slen == 2:
+            bsize = struct.unpack("<H", extra[pos + 4 : pos + 6])[0]
+        pos += 4 + slen
+    if bsize is None:
+        raise DataFormatError("{0} is not a BGZF file".format(path))
+    cdata = handle.read(bsize - xlen - 19)
+    footer = handle.read(FOOTER.size)
+    if len(footer) < FOOTER.size:
+        raise DataFormatError("{0} ends with a truncated BGZF block".format(path))
+    crc, size = FOOTER.unpack(footer)
+    return cdata, crc, size, bsize + 1
+
+
+def inflate_block(cdata, crc, size, path):
+    """
+    Decompress the data of one BGZF block and check it against its footer.
+
+    :raises DataFormatError: if the data does not match the footer
+    """
+    try:
+        data = zlib.decompress(cdata, -15)
+    except zlib.error as e:
+        raise DataFormatError("Corrupt BGZF block in {0}: {1}".format(path, e))
+    if len(data) != size or zlib.crc32(data) != crc:
+        raise DataFormatError("Corrupt BGZF block in {0}".format(path))
+    return data
+
+
+def is_bgzf(path):
+    """
+    Checks whether a file starts with a BGZF block.
+
+    :param path: file path
+    :return: bool
+    """
+    with open(path, "rb") as fh:
+        try:
+            return read_block(fh, path) is not None
+        except DataFormatError:
+            return False
+
+
+def inflate_chunks(path, chunk_size, threads=None):
+    """
+    Generator of the uncompressed data of a BGZF file in chunks of about
+    `chunk_size` bytes. Blocks are read in order and decompressed in a
+    thread pool, with at most a few blocks per thread in flight.
+
+    :param path: BGZF file path
+    :param chunk_size: minimum size of each chunk but the last
+    :param threads: number of threads, defaults to the number of CPUs;
+    blocks are decompressed in the calling thread with one
+    :return: bytes
+    """
+    threads = threads or os.cpu_count() or 1
+    parts = []
+    size = 0
+    with open(path, "rb") as fh, ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = deque()
+        while True:
+            block = read_block(fh, path)
+            if block is not None:
+                if threads > 1:
+                    pending.append(pool.submit(inflate_block, *block[:3], path))
+                else:
+                    pending.append(inflate_block(*block[:3], path))
+            while pending and (block is None or len(pending) > 4 * threads):
+                data = pending.popleft()
+                data = data if threads < 2 else data.result()
+                parts.append(data)
+                size += len(data)
+                if size >= chunk_size:
+                    yield b"".join(parts)
+                    parts = []
+                    size = 0
+            if block is None:
+                break
+    if parts:
+        yield b"".join(parts)
+
+
+class BgzfWriter:
+    """Binary file-like writer of BGZF blocks that tracks virtual offsets"""
+
+    def __init__(self, path, level=COMPRESS_LEVEL):
+        self.path = path
+        self.level = level
+        self.handle = open(path, "wb")
+        self.buffer = bytearray()
+        self.block_address = 0
+
+    def write(self, data):
+        """
+        Write bytes, emitting a block each time `BLOCK_SIZE` bytes are
+        buffered.
+        """
+        self.buffer += data
+        while len(self.buffer) >= BLOCK_SIZE:
+            self._write_block(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+        return len(data)
+
+    def tell(self):
+        """
+        Returns the virtual offset of the next byte to be written.
+        """
+        return (self.block_address << 16) | len(self.buffer)
+
+    def flush(self):
+        """
+        Write any buffered bytes as a block.
+        """
+        if self.buffer:
+            self._write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.handle.flush()
+
+    def close(self):
+        """
+        Flush and write the BGZF end-of-file marker block.
+        """
+        if self.handle.closed:
+            return
+        self.flush()
+        self.handle.write(EOF_BLOCK)
+        self.handle.close()
+
+    def _write_block(self, data):
+        block = compress_block(data, self.level)
+        self.handle.write(block)
+        self.block_address += len(block)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ParallelBgzfWriter(io.RawIOBase):
+    """
+    Binary file-like writer of BGZF blocks compressed in a thread pool.
+    Blocks are written in order, and at most a few blocks per thread are
+    held in memory. The output is the same as that of `BgzfWriter` without
+    intermediate flushes: `flush` only writes blocks that are already full.
+    Every block but the last holds `BLOCK_SIZE` uncompressed bytes, and the
+    compressed size of each block written is kept in `block_sizes`, so
+    virtual offsets can be worked out from uncompressed offsets.
+    """
+
+    def __init__(self, path, threads=None, level=COMPRESS_LEVEL, mode="wb"):
+        """
+        :param path: output path
+        :param threads: number of compression threads, defaults to the
+        number of CPUs; blocks are compressed in the calling thread with one
+        :param level: zlib compression level
+        :param mode: ``wb``, ``ab`` or ``xb``
+        """
+        super().__init__()
+        self.path = path
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.handle = open(path, mode)
+        self.buffer = bytearray()
+        self.block_sizes = []
+        self.pending = deque()
+        self.pool = None
+        if self.threads > 1:
+            self.pool = ThreadPoolExecutor(max_workers=self.threads)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """
+        Write bytes, compressing a block each time `BLOCK_SIZE` bytes are
+        buffered.
+        """
+        self.buffer += data
+        if len(self.buffer) >= BLOCK_SIZE:
+            buffered = bytes(self.buffer)
+            end = len(buffered) - len(buffered) % BLOCK_SIZE
+            for start in range(0, end, BLOCK_SIZE):
+                self._submit(buffered[start : start + BLOCK_SIZE])
+            self.buffer = bytearray(buffered[end:])
+        return len(data)
+
+    def flush(self):
+        """
+        Write the blocks compressed so far.
+        """
+        if self.handle.closed:
+            return
+        self._drain(0)
+        self.handle.flush()
+
+    def close(self):
+        """
+        Compress any buffered bytes, write all blocks and the BGZF
+        end-of-file marker block.
+        """
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            self._drain(0)
+            self.handle.write(EOF_BLOCK)
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+            self.handle.close()
+            super().close()
+
+    def _submit(self, data):
+        if self.pool is None:
+            self._write_block(compress_block(data, self.level))
+            return
+        self.pending.append(self.pool.submit(compress_block, data, self.level))
+        self._drain(4 * self.threads)
+
+    def _drain(self, limit):
+        # write finished blocks in order until at most `limit` are pending
+        while len(self.pending) > limit:
+            self._write_block(self.pending.popleft().result())
+
+    def _write_block(self, block):
+        self.handle.write(block)
+        self.block_sizes.append(len(block))
+
+
+class BgzfReader:
+    """Reader of BGZF files that can seek to virtual offsets"""
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = open(path, "rb")
+        self.block_address = 0
+        self.next_address = 0
+        self.block = b""
+        self.offset = 0
+        self._load_block(0)
+
+    def seek(self, virtual_offset):
+        """
+        Move to a virtual offset.
+        """
+        address, offset = virtual_offset >> 16, virtual_offset & 0xFFFF
+        if address != self.block_address or not self.block:
+            self._load_block(address)
+        self.offset = offset
+        self._skip_exhausted()
+
+    def tell(self):
+        """
+        Returns the virtual offset of the next byte to be read.
+        """
+        return (self.block_address << 16) | self.offset
+
+    def readline(self):
+        """
+        Returns the next line as bytes, or empty bytes at end of file.
+        """
+        parts = []
+        while self.block:
+            end = self.block.find(b"\n", self.offset)
+            if end >= 0:
+                parts.append(self.block[self.offset : end + 1])
+                self.offset = end + 1
+                self._skip_exhausted()
+                break
+            parts.append(self.block[self.offset :])
+            self._load_block(self.next_address)
+        return b"".join(parts)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _skip_exhausted(self):
+        # Keep offsets at the start of the next block rather than the end of
+        # the current one, matching the offsets recorded by the writer.
+        while self.block and self.offset >= len(self.block):
+            self._load_block(self.next_address)
+
+    def _load_block(self, address):
+        self.handle.seek(address)
+        self.block_address = address
+        self.offset = 0
+        block = read_block(self.handle, self.path)
+        if block is None:
+            self.block = b""
+            self.next_address = address
+            return
+        cdata, _, _, bsize = block
+        self.block = zlib.decompress(cdata, -15)
+        self.next_address = address + bsize
+        if not self.block:
+            # empty blocks, including the EOF marker, are skipped
+            self._load_block(self.next_address)
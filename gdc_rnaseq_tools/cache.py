@@ -0,0 +1,243 @@
+"""On-disk caches that can be shared by concurrent processes.
+
+Entries are files in one directory, named by a key derived from the content
+of their inputs. An entry is written to a temporary file in the same
+directory and renamed into place, so readers only ever see complete entries
+and concurrent writers of the same key simply replace each other's identical
+result. Reading an entry updates its modification time, and when the
+directory grows past its size limit the least recently used entries are
+removed first.
+
+`cached_run` uses a cache for tool results: the outputs of a run are
+published under a key derived from the tool, its options, the package
+version and the content of its inputs, and a later run with the same key
+copies them instead of recomputing. Entries are never linked to outputs,
+since the tools truncate and rewrite their outputs in place.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from gdc_rnaseq_tools import __version__
+from gdc_rnaseq_tools.utils import parse_size
+
+TMP_PREFIX = ".tmp-"
+# Temporary files older than this are left over from killed writers.
+STALE_SECONDS = 24 * 60 * 60
+
+
+def file_digest(path, digest=None, chunk_size=1 << 20):
+    """
+    Hash the content of a file.
+
+    :param path: file path
+    :param digest: optional ``hashlib`` object to update, otherwise SHA-256
+    :param chunk_size: number of bytes to read at a time
+    :return: the updated ``hashlib`` object
+    """
+    digest = digest or hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest
+
+
+class DiskCache:
+    """Directory of cache entries evicted least recently used first"""
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """
+        Returns the path of an entry.
+        """
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """
+        Returns the path of an entry and marks it as recently used, or None
+        if there is no such entry. Callers should treat a
+        ``FileNotFoundError`` when opening the path as a miss, since another
+        process may evict the entry in between.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, write):
+        """
+        Publish an entry atomically, then evict old entries if the cache is
+        over its size limit.
+
+        :param key: entry name
+        :param write: function writing the entry to the path it is given
+        :return: the path of the entry
+        """
+        fd, tmp = tempfile.mkstemp(prefix=TMP_PREFIX, dir=self.directory)
+        os.close(fd)
+        try:
+            write(tmp)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict()
+        return self.path(key)
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits its size
+        limit, and any stale temporary files.
+        """
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                if entry.name.startswith(TMP_PREFIX):
+                    if now - stat.st_mtime > STALE_SECONDS:
+                        os.remove(entry.path)
+                    continue
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+
+        if not self.max_size:
+            return
+        total = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def result_cache(args):
+    """
+    Opens the result cache requested with ``--cache-dir`` and
+    ``--cache-size``.
+
+    :param args: argparser
+    :return: `DiskCache`, or None if no cache directory is given
+    """
+    directory = getattr(args, "cache_dir", None)
+    if not directory:
+        return None
+    max_size = getattr(args, "cache_size", None)
+    return DiskCache(directory, parse_size(max_size) if max_size else None)
+
+
+def result_key(tool, options, inputs):
+    """
+    Cache key of a tool run.
+
+    :param tool: subcommand name
+    :param options: JSON serializable dict of the options that change the
+    outputs
+    :param inputs: paths of the input files, in the order they are used
+    :return: entry name
+    """
+    digest = hashlib.sha256()
+    digest.update(
+        json.dumps([tool, __version__, options], sort_keys=True).encode() + b"\n"
+    )
+    for path in inputs:
+        digest.update(file_digest(path).digest())
+    return "{0}-{1}".format(tool, digest.hexdigest())
+
+
+def copy_file(source, destination):
+    """
+    Copies a file to a new inode, so that writing to one never changes the
+    other. The destination is replaced atomically.
+
+    :param source: path of the existing file
+    :param destination: path to create or replace
+    """
+    fd, tmp = tempfile.mkstemp(
+        prefix=TMP_PREFIX, dir=os.path.dirname(os.path.abspath(destination))
+    )
+    os.close(fd)
+    try:
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, destination)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def result_entries(key, outputs):
+    """
+    Entry names of the outputs of a run: the key for the first output and
+    numbered keys for the others.
+    """
+    return [key] + ["{0}.{1}".format(key, i) for i in range(1, len(outputs))]
+
+
+def fetch_result(cache, key, outputs):
+    """
+    Copies the cached outputs of a run to their paths.
+
+    :param cache: `DiskCache`
+    :param key: entry name of the run, see `result_key`
+    :param outputs: paths of the files the run writes
+    :return: whether every output was found in the cache
+    """
+    paths = [cache.get(entry) for entry in result_entries(key, outputs)]
+    if all(paths):
+        try:
+            for path, output in zip(paths, outputs):
+                copy_file(path, output)
+            return True
+        except FileNotFoundError:
+            # evicted by another process in between
+            pass
+    return False
+
+
+def publish_result(cache, key, outputs):
+    """
+    Adds the outputs of a run to the cache.
+
+    :param cache: `DiskCache`
+    :param key: entry name of the run, see `result_key`
+    :param outputs: paths of the files the run wrote
+    """
+    for entry, output in zip(result_entries(key, outputs), outputs):
+        cache.put(entry, lambda tmp, output=output: copy_file(output, tmp))
+
+
+def cached_run(cache, key, outputs, run):
+    """
+    Serves the outputs of a run from the cache, or runs it and publishes its
+    outputs.
+
+    :param cache: `DiskCache`, or None to always run
+    :param key: entry name of the run, see `result_key`
+    :param outputs: paths of the files the run writes
+    :param run: function writing the outputs
+    :return: whether the outputs were served from the cache
+    """
+    if cache is not None and fetch_result(cache, key, outputs):
+        return True
+    run()
+    if cache is not None:
+        publish_result(cache, key, outputs)
+    return False
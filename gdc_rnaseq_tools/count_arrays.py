@@ -0,0 +1,142 @@
+"""NumPy engine for merging STAR gene counts files.
+
+Each ReadsPerGene file is parsed into a list of gene names and an int64 array
+of counts, aligned to a gene index shared by all inputs and summed with array
+operations. Gene order, including the leading ``N_`` summary rows, is the
+order genes are first seen, as in `gdc_rnaseq_tools.merge_counts`.
+"""
+
+import numpy as np
+
+from gdc_rnaseq_tools.junction_arrays import WRITE_ROWS, _format_rows, _parse_uints
+from gdc_rnaseq_tools.utils import DataFormatError, get_open_function, parallel_map
+
+TAB = ord("\t")
+NEWLINE = ord("\n")
+
+
+class GeneCounts:
+    """Gene names and a genes by columns array of counts"""
+
+    def __init__(self, genes, counts):
+        self.genes = genes
+        self.counts = counts
+
+    def __len__(self):
+        return len(self.genes)
+
+    @property
+    def width(self):
+        """
+        Number of count columns.
+        """
+        return self.counts.shape[1]
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Initialize from the raw bytes of a ReadsPerGene file.
+        :param data: bytes of whole lines
+        :raises DataFormatError: if lines have different numbers of columns or
+        a count cannot be parsed
+        """
+        data = data.replace(b"\r", b"")
+        if not data:
+            return cls([], np.empty((0, 0), dtype=np.int64))
+        if not data.endswith(b"\n"):
+            data += b"\n"
+        buf = np.frombuffer(data, dtype=np.uint8)
+        n_columns = data.count(b"\t", 0, data.index(b"\n")) + 1
+        separators = np.array([TAB] * (n_columns - 1) + [NEWLINE], dtype=np.uint8)
+        seps = np.flatnonzero((buf == TAB) | (buf == NEWLINE))
+        if (
+            n_columns < 2
+            or len(seps) % n_columns
+            or not (buf[seps].reshape(-1, n_columns) == separators).all()
+        ):
+            raise DataFormatError(
+                "Expected {0} columns in each gene counts line".format(n_columns)
+            )
+        starts = np.concatenate(([0], seps[:-1] + 1)).reshape(-1, n_columns)
+        ends = seps.reshape(-1, n_columns)
+
+        genes = [
+            data[start:end]
+            for start, end in zip(starts[:, 0].tolist(), ends[:, 0].tolist())
+        ]
+        counts = _parse_uints(buf, starts[:, 1:].ravel(), ends[:, 1:].ravel())
+        return cls(genes, counts.reshape(-1, n_columns - 1))
+
+    @classmethod
+    def from_file(cls, fil):
+        """
+        Initialize from a STAR ReadsPerGene file.
+        :param fil: path to STAR gene counts file
+        """
+        reader = get_open_function(fil)
+        with reader(fil, "rb") as fh:
+            return cls.from_bytes(fh.read())
+
+    def write(self, fh, rows=WRITE_ROWS):
+        """
+        Write the genes and counts as tab-separated lines.
+        :param fh: text file handle to write to
+        :param rows: number of rows to format at a time
+        """
+        for start in range(0, len(self), rows):
+            names = np.array(self.genes[start : start + rows])
+            counts = self.counts[start : start + rows]
+            columns = [counts[:, i] for i in range(self.width)]
+            fh.write(_format_rows(names, np.arange(len(names)), columns).decode())
+
+
+def merge_gene_counts(tables):
+    """
+    Sum gene counts tables on a shared gene index. Tables with the same gene
+    order as the index so far are added directly; others are aligned through
+    a dictionary of gene to row.
+    :param tables: list of `GeneCounts` with the same number of columns
+    :returns: merged `GeneCounts`
+    :raises DataFormatError: if the tables have different numbers of columns
+    """
+    genes = []
+    index = dict()
+    totals = None
+    for table in tables:
+        if not len(table):
+            continue
+        if totals is None:
+            totals = np.zeros((0, table.width), dtype=np.int64)
+        if table.width != totals.shape[1]:
+            raise DataFormatError(
+                "Gene counts files have {0} and {1} count columns".format(
+                    totals.shape[1], table.width
+                )
+            )
+        if table.genes == genes:
+            totals += table.counts
+            continue
+
+        rows = np.array(
+            [index.setdefault(gene, len(index)) for gene in table.genes],
+            dtype=np.int64,
+        )
+        genes = list(index)
+        if len(genes) > len(totals):
+            extra = np.zeros((len(genes) - len(totals), totals.shape[1]), np.int64)
+            totals = np.concatenate([totals, extra])
+        np.add.at(totals, rows, table.counts)
+
+    if totals is None:
+        totals = np.empty((0, 0), dtype=np.int64)
+    return GeneCounts(genes, totals)
+
+
+def merge_count_files(files, processes=1):
+    """
+    Load and merge STAR gene counts files with the NumPy engine.
+    :param files: list of paths to STAR gene counts files
+    :param processes: number of worker processes used to parse the files
+    :returns: merged `GeneCounts`
+    """
+    return merge_gene_counts(parallel_map(GeneCounts.from_file, files, processes))
@@ -0,0 +1,264 @@
+"""A gdc-rnaseq-tools subcommand to build a genes-by-samples raw counts
+matrix from the gene counts files of many samples.
+
+The matrix is an int64 ``.npy`` file in Fortran (column-major) order, so each
+sample's counts are one contiguous block on disk. Samples are read one at a
+time and written straight to their block, and new samples can be appended by
+growing the file and rewriting the shape in its header. Memory use does not
+grow with the number of samples. Load the matrix with
+``numpy.load(path, mmap_mode="r")`` or `load_counts_matrix`.
+
+Gene IDs, sample IDs and the counts column are kept in a JSON sidecar next
+to the matrix, see `index_path`.
+
+Inputs are parsed like `augment_star_counts.load_table`: comment lines are
+skipped, and tables with a ``gene_id`` header, such as augment_star_counts
+outputs, are read by column name while headerless STAR ReadsPerGene and
+merge_star_gene_counts outputs are read by position.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from gdc_rnaseq_tools.augment_star_counts import CountsColumns, load_table
+from gdc_rnaseq_tools.junction_matrix import load_inputs
+from gdc_rnaseq_tools.utils import (
+    DataError,
+    DataFormatError,
+    get_logger,
+    get_open_function,
+)
+
+DTYPE = np.dtype(np.int64)
+
+
+def index_path(output):
+    """
+    Path of the JSON sidecar holding the gene and sample IDs of a matrix.
+    """
+    return os.path.splitext(output)[0] + ".index.json"
+
+
+def has_header(fil):
+    """
+    Whether the first non-comment line of a table is a ``gene_id`` header.
+    """
+    reader = get_open_function(fil)
+    with reader(fil, "rt") as fh:
+        for line in fh:
+            if not line.startswith("#"):
+                return line.split("\t", 1)[0] == CountsColumns.GENE_ID.value
+    return False
+
+
+def read_sample_counts(fil, column=CountsColumns.UNSTRANDED.value):
+    """
+    Read the gene IDs and one counts column of a gene counts table.
+    :param fil: path to a STAR, merged or augmented gene counts file
+    :param column: name of the counts column
+    :returns: tuple of gene ID list and int64 array of counts
+    :raises DataFormatError: if the column is missing or not integer counts
+    """
+    if has_header(fil):
+        df = load_table(fil)
+    else:
+        df = load_table(fil, CountsColumns.cols())
+    if column not in df.columns or CountsColumns.GENE_ID.value not in df.columns:
+        raise DataFormatError("Column {0} not found in {1}".format(column, fil))
+    values = df[column]
+    if values.isna().any() or values.dtype.kind not in "iu":
+        raise DataFormatError(
+            "Column {0} of {1} does not hold integer counts".format(column, fil)
+        )
+    return df[CountsColumns.GENE_ID.value].tolist(), values.to_numpy(DTYPE)
+
+
+def write_header(fh, shape):
+    """
+    Write the ``.npy`` header of a Fortran-ordered int64 matrix. The header is
+    padded so that its length does not change as the sample axis grows.
+    :param fh: binary file handle positioned at the start of the file
+    :param shape: tuple of the number of genes and samples
+    :returns: offset of the matrix data
+    """
+    np.lib.format.write_array_header_1_0(
+        fh,
+        {
+            "descr": np.lib.format.dtype_to_descr(DTYPE),
+            "fortran_order": True,
+            "shape": tuple(shape),
+        },
+    )
+    return fh.tell()
+
+
+def read_header(fh):
+    """
+    Read the shape and data offset of a matrix written by `write_header`.
+    :param fh: binary file handle positioned at the start of the file
+    :returns: tuple of shape and data offset
+    :raises DataFormatError: if the file is not a Fortran-ordered int64 matrix
+    """
+    version = np.lib.format.read_magic(fh)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fh)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fh)
+    if dtype != DTYPE or not fortran_order or len(shape) != 2:
+        raise DataFormatError("Not a counts matrix written by build_counts_matrix")
+    return shape, fh.tell()
+
+
+def load_index(output):
+    """
+    Load the sidecar of a matrix.
+    :param output: path to the ``.npy`` matrix
+    :returns: dict with ``genes``, ``samples`` and ``column``
+    """
+    with open(index_path(output), "rt") as fh:
+        return json.load(fh)
+
+
+def save_index(output, index):
+    """
+    Write the sidecar of a matrix, replacing any previous one atomically.
+    """
+    path = index_path(output)
+    tmp = path + ".tmp"
+    with open(tmp, "wt") as o:
+        json.dump(index, o)
+    os.replace(tmp, path)
+
+
+def load_counts_matrix(output):
+    """
+    Memory-map a counts matrix.
+    :param output: path to the ``.npy`` matrix
+    :returns: tuple of the read-only genes by samples matrix and its sidecar
+    """
+    return np.load(output, mmap_mode="r"), load_index(output)
+
+
+def build_counts_matrix(
+    files,
+    samples,
+    output,
+    column=CountsColumns.UNSTRANDED.value,
+    append=False,
+    logger=None,
+):
+    """
+    Write the counts of each sample as a column of the matrix. The file is
+    preallocated for all samples, each column is written as soon as it is
+    read, and the header and sidecar are only updated once every sample has
+    been written, so a failed run leaves an existing matrix unchanged.
+    :param files: paths to gene counts files, one per sample
+    :param samples: sample ID of each file
+    :param output: path to the ``.npy`` matrix
+    :param column: name of the counts column to collect
+    :param append: whether to add the samples to an existing matrix
+    :param logger: optional `logging.Logger` instance
+    :returns: the updated sidecar dict
+    :raises DataError: if sample IDs repeat, a sample's genes differ from
+    the matrix genes or the column differs from that of an existing matrix
+    """
+    if append:
+        index = load_index(output)
+        if index["column"] != column:
+            raise DataError(
+                "Matrix {0} holds {1} counts, not {2}".format(
+                    output, index["column"], column
+                )
+            )
+    else:
+        index = {"genes": read_sample_counts(files[0], column)[0] if files else []}
+        index.update({"samples": [], "column": column})
+        with open(output, "wb") as o:
+            write_header(o, (len(index["genes"]), 0))
+
+    duplicated = set(index["samples"]).intersection(samples)
+    if duplicated or len(set(samples)) < len(samples):
+        raise DataError("Duplicated sample IDs {0}".format(sorted(duplicated)))
+
+    genes = index["genes"]
+    rows = {gene: i for i, gene in enumerate(genes)}
+    with open(output, "r+b") as fh:
+        shape, offset = read_header(fh)
+        if shape != (len(genes), len(index["samples"])):
+            raise DataFormatError("Matrix {0} does not match its index".format(output))
+        column_bytes = len(genes) * DTYPE.itemsize
+        start = offset + shape[1] * column_bytes
+        try:
+            fh.truncate(start + len(files) * column_bytes)
+            for i, fil in enumerate(files):
+                sample_genes, counts = read_sample_counts(fil, column)
+                if sample_genes != genes:
+                    counts = align_counts(sample_genes, counts, rows, fil)
+                fh.seek(start + i * column_bytes)
+                fh.write(counts.tobytes())
+                if logger and (i + 1) % 100 == 0:
+                    logger.info("Wrote {0} samples.".format(i + 1))
+        except BaseException:
+            fh.truncate(start)
+            raise
+
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.seek(0)
+        if write_header(fh, (len(genes), shape[1] + len(files))) != offset:
+            raise DataFormatError("Cannot grow the header of {0}".format(output))
+
+    index["samples"] = index["samples"] + list(samples)
+    save_index(output, index)
+    return index
+
+
+def align_counts(genes, counts, rows, fil):
+    """
+    Reorder a sample's counts to the gene order of the matrix.
+    :param genes: gene IDs of the sample
+    :param counts: counts of the sample
+    :param rows: dict of matrix gene ID to row
+    :param fil: path of the sample, for error messages
+    :returns: int64 array of counts in matrix gene order
+    :raises DataError: if the sample does not have exactly the matrix genes
+    """
+    if len(genes) != len(rows) or len(set(genes)) != len(genes):
+        raise DataError("Genes of {0} do not match the matrix genes".format(fil))
+    try:
+        order = np.array([rows[gene] for gene in genes], dtype=np.int64)
+    except KeyError as e:
+        raise DataError("Gene {0} of {1} is not in the matrix".format(e, fil))
+    aligned = np.empty(len(rows), dtype=DTYPE)
+    aligned[order] = counts
+    return aligned
+
+
+def main(args):
+    """
+    Main entrypoint for build_counts_matrix.
+    """
+    logger = get_logger("build_counts_matrix")
+    files, samples = load_inputs(args)
+    append = getattr(args, "append", False)
+    logger.info(
+        "{0} {1} samples to counts matrix {2}.".format(
+            "Appending" if append else "Writing", len(files), args.output
+        )
+    )
+
+    index = build_counts_matrix(
+        files,
+        samples,
+        args.output,
+        column=getattr(args, "column", None) or CountsColumns.UNSTRANDED.value,
+        append=append,
+        logger=logger,
+    )
+    logger.info(
+        "Matrix has {0} genes by {1} samples.".format(
+            len(index["genes"]), len(index["samples"])
+        )
+    )
@@ -0,0 +1,372 @@
+"""Columnar NumPy engine for merging STAR junction counts files.
+
+Junction files are parsed in chunks into typed arrays instead of one
+`StarJunctionRecord` per line. Records are grouped with a lexsort over the
+encoded keys and merged with vectorized reductions. The output is identical to
+the record-based merge in `gdc_rnaseq_tools.merge_junctions`.
+"""
+
+from functools import partial
+
+import numpy as np
+
+from gdc_rnaseq_tools.utils import DataFormatError, get_open_function, parallel_map
+
+N_COLUMNS = 9
+CHUNK_SIZE = 1 << 24
+WRITE_ROWS = 1 << 18
+MAX_DIGITS = 18
+
+TAB = ord("\t")
+NEWLINE = ord("\n")
+ZERO = ord("0")
+LINE_SEPARATORS = np.array([TAB] * (N_COLUMNS - 1) + [NEWLINE], dtype=np.uint8)
+
+
+class JunctionArrays:
+    """Columns of a STAR junction file held as typed arrays"""
+
+    def __init__(
+        self,
+        chromosomes,
+        chrom,
+        intron_first,
+        intron_last,
+        strand,
+        motif,
+        annotation,
+        n_unique_mapped,
+        n_multi_mapped,
+        max_splice_overhang,
+    ):
+        self.chromosomes = list(chromosomes)
+        self.chrom = np.asarray(chrom, dtype=np.int32)
+        self.intron_first = np.asarray(intron_first, dtype=np.int32)
+        self.intron_last = np.asarray(intron_last, dtype=np.int32)
+        self.strand = np.asarray(strand, dtype=np.int8)
+        self.motif = np.asarray(motif, dtype=np.int8)
+        self.annotation = np.asarray(annotation, dtype=np.int8)
+        self.n_unique_mapped = np.asarray(n_unique_mapped, dtype=np.int64)
+        self.n_multi_mapped = np.asarray(n_multi_mapped, dtype=np.int64)
+        self.max_splice_overhang = np.asarray(max_splice_overhang, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.chrom)
+
+    @classmethod
+    def empty(cls):
+        """
+        Initialize a table with no records.
+        """
+        return cls([], *[[] for _ in range(N_COLUMNS)])
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Initialize from the raw bytes of complete SJ.out.tab lines.
+        :param data: bytes containing whole lines
+        :raises DataFormatError: if a line does not have nine columns or a
+        numeric column cannot be parsed
+        """
+        data = data.replace(b"\r", b"")
+        if not data.endswith(b"\n"):
+            data += b"\n"
+        buf = np.frombuffer(data, dtype=np.uint8)
+        seps = np.flatnonzero((buf == TAB) | (buf == NEWLINE))
+        if (
+            len(seps) % N_COLUMNS
+            or not (buf[seps].reshape(-1, N_COLUMNS) == LINE_SEPARATORS).all()
+        ):
+            raise DataFormatError(
+                "Expected {0} columns in each junction line".format(N_COLUMNS)
+            )
+        starts = np.concatenate(([0], seps[:-1] + 1)).reshape(-1, N_COLUMNS)
+        ends = seps.reshape(-1, N_COLUMNS)
+
+        names, inverse = np.unique(
+            _gather_strings(buf, starts[:, 0], ends[:, 0]), return_inverse=True
+        )
+        values = _parse_uints(buf, starts[:, 1:].ravel(), ends[:, 1:].ravel())
+        values = values.reshape(-1, N_COLUMNS - 1)
+        return cls(
+            [name.decode() for name in names],
+            inverse.ravel(),
+            *[values[:, i] for i in range(N_COLUMNS - 1)],
+        )
+
+    @classmethod
+    def from_file(cls, fil, chunk_size=CHUNK_SIZE, filters=None):
+        """
+        Initialize from a STAR junction file, parsed in chunks of whole lines.
+        Leading comment lines, such as the header of merged files, are skipped.
+        :param fil: path to STAR junction file
+        :param chunk_size: number of bytes to read at a time
+        :param filters: optional `JunctionFilter` whose per-record filters are
+        applied to each chunk as it is parsed
+        """
+        parts = []
+        reader = get_open_function(fil)
+        with reader(fil, "rb") as fh:
+            rest = b""
+            in_header = True
+            while True:
+                block = fh.read(chunk_size)
+                if not block:
+                    break
+                block = rest + block
+                while in_header and block.startswith(b"#") and b"\n" in block:
+                    block = block[block.index(b"\n") + 1 :]
+                if in_header and (not block or block.startswith(b"#")):
+                    rest = block
+                    continue
+                in_header = False
+                end = block.rfind(b"\n") + 1
+                rest = block[end:]
+                if end:
+                    parts.append(cls.from_bytes(block[:end]).select(filters))
+            if rest and not rest.startswith(b"#"):
+                parts.append(cls.from_bytes(rest).select(filters))
+        return cls.concatenate(parts)
+
+    @classmethod
+    def concatenate(cls, tables):
+        """
+        Concatenate tables in order, re-encoding chromosome codes.
+        :param tables: list of `JunctionArrays`
+        """
+        chromosomes = []
+        codes = dict()
+        chrom = []
+        for table in tables:
+            mapping = np.empty(len(table.chromosomes), dtype=np.int32)
+            for i, name in enumerate(table.chromosomes):
+                if name not in codes:
+                    codes[name] = len(chromosomes)
+                    chromosomes.append(name)
+                mapping[i] = codes[name]
+            chrom.append(mapping[table.chrom])
+        if not tables:
+            return cls.empty()
+        return cls(
+            chromosomes,
+            np.concatenate(chrom),
+            *[
+                np.concatenate([getattr(table, name) for table in tables])
+                for name in cls.value_columns()
+            ],
+        )
+
+    @staticmethod
+    def value_columns():
+        """
+        Names of the array attributes after the chromosome column.
+        """
+        return [
+            "intron_first",
+            "intron_last",
+            "strand",
+            "motif",
+            "annotation",
+            "n_unique_mapped",
+            "n_multi_mapped",
+            "max_splice_overhang",
+        ]
+
+    def chrom_ranks(self, chrom_order=None):
+        """
+        Returns the sort rank of each chromosome code. Without a chromosome
+        order chromosomes sort by name. With one, chromosomes sort by rank
+        and those missing from the order sort by name after all ranked ones.
+        :param chrom_order: optional dict of chromosome to rank
+        """
+        chrom_order = chrom_order or {}
+        default = len(chrom_order)
+        order = sorted(
+            range(len(self.chromosomes)),
+            key=lambda i: (
+                chrom_order.get(self.chromosomes[i], default),
+                self.chromosomes[i],
+            ),
+        )
+        ranks = np.empty(len(self.chromosomes), dtype=np.int32)
+        ranks[order] = np.arange(len(self.chromosomes), dtype=np.int32)
+        return ranks
+
+    def take(self, index):
+        """
+        Returns a new table with the rows at `index`.
+        """
+        return JunctionArrays(
+            self.chromosomes,
+            self.chrom[index],
+            *[getattr(self, name)[index] for name in self.value_columns()],
+        )
+
+    def select(self, filters=None):
+        """
+        Returns the rows passing the per-record filters of a `JunctionFilter`.
+        """
+        if filters is None:
+            return self
+        keep = np.array(
+            [filters.keep_chromosome(name) for name in self.chromosomes], dtype=bool
+        )[self.chrom]
+        if filters.canonical_only:
+            keep &= self.motif != 0
+        if filters.annotation is not None:
+            keep &= self.annotation == filters.annotation
+        return self if keep.all() else self.take(np.flatnonzero(keep))
+
+    def merge(self, chrom_ranks=None):
+        """
+        Sum records that share a key and sort the result by chromosome, intron
+        start and intron end. Records at the same position are kept in the
+        order their key was first seen, and the max splice overhang is kept.
+        :param chrom_ranks: optional dict of chromosome to rank
+        :returns: merged `JunctionArrays`
+        """
+        if not len(self):
+            return self
+        rank = self.chrom_ranks(chrom_ranks)[self.chrom]
+        # encode the six key columns into three sortable integer keys
+        position = (rank.astype(np.int64) << 32) | self.intron_first.astype(np.int64)
+        flags = (
+            (self.strand.astype(np.int32) << 16)
+            | (self.motif.astype(np.int32) << 8)
+            | self.annotation.astype(np.int32)
+        )
+        keys = (position, self.intron_last, flags)
+        order = np.lexsort(keys[::-1])
+        same = np.ones(len(order) - 1, dtype=bool)
+        for col in keys:
+            ordered = col[order]
+            same &= ordered[1:] == ordered[:-1]
+        starts = np.flatnonzero(np.concatenate(([True], ~same)))
+
+        # lexsort is stable so the first row of each group is its first
+        # appearance in the inputs
+        first_seen = order[starts]
+        merged = self.take(first_seen)
+        merged.n_unique_mapped = np.add.reduceat(self.n_unique_mapped[order], starts)
+        merged.n_multi_mapped = np.add.reduceat(self.n_multi_mapped[order], starts)
+        merged.max_splice_overhang = np.maximum.reduceat(
+            self.max_splice_overhang[order], starts
+        )
+
+        output_order = np.lexsort(
+            (first_seen, merged.intron_last, merged.intron_first, rank[first_seen])
+        )
+        return merged.take(output_order)
+
+    def write(self, fh, rows=WRITE_ROWS):
+        """
+        Write the records as SJ.out.tab lines.
+        :param fh: text file handle to write to
+        :param rows: number of rows to format at a time
+        """
+        names = np.array([name.encode() for name in self.chromosomes])
+        for start in range(0, len(self), rows):
+            stop = start + rows
+            columns = [getattr(self, name)[start:stop] for name in self.value_columns()]
+            fh.write(_format_rows(names, self.chrom[start:stop], columns).decode())
+
+
+def _gather_strings(buf, starts, ends):
+    """
+    Copy variable-length fields out of a byte buffer into a fixed-width
+    bytes array.
+    :param buf: uint8 array
+    :param starts: offset of the first byte of each field
+    :param ends: offset one past the last byte of each field
+    :returns: numpy bytes array
+    """
+    lengths = ends - starts
+    width = max(int(lengths.max()), 1) if len(lengths) else 1
+    offsets = np.arange(width)
+    idx = np.minimum(starts[:, None] + offsets, len(buf) - 1)
+    chars = np.where(offsets < lengths[:, None], buf[idx], 0).astype(np.uint8)
+    return chars.view("S{0}".format(width)).ravel()
+
+
+def _parse_uints(buf, starts, ends):
+    """
+    Parse unsigned decimal integer fields out of a byte buffer.
+    :param buf: uint8 array
+    :param starts: offset of the first byte of each field
+    :param ends: offset one past the last byte of each field
+    :returns: int64 array of values
+    :raises DataFormatError: if a field is empty, too long or not a number
+    """
+    lengths = ends - starts
+    if len(lengths) and (lengths.min() < 1 or lengths.max() > MAX_DIGITS):
+        raise DataFormatError("Invalid integer field in junction columns")
+    values = np.zeros(len(starts), dtype=np.int64)
+    for i in range(int(lengths.max()) if len(lengths) else 0):
+        sel = lengths > i
+        digits = buf[starts[sel] + i].astype(np.int64) - ZERO
+        if ((digits < 0) | (digits > 9)).any():
+            raise DataFormatError("Non-integer value in junction columns")
+        values[sel] = values[sel] * 10 + digits
+    return values
+
+
+def _format_rows(names, chrom, columns):
+    """
+    Format rows of a chromosome column followed by unsigned integer columns as
+    tab-separated lines.
+    :param names: numpy bytes array of chromosome names
+    :param chrom: chromosome code of each row
+    :param columns: list of non-negative integer arrays
+    :returns: bytes of the formatted lines
+    """
+    name_lengths = np.char.str_len(names)[chrom]
+    widths = [_count_digits(col) for col in columns]
+    line_lengths = name_lengths + sum(widths) + len(columns) + 1
+    line_starts = np.cumsum(line_lengths) - line_lengths
+    out = np.full(int(line_lengths.sum()), TAB, dtype=np.uint8)
+
+    name_chars = np.frombuffer(names.tobytes(), dtype=np.uint8).reshape(len(names), -1)
+    for i in range(name_chars.shape[1]):
+        sel = name_lengths > i
+        out[line_starts[sel] + i] = name_chars[chrom[sel], i]
+
+    offsets = line_starts + name_lengths + 1
+    for col, width in zip(columns, widths):
+        col = col.astype(np.int64)
+        for i in range(int(width.max()) if len(width) else 0):
+            sel = width > i
+            out[offsets[sel] + width[sel] - 1 - i] = ZERO + (col[sel] // 10**i) % 10
+        offsets = offsets + width + 1
+    out[line_starts + line_lengths - 1] = NEWLINE
+    return out.tobytes()
+
+
+def _count_digits(values):
+    """
+    Returns the number of decimal digits in each non-negative integer.
+    """
+    widths = np.ones(len(values), dtype=np.int64)
+    for i in range(1, MAX_DIGITS):
+        widths += values >= 10**i
+    return widths
+
+
+def merge_junction_files(files, processes=1, chrom_ranks=None, filters=None):
+    """
+    Load and merge STAR junction files with the columnar engine.
+    :param files: list of paths to STAR junction files
+    :param processes: number of worker processes used to parse the files
+    :param chrom_ranks: optional dict of chromosome to rank
+    :param filters: optional `JunctionFilter`. The minimum unique reads is
+    applied to the merged totals.
+    :returns: merged `JunctionArrays`
+    """
+    load = partial(JunctionArrays.from_file, filters=filters)
+    merged = JunctionArrays.concatenate(parallel_map(load, files, processes)).merge(
+        chrom_ranks
+    )
+    if filters is not None and filters.min_unique:
+        merged = merged.take(
+            np.flatnonzero(merged.n_unique_mapped >= filters.min_unique)
+        )
+    return merged
@@ -0,0 +1,254 @@
+"""A gdc-rnaseq-tools subcommand to build a sparse junction-by-sample matrix
+from the merged STAR junction counts files of many samples.
+
+Each junction key (chromosome, intron start, intron end, strand, intron motif
+and annotation) gets an integer ID the first time it is seen, so adding
+samples never changes existing IDs. Counts are stored as a compressed sparse
+column (CSC) matrix with one column per sample. Samples are read one at a
+time and their nonzero entries are streamed to temporary files, so memory is
+bounded by the junction catalog rather than the number of samples.
+
+The output is a NumPy ``.npz`` archive with:
+
+* ``format``, ``shape``, ``indptr``, ``indices``: the CSC structure, usable
+  as ``scipy.sparse.csc_matrix((n_unique_map, indices, indptr), shape)``
+* ``n_unique_map`` and optionally ``n_multi_map``: the nonzero values
+* ``samples``: the sample ID of each column
+* ``chromosomes`` and ``chromosome``: chromosome names and the index of each
+  junction's chromosome
+* ``intron_start``, ``intron_end``, ``strand``, ``intron_motif``,
+  ``annotation``: the key columns of each junction
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+from gdc_rnaseq_tools.junction_arrays import JunctionArrays
+from gdc_rnaseq_tools.utils import get_logger
+
+KEY_DTYPE = np.dtype("V16")
+
+
+class JunctionCatalog:
+    """Assigns an integer ID to each junction key in order of first appearance"""
+
+    def __init__(self):
+        self.chromosomes = []
+        self.chrom_codes = dict()
+        self.sorted_keys = np.empty(0, dtype=KEY_DTYPE)
+        self.sorted_ids = np.empty(0, dtype=np.int64)
+        self.junctions = []
+
+    def __len__(self):
+        return len(self.sorted_ids)
+
+    def encode(self, table):
+        """
+        Encode the keys of a table into sortable 16-byte values using global
+        chromosome codes.
+        :param table: `JunctionArrays`
+        :returns: numpy array of `KEY_DTYPE`
+        """
+        mapping = np.empty(len(table.chromosomes), dtype=np.int64)
+        for i, name in enumerate(table.chromosomes):
+            if name not in self.chrom_codes:
+                self.chrom_codes[name] = len(self.chromosomes)
+                self.chromosomes.append(name)
+            mapping[i] = self.chrom_codes[name]
+
+        # big-endian so that byte order matches numeric order
+        words = np.empty((len(table), 2), dtype=">i8")
+        words[:, 0] = (mapping[table.chrom] << 32) | table.intron_first
+        words[:, 1] = (
+            (table.intron_last.astype(np.int64) << 24)
+            | (table.strand.astype(np.int64) << 16)
+            | (table.motif.astype(np.int64) << 8)
+            | table.annotation.astype(np.int64)
+        )
+        return words.view(KEY_DTYPE).ravel()
+
+    def lookup(self, table):
+        """
+        Returns the ID of each record's key, adding keys not seen before.
+        :param table: `JunctionArrays`
+        :returns: int64 array of junction IDs
+        """
+        keys = self.encode(table)
+        pos = np.searchsorted(self.sorted_keys, keys)
+        found = pos < len(self.sorted_keys)
+        found[found] = self.sorted_keys[pos[found]] == keys[found]
+        ids = np.empty(len(keys), dtype=np.int64)
+        ids[found] = self.sorted_ids[pos[found]]
+
+        new = np.flatnonzero(~found)
+        if len(new):
+            new_keys, first, inverse = np.unique(
+                keys[new], return_index=True, return_inverse=True
+            )
+            # number new keys in the order they appear in the table
+            rank = np.empty(len(first), dtype=np.int64)
+            rank[np.argsort(first, kind="stable")] = np.arange(len(first))
+            new_ids = len(self) + rank
+            ids[new] = new_ids[inverse.ravel()]
+
+            self.junctions.append(table.take(new[np.sort(first)]))
+            at = np.searchsorted(self.sorted_keys, new_keys)
+            self.sorted_keys = np.insert(self.sorted_keys, at, new_keys)
+            self.sorted_ids = np.insert(self.sorted_ids, at, new_ids)
+        return ids
+
+    def columns(self):
+        """
+        Returns the key columns of all junctions in ID order.
+        :returns: dict of column name to array
+        """
+        table = JunctionArrays.concatenate(self.junctions)
+        mapping = np.array(
+            [self.chrom_codes[name] for name in table.chromosomes], dtype=np.int32
+        )
+        return {
+            "chromosome": mapping[table.chrom],
+            "intron_start": table.intron_first,
+            "intron_end": table.intron_last,
+            "strand": table.strand,
+            "intron_motif": table.motif,
+            "annotation": table.annotation,
+        }
+
+
+def sample_columns(ids, table, multi=False):
+    """
+    Sort a sample's entries by junction ID, summing any repeated keys.
+    :param ids: junction ID of each record
+    :param table: `JunctionArrays` of the sample
+    :param multi: whether to also return multi-mapped counts
+    :returns: tuple of sorted IDs, unique counts and multi counts or None
+    """
+    if not len(ids):
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, empty if multi else None
+    order = np.argsort(ids, kind="stable")
+    ids = ids[order]
+    starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+    n_unique = np.add.reduceat(table.n_unique_mapped[order], starts)
+    n_multi = None
+    if multi:
+        n_multi = np.add.reduceat(table.n_multi_mapped[order], starts)
+    return ids[starts], n_unique, n_multi
+
+
+def build_junction_matrix(
+    files, samples, output, multi=False, tmp_dir=None, logger=None
+):
+    """
+    Build the sparse junction-by-sample matrix and save it as ``.npz``.
+    :param files: paths to merged STAR junction counts files, one per sample
+    :param samples: sample ID of each file
+    :param output: path to the ``.npz`` output
+    :param multi: whether to also store multi-mapped counts
+    :param tmp_dir: optional parent directory for temporary files
+    :param logger: optional `logging.Logger` instance
+    :returns: `JunctionCatalog`
+    """
+    catalog = JunctionCatalog()
+    indptr = [0]
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        names = ["indices", "n_unique_map"] + (["n_multi_map"] if multi else [])
+        handles = {name: open(os.path.join(tmp, name), "wb") for name in names}
+        try:
+            for i, fil in enumerate(files):
+                table = JunctionArrays.from_file(fil)
+                ids, n_unique, n_multi = sample_columns(
+                    catalog.lookup(table), table, multi
+                )
+                handles["indices"].write(ids.astype(np.int64).tobytes())
+                handles["n_unique_map"].write(n_unique.astype(np.int64).tobytes())
+                if multi:
+                    handles["n_multi_map"].write(n_multi.astype(np.int64).tobytes())
+                indptr.append(indptr[-1] + len(ids))
+                if logger and (i + 1) % 100 == 0:
+                    logger.info(
+                        "Loaded {0} samples, {1} junctions.".format(i + 1, len(catalog))
+                    )
+        finally:
+            for handle in handles.values():
+                handle.close()
+
+        arrays = {
+            name: (
+                np.memmap(os.path.join(tmp, name), dtype=np.int64, mode="r")
+                if indptr[-1]
+                else np.empty(0, dtype=np.int64)
+            )
+            for name in names
+        }
+        arrays.update(catalog.columns())
+        np.savez_compressed(
+            output,
+            format=np.array("csc"),
+            shape=np.array([len(catalog), len(files)], dtype=np.int64),
+            indptr=np.array(indptr, dtype=np.int64),
+            samples=np.array(samples, dtype=str),
+            chromosomes=np.array(catalog.chromosomes, dtype=str),
+            **arrays,
+        )
+        del arrays
+    return catalog
+
+
+def sample_id(fil):
+    """
+    Default sample ID of a file: its base name without compression and table
+    extensions.
+    """
+    name = os.path.basename(fil)
+    for ext in [".gz", ".tsv", ".tab", ".txt"]:
+        if name.endswith(ext):
+            name = name[: -len(ext)]
+    return name
+
+
+def load_inputs(args):
+    """
+    Collect input files and sample IDs from `args.input` and
+    `args.input_list`. Each line of the list holds a path and optionally a
+    tab-separated sample ID.
+    :param args: argparser
+    :returns: tuple of file list and sample ID list
+    """
+    files = list(getattr(args, "input", None) or [])
+    samples = [sample_id(fil) for fil in files]
+    if getattr(args, "input_list", None):
+        with open(args.input_list, "rt") as fh:
+            for line in fh:
+                cols = line.rstrip("\r\n").split("\t")
+                if not cols[0] or cols[0].startswith("#"):
+                    continue
+                files.append(cols[0])
+                samples.append(cols[1] if len(cols) > 1 else sample_id(cols[0]))
+    return files, samples
+
+
+def main(args):
+    """
+    Main entrypoint for build_junction_matrix.
+    """
+    logger = get_logger("build_junction_matrix")
+    files, samples = load_inputs(args)
+    logger.info("Building junction matrix from {0} samples.".format(len(files)))
+
+    catalog = build_junction_matrix(
+        files,
+        samples,
+        args.output,
+        multi=getattr(args, "multi", False),
+        tmp_dir=getattr(args, "tmp_dir", None),
+        logger=logger,
+    )
+    logger.info(
+        "Wrote {0} junctions by {1} samples to {2}.".format(
+            len(catalog), len(files), args.output
+        )
+    )
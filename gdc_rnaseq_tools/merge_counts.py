@@ -4,9 +4,22 @@ files from the same sample.
 @author: Kyle Hernandez <kmhernan@uchicago.edu>
 """
 
+import hashlib
 from collections import OrderedDict
+from contextlib import ExitStack, closing
+from itertools import chain, zip_longest
 
-from gdc_rnaseq_tools.utils import get_logger, get_open_function
+from gdc_rnaseq_tools.cache import cached_run, result_cache, result_key
+from gdc_rnaseq_tools.utils import (
+    DataFormatError,
+    GeneOrderError,
+    copy_with_header,
+    get_logger,
+    get_open_function,
+    iter_star_counts,
+    parallel_map,
+    tree_reduce,
+)
 
 COLUMN_NAMES = ["gene", "unstranded", "stranded_first", "stranded_second"]
 
@@ -17,40 +30,116 @@ def process_files(args, logger):
     :param args: argparser
     :param logger: `logging.Logger` instance
     """
-    writer = get_open_function(args.output)
     logger.info("Writing outputs to {0}".format(args.output))
+    if len(args.input) == 1:
+        logger.info(
+            "Only 1 STAR gene counts file provided. "
+            + "A new STAR gene counts file will be produced "
+            + "with a header line."
+        )
+        logger.info("Writing formatted STAR gene counts to {0}.".format(args.output))
+        copy_with_header(
+            args.input[0], args.output, "#" + "\t".join(COLUMN_NAMES) + "\n"
+        )
+        return
 
-    with writer(args.output, "wt") as o:
-        # Write header row as comment
-        o.write("#" + "\t".join(COLUMN_NAMES) + "\n")
-        if len(args.input) > 1:
-            logger.info("Merging {0} STAR gene counts files.".format(len(args.input)))
-            # Load
-            dic = OrderedDict()
-            for fil in args.input:
-                dic = load_star_file(fil, dic)
-
-            logger.info("Writing merged STAR gene counts to {0}.".format(args.output))
-            # Merge and write
-            for gene, counts in merge_star_counts(dic):
-                row = [gene] + [str(i) for i in counts]
-                o.write("\t".join(row) + "\n")
-
-        else:
+    processes = getattr(args, "processes", 1)
+    if getattr(args, "engine", "python") == "numpy" and getattr(args, "fan_in", None):
+        raise ValueError("--fan-in is not supported by the numpy engine")
+    if getattr(args, "stream", False):
+        fingerprints = parallel_map(gene_order_fingerprint, args.input, processes)
+        if len(set(fingerprints)) == 1:
             logger.info(
-                "Only 1 STAR gene counts file provided. "
-                + "A new STAR gene counts file will be produced "
-                + "with a header line."
+                "Lockstep merge of {0} STAR gene counts files with the same "
+                "gene order.".format(len(args.input))
             )
-            logger.info(
-                "Writing formatted STAR gene counts to {0}.".format(args.output)
+            try:
+                rows = lockstep_merge_counts(args.input)
+                first = next(rows, None)
+                width = len(first[1]) if first else len(COLUMN_NAMES) - 1
+                write_merged_counts(
+                    args.output, chain([first] if first else [], rows), width
+                )
+                return
+            except GeneOrderError as e:
+                logger.warning(
+                    "{0}. Falling back to the keyed merge.".format(e.message)
+                )
+        else:
+            logger.warning(
+                "Gene order differs between inputs. Falling back to the keyed merge."
             )
 
-            fil = args.input[0]
-            reader = get_open_function(fil)
-            with reader(fil, "rt") as fh:
-                for line in fh:
-                    o.write(line)
+    logger.info("Merging {0} STAR gene counts files.".format(len(args.input)))
+    if getattr(args, "engine", "python") == "numpy":
+        # Imported here so the default engine starts without loading numpy
+        from gdc_rnaseq_tools.count_arrays import merge_count_files
+
+        merged = merge_count_files(args.input, processes=processes)
+        width = merged.width
+    elif getattr(args, "fan_in", None):
+        merged = reduce_star_files(args.input, processes, args.fan_in)
+        width = len(next(iter(merged.values()))) if merged else len(COLUMN_NAMES) - 1
+    else:
+        # Load
+        dic = load_star_files(args.input, processes=processes)
+        width = len(next(iter(dic.values()))[0]) if dic else len(COLUMN_NAMES) - 1
+
+    logger.info("Writing merged STAR gene counts to {0}.".format(args.output))
+    if getattr(args, "engine", "python") == "numpy":
+        writer = get_open_function(args.output)
+        with writer(args.output, "wt") as o:
+            o.write("#" + "\t".join(header_columns(width)) + "\n")
+            merged.write(o)
+    elif getattr(args, "fan_in", None):
+        write_merged_counts(args.output, merged.items(), width)
+    else:
+        # Merge and write
+        write_merged_counts(args.output, merge_star_counts(dic), width)
+
+
+def write_merged_counts(output, rows, width):
+    """
+    Write merged gene counts with a header row.
+    :param output: path to the output file
+    :param rows: iterable of gene and list of counts
+    :param width: number of count columns
+    """
+    writer = get_open_function(output)
+    with writer(output, "wt") as o:
+        # Write header row as comment
+        o.write("#" + "\t".join(header_columns(width)) + "\n")
+        for gene, counts in rows:
+            row = [gene] + [str(i) for i in counts]
+            o.write("\t".join(row) + "\n")
+
+
+def header_columns(width):
+    """
+    Column names of a gene counts file with `width` count columns. Columns
+    after the three STAR strandedness columns are numbered.
+    :param width: number of count columns
+    :returns: list of column names
+    """
+    return COLUMN_NAMES[: width + 1] + [
+        "count_{0}".format(i) for i in range(len(COLUMN_NAMES), width + 1)
+    ]
+
+
+def check_width(width, counts):
+    """
+    Check that a row of counts has the number of count columns of the rows
+    merged so far, like the numpy engine does.
+    :param width: number of count columns of the rows merged so far
+    :param counts: list of counts
+    :raises DataFormatError: if the numbers of columns differ
+    """
+    if len(counts) != width:
+        raise DataFormatError(
+            "Gene counts files have {0} and {1} count columns".format(
+                width, len(counts)
+            )
+        )
 
 
 def load_star_file(fil, dic):
@@ -59,31 +148,165 @@ def load_star_file(fil, dic):
     :param fil: path to STAR counts file to load
     :param dic: ``OrderedDict`` to load file to
     :returns: updated ``OrderedDict``
+    :raises DataFormatError: if the file is not a STAR counts file
+    :raises DataError: if the file is truncated
     """
-    reader = get_open_function(fil)
-    with reader(fil, "rt") as fh:
-        for line in fh:
-            cols = line.rstrip("\r\n").split("\t")
-            key = cols[0]
+    for key, counts in iter_star_counts(fil):
+        if key not in dic:
+            dic[key] = []
+        dic[key].append(counts)
+    return dic
+
+
+def load_star_partial(fil):
+    """
+    Load a single star counts file into a new dictionary.
+    :param fil: path to STAR counts file to load
+    :returns: ``OrderedDict`` of gene to list of counts
+    """
+    return load_star_file(fil, OrderedDict())
+
+
+def load_star_files(files, processes=1):
+    """
+    Load star counts files into one dictionary. With more than one process
+    the files are parsed in worker processes and the partial dictionaries are
+    combined in input order, so the result does not depend on `processes`.
+    :param files: paths to STAR counts files to load
+    :param processes: number of worker processes
+    :returns: ``OrderedDict`` of gene to list of counts
+    """
+    dic = OrderedDict()
+    if not processes or processes < 2:
+        for fil in files:
+            dic = load_star_file(fil, dic)
+        return dic
+
+    for part in parallel_map(load_star_partial, files, processes):
+        for key, counts in part.items():
             if key not in dic:
                 dic[key] = []
-            counts = list(map(int, cols[1:]))
-            dic[key].append(counts)
+            dic[key].extend(counts)
     return dic
 
 
+def load_star_group(files):
+    """
+    Load and merge a group of star counts files, one file at a time.
+    :param files: paths to STAR counts files to load
+    :returns: dict of gene to list of summed counts
+    """
+    dic = OrderedDict()
+    for fil in files:
+        dic = load_star_file(fil, dic)
+    return dict(merge_star_counts(dic))
+
+
+def merge_star_partials(parts):
+    """
+    Merge the results of `load_star_group` in order, keeping the order genes
+    were first seen.
+    :param parts: list of dicts of gene to summed counts
+    :returns: merged dict
+    :raises DataFormatError: if the parts have different numbers of columns
+    """
+    merged = parts[0]
+    width = len(next(iter(merged.values()))) if merged else None
+    for part in parts[1:]:
+        if not part:
+            continue
+        if width is None:
+            width = len(next(iter(part.values())))
+        check_width(width, next(iter(part.values())))
+        for key, counts in part.items():
+            if key not in merged:
+                merged[key] = counts
+            else:
+                merged[key] = [a + b for a, b in zip(merged[key], counts)]
+    return merged
+
+
+def reduce_star_files(files, processes=1, fan_in=8):
+    """
+    Load and merge star counts files with a tree reduction: groups of
+    `fan_in` files are merged in worker processes and the partial results
+    are merged `fan_in` at a time until one remains. Each worker reads one
+    file at a time, so at most `processes` inputs are open at once. The
+    result is the same as `merge_star_counts` on `load_star_files`.
+    :param files: paths to STAR counts files to load
+    :param processes: number of worker processes
+    :param fan_in: number of files or partial results merged per group
+    :returns: dict of gene to list of merged counts
+    """
+    return tree_reduce(
+        load_star_group,
+        merge_star_partials,
+        files,
+        processes=processes,
+        fan_in=fan_in,
+    )
+
+
+def gene_order_fingerprint(fil):
+    """
+    Hash of the gene ID column of a star counts file. Files with the same
+    fingerprint list the same genes in the same order.
+    :param fil: path to STAR counts file
+    :returns: hex digest
+    """
+    digest = hashlib.sha1()
+    reader = get_open_function(fil)
+    with reader(fil, "rb") as fh:
+        for line in fh:
+            digest.update(line.split(b"\t", 1)[0].rstrip(b"\r\n") + b"\n")
+    return digest.hexdigest()
+
+
+def lockstep_merge_counts(files):
+    """
+    Generator of merged star records from files that list the same genes in
+    the same order. The files are read together one line at a time, so memory
+    does not depend on the number of genes.
+    :param files: paths to STAR counts files
+    :return: the gene key and list of merged counts
+    :raises GeneOrderError: if the files do not list the same genes in the
+    same order
+    :raises DataFormatError: if the files have different numbers of columns
+    """
+    with ExitStack() as stack:
+        readers = [stack.enter_context(closing(iter_star_counts(fil))) for fil in files]
+        for rows in zip_longest(*readers):
+            if None in rows:
+                raise GeneOrderError(
+                    "Gene counts files have different numbers of genes"
+                )
+            gene = rows[0][0]
+            width = len(rows[0][1])
+            for fil, row in zip(files, rows):
+                check_width(width, row[1])
+                if row[0] != gene:
+                    raise GeneOrderError(
+                        "Expected gene {0} but found {1} in {2}".format(
+                            gene, row[0], fil
+                        )
+                    )
+            yield gene, [sum(col) for col in zip(*[row[1] for row in rows])]
+
+
 def merge_star_counts(dic):
     """
     Generator of merged star records from the ordered dic.
     :param dic: ``OrderedDict`` of counts
     :return: the gene key and list of merged counts
+    :raises DataFormatError: if rows have different numbers of columns
     """
-    for key in dic:
-        counts = [0 for i in range(3)]
-        for rec in dic[key]:
-            for i, v in enumerate(rec):
-                counts[i] += v
-        yield key, counts
+    width = None
+    for key, rows in dic.items():
+        if width is None:
+            width = len(rows[0])
+        for counts in rows:
+            check_width(width, counts)
+        yield key, [sum(col) for col in zip(*rows)]
 
 
 def main(args):
@@ -95,4 +318,10 @@ def main(args):
         "Merging/Formatting {0} STAR gene counts files.".format(len(args.input))
     )
 
-    process_files(args, logger)
+    cache = result_cache(args)
+    key = None
+    if cache is not None:
+        options = {"gzip": args.output.endswith(".gz")}
+        key = result_key("merge_star_gene_counts", options, args.input)
+    if cached_run(cache, key, [args.output], lambda: process_files(args, logger)):
+        logger.info("Served {0} from the result cache.".format(args.output))
@@ -4,9 +4,27 @@ files from the same sample.
 @author: Kyle Hernandez <kmhernan@uchicago.edu>
 """
 
+import heapq
+import os
+import tempfile
+from fnmatch import fnmatchcase
+from functools import partial
 from operator import itemgetter
 
-from gdc_rnaseq_tools.utils import get_logger, get_open_function
+from gdc_rnaseq_tools.cache import cached_run, result_cache, result_key
+from gdc_rnaseq_tools.tabix import TabixWriter
+from gdc_rnaseq_tools.utils import (
+    UnsortedInputError,
+    copy_with_header,
+    get_logger,
+    get_open_function,
+    gzip_settings,
+    iter_star_junctions,
+    load_chrom_order,
+    parallel_map,
+    parse_size,
+    tree_reduce,
+)
 
 COLUMN_NAMES = [
     "chromosome",
@@ -20,6 +38,15 @@ COLUMN_NAMES = [
     "max_splice_overhang",
 ]
 
+ANNOTATION_STATUS = {"unannotated": 0, "annotated": 1}
+
+# Rough size of a loaded record and its dictionary entry, used to turn a
+# memory budget into a number of records held before spilling a sorted run.
+RECORD_BYTES = 512
+
+# Default number of sorted runs open at once while merging spilled runs.
+RUN_FAN_IN = 16
+
 
 class StarJunctionRecord:
     """Represents a row in the SJ file"""
@@ -68,6 +95,26 @@ class StarJunctionRecord:
         """
         return cls(*line.rstrip("\r\n").split("\t"))
 
+    @classmethod
+    def from_columns(cls, cols):
+        """
+        Initialize record from the parsed columns of a line, as returned by
+        `utils.iter_star_junctions`, without converting them again.
+        """
+        rec = cls.__new__(cls)
+        (
+            rec.chromosome,
+            rec.intron_first,
+            rec.intron_last,
+            rec.strand,
+            rec.motif,
+            rec.annotation,
+            rec.n_unique_mapped,
+            rec.n_multi_mapped,
+            rec.max_splice_overhang,
+        ) = cols
+        return rec
+
     def __iadd__(self, other):
         """
         Used to merge overlapping records by adding the appropriate columns and
@@ -101,68 +148,605 @@ class StarJunctionRecord:
         )
 
 
+class JunctionFilter:
+    """
+    Filters on STAR junction records. The chromosome, motif and annotation
+    filters are checked on the columns of each line while parsing, so dropped
+    records are never loaded. The minimum number of unique reads applies to
+    the merged totals and is checked on merged records.
+    """
+
+    def __init__(
+        self, min_unique=0, annotation=None, canonical_only=False, exclude_contigs=None
+    ):
+        self.min_unique = min_unique or 0
+        self.annotation = (
+            ANNOTATION_STATUS[annotation] if annotation is not None else None
+        )
+        self.canonical_only = canonical_only
+        self.exclude_contigs = list(exclude_contigs or [])
+        self.chromosomes = dict()
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Initialize from the merge_star_junctions arguments.
+        :param args: argparser
+        :returns: `JunctionFilter`, or None if no filter is set
+        """
+        filters = cls(
+            min_unique=getattr(args, "min_unique", 0),
+            annotation=getattr(args, "annotation", None),
+            canonical_only=getattr(args, "canonical_only", False),
+            exclude_contigs=getattr(args, "exclude_contig", None),
+        )
+        return filters if filters.active else None
+
+    @property
+    def active(self):
+        """
+        Whether any filter is set.
+        """
+        return bool(
+            self.min_unique
+            or self.annotation is not None
+            or self.canonical_only
+            or self.exclude_contigs
+        )
+
+    def keep_chromosome(self, name):
+        """
+        Whether a chromosome matches none of the excluded names or glob
+        patterns, such as ``chrM`` or ``*_decoy``.
+        """
+        keep = self.chromosomes.get(name)
+        if keep is None:
+            keep = not any(fnmatchcase(name, pat) for pat in self.exclude_contigs)
+            self.chromosomes[name] = keep
+        return keep
+
+    def keep_columns(self, cols):
+        """
+        Whether the split columns of a line pass the per-record filters.
+        """
+        if self.canonical_only and int(cols[4]) == 0:
+            return False
+        if self.annotation is not None and int(cols[5]) != self.annotation:
+            return False
+        return self.keep_chromosome(cols[0])
+
+    def keep_merged(self, rec):
+        """
+        Whether a merged record has at least `min_unique` unique reads.
+        """
+        return rec.n_unique_mapped >= self.min_unique
+
+
+def filter_merged(records, filters=None):
+    """
+    Generator of the merged records that pass the minimum unique reads.
+    :param records: iterable of merged `StarJunctionRecord`
+    :param filters: optional `JunctionFilter`
+    """
+    if filters is None or not filters.min_unique:
+        yield from records
+        return
+    for rec in records:
+        if filters.keep_merged(rec):
+            yield rec
+
+
+def open_output(args):
+    """
+    Opens the output file for writing text. With `args.index` the output is
+    written as BGZF with a tabix index alongside it, with the compression
+    settings of `configure_gzip`.
+    :param args: argparser
+    :returns: writable text file object
+    """
+    if getattr(args, "index", False):
+        if not args.output.endswith(".gz"):
+            raise ValueError("An indexed output file name must end with .gz")
+        return TabixWriter(args.output, **gzip_settings())
+    writer = get_open_function(args.output)
+    return writer(args.output, "wt")
+
+
 def process_files(args, logger):
     """
     All the logic for formatting/merging STAR junction counts.
     :param args: argparser
     :param logger: `logging.Logger` instance
     """
-    writer = get_open_function(args.output)
+    processes = getattr(args, "processes", 1)
+    max_memory = getattr(args, "max_memory", None)
+    if max_memory and getattr(args, "fan_in", None):
+        raise ValueError(
+            "--max-memory and --fan-in cannot be combined, use --run-fan-in to "
+            "bound the number of spilled runs merged at a time"
+        )
+    if getattr(args, "engine", "python") == "numpy" and (
+        max_memory or getattr(args, "fan_in", None)
+    ):
+        raise ValueError(
+            "--max-memory and --fan-in are not supported by the numpy engine"
+        )
+    filters = JunctionFilter.from_args(args)
+    chrom_ranks = None
+    if getattr(args, "chrom_order", None):
+        logger.info("Loading chromosome order from {0}".format(args.chrom_order))
+        chrom_ranks = load_chrom_order(args.chrom_order)
     logger.info("Writing outputs to {0}".format(args.output))
 
-    with writer(args.output, "wt") as o:
+    if len(args.input) > 1 and getattr(args, "stream", False):
+        logger.info(
+            "Streaming merge of {0} sorted STAR junction counts files.".format(
+                len(args.input)
+            )
+        )
+        try:
+            with open_output(args) as o:
+                o.write("#" + "\t".join(COLUMN_NAMES) + "\n")
+                for rec in filter_merged(
+                    stream_merge_junctions(args.input, chrom_ranks, filters), filters
+                ):
+                    o.write(str(rec) + "\n")
+            return
+        except UnsortedInputError as e:
+            logger.warning(
+                "{0}. Falling back to the in-memory merge.".format(e.message)
+            )
+
+    if len(args.input) == 1:
+        logger.info(
+            "Only 1 STAR junction counts file provided. "
+            + "A new STAR junction counts file will be produced "
+            + "with a header line."
+        )
+        logger.info(
+            "Writing formatted STAR junction " + "counts to {0}.".format(args.output)
+        )
+        if filters is None and not getattr(args, "index", False):
+            copy_with_header(
+                args.input[0], args.output, "#" + "\t".join(COLUMN_NAMES) + "\n"
+            )
+            return
+
+    with open_output(args) as o:
         # Write header row as comment
         o.write("#" + "\t".join(COLUMN_NAMES) + "\n")
-        if len(args.input) > 1:
-            logger.info("Merging {0} STAR gene counts files.".format(len(args.input)))
-            # Load
-            dic = dict()
-            for fil in args.input:
-                dic = load_junction_file(fil, dic)
+        if len(args.input) > 1 and getattr(args, "engine", "python") == "numpy":
+            logger.info(
+                "Merging {0} STAR junction counts files with the numpy engine.".format(
+                    len(args.input)
+                )
+            )
+            # Imported here so the default engine starts without loading numpy
+            from gdc_rnaseq_tools.junction_arrays import merge_junction_files
+
+            merged = merge_junction_files(
+                args.input,
+                processes=processes,
+                chrom_ranks=chrom_ranks,
+                filters=filters,
+            )
 
             logger.info(
                 "Writing merged STAR junction counts to {0}.".format(args.output)
             )
-            # Merge and write
-            for key in sorted(dic, key=itemgetter(0, 1, 2)):
-                o.write(str(dic[key]) + "\n")
+            merged.write(o)
 
-        else:
+        elif len(args.input) > 1 and max_memory:
             logger.info(
-                "Only 1 STAR junction counts file provided. "
-                + "A new STAR junction counts file will be produced "
-                + "with a header line."
+                "Merging {0} STAR junction counts files within {1}.".format(
+                    len(args.input), max_memory
+                )
             )
+            for rec in filter_merged(
+                external_merge_junctions(
+                    args.input,
+                    parse_size(max_memory),
+                    chrom_ranks=chrom_ranks,
+                    tmp_dir=getattr(args, "tmp_dir", None),
+                    filters=filters,
+                    fan_in=getattr(args, "run_fan_in", None),
+                ),
+                filters,
+            ):
+                o.write(str(rec) + "\n")
+
+        elif len(args.input) > 1:
+            logger.info("Merging {0} STAR gene counts files.".format(len(args.input)))
+            # Load
+            if getattr(args, "fan_in", None):
+                dic = reduce_junction_files(
+                    args.input, processes, args.fan_in, filters=filters
+                )
+            else:
+                dic = load_junction_files(
+                    args.input, processes=processes, filters=filters
+                )
+
             logger.info(
-                "Writing formatted STAR junction "
-                + "counts to {0}.".format(args.output)
+                "Writing merged STAR junction counts to {0}.".format(args.output)
             )
+            # Merge and write
+            for rec in filter_merged(
+                sorted(
+                    dic.values(), key=partial(position_key, chrom_ranks=chrom_ranks)
+                ),
+                filters,
+            ):
+                o.write(str(rec) + "\n")
 
+        else:
             fil = args.input[0]
             reader = get_open_function(fil)
             with reader(fil, "rt") as fh:
                 for line in fh:
+                    if filters is not None and not line.startswith("#"):
+                        cols = line.rstrip("\r\n").split("\t")
+                        if not filters.keep_columns(cols) or (
+                            int(cols[6]) < filters.min_unique
+                        ):
+                            continue
                     o.write(line)
 
 
-def load_junction_file(fil, dic):
+def load_junction_file(fil, dic, filters=None):
     """
     Load star junction file into a dictionary.
     :param fil: path to STAR counts file to load
     :param dic: dict to load file to
+    :param filters: optional `JunctionFilter` whose per-record filters are
+    applied before records are created
     :returns: updated dictionary
     """
-    reader = get_open_function(fil)
-    with reader(fil, "rt") as fh:
-        for line in fh:
-            rec = StarJunctionRecord.from_line(line)
-            if rec.key not in dic:
-                dic[rec.key] = rec
+    for rec in iter_junction_file(fil, filters):
+        if rec.key not in dic:
+            dic[rec.key] = rec
+        else:
+            dic[rec.key] += rec
+    return dic
+
+
+def load_junction_partial(fil, filters=None):
+    """
+    Load and merge a single star junction file into plain tuples, which are
+    much cheaper to send between processes than records.
+    :param fil: path to STAR counts file to load
+    :param filters: optional `JunctionFilter`
+    :returns: list of tuples of the nine junction columns
+    """
+    return [
+        rec.key + (rec.n_unique_mapped, rec.n_multi_mapped, rec.max_splice_overhang)
+        for rec in load_junction_file(fil, dict(), filters).values()
+    ]
+
+
+def load_junction_files(files, processes=1, filters=None):
+    """
+    Load star junction files into one dictionary. With more than one process
+    the files are parsed in worker processes and the partial results are
+    combined in input order, so the result does not depend on `processes`.
+    :param files: paths to STAR counts files to load
+    :param processes: number of worker processes
+    :param filters: optional `JunctionFilter`
+    :returns: dictionary of key to `StarJunctionRecord`
+    """
+    dic = dict()
+    if not processes or processes < 2:
+        for fil in files:
+            dic = load_junction_file(fil, dic, filters)
+        return dic
+
+    load = partial(load_junction_partial, filters=filters)
+    for part in parallel_map(load, files, processes):
+        for row in part:
+            key = row[:6]
+            rec = dic.get(key)
+            if rec is None:
+                dic[key] = StarJunctionRecord(*row)
             else:
-                dic[rec.key] += rec
+                rec.n_unique_mapped += row[6]
+                rec.n_multi_mapped += row[7]
+                rec.max_splice_overhang = max(rec.max_splice_overhang, row[8])
     return dic
 
 
+def load_junction_group(files, filters=None):
+    """
+    Load and merge a group of star junction files, one file at a time.
+    :param files: paths to STAR counts files to load
+    :param filters: optional `JunctionFilter`
+    :returns: dict of key to list of the summed value columns, which is much
+    cheaper to send between processes than records
+    """
+    dic = dict()
+    for fil in files:
+        dic = load_junction_file(fil, dic, filters)
+    return {
+        key: [rec.n_unique_mapped, rec.n_multi_mapped, rec.max_splice_overhang]
+        for key, rec in dic.items()
+    }
+
+
+def merge_junction_partials(parts):
+    """
+    Merge the results of `load_junction_group` in order, keeping the order
+    keys were first seen.
+    :param parts: list of dicts of key to value columns
+    :returns: merged dict
+    """
+    merged = parts[0]
+    for part in parts[1:]:
+        for key, values in part.items():
+            found = merged.get(key)
+            if found is None:
+                merged[key] = values
+            else:
+                found[0] += values[0]
+                found[1] += values[1]
+                found[2] = max(found[2], values[2])
+    return merged
+
+
+def reduce_junction_files(files, processes=1, fan_in=8, filters=None):
+    """
+    Load star junction files with a tree reduction: groups of `fan_in` files
+    are merged in worker processes and the partial results are merged
+    `fan_in` at a time until one remains. Each worker reads one file at a
+    time, so at most `processes` inputs are open at once. The result is the
+    same as `load_junction_files`.
+    :param files: paths to STAR counts files to load
+    :param processes: number of worker processes
+    :param fan_in: number of files or partial results merged per group
+    :param filters: optional `JunctionFilter`
+    :returns: dictionary of key to `StarJunctionRecord`
+    """
+    merged = tree_reduce(
+        partial(load_junction_group, filters=filters),
+        merge_junction_partials,
+        files,
+        processes=processes,
+        fan_in=fan_in,
+    )
+    return {key: StarJunctionRecord(*key, *values) for key, values in merged.items()}
+
+
+def iter_junction_file(fil, filters=None):
+    """
+    Generator of records from a star junction file.
+    :param fil: path to STAR junction file to read
+    :param filters: optional `JunctionFilter` whose per-record filters are
+    checked on the columns of each line before a record is created
+    :return: `StarJunctionRecord` instances in file order
+    :raises DataFormatError: if the file is not a STAR junction file
+    :raises DataError: if the file is truncated
+    """
+    for cols in iter_star_junctions(fil):
+        if filters is None or filters.keep_columns(cols):
+            yield StarJunctionRecord.from_columns(cols)
+
+
+def iter_sorted_junction_file(fil, chrom_ranks, filters=None, add_ranks=False):
+    """
+    Generator of position-tagged records from a star junction file that is
+    sorted by chromosome, intron start and intron end, with chromosomes in
+    the order of `chrom_ranks`.
+    :param fil: path to STAR junction file to read
+    :param chrom_ranks: dict of chromosome to rank, see `position_key`
+    :param filters: optional `JunctionFilter`
+    :param add_ranks: whether a chromosome missing from `chrom_ranks` is
+    added to it when first reached, ranked after all chromosomes reached
+    before by this or another file sharing `chrom_ranks`
+    :return: tuples of the `position_key` and record
+    :raises UnsortedInputError: if the file is not sorted in that order
+    """
+    last = None
+    for rec in iter_junction_file(fil, filters):
+        if add_ranks and rec.chromosome not in chrom_ranks:
+            chrom_ranks[rec.chromosome] = len(chrom_ranks)
+        pos = position_key(rec, chrom_ranks)
+        if last is not None and pos < last:
+            raise UnsortedInputError(
+                "Junction file {0} is not sorted at {1}:{2}-{3}".format(
+                    fil, rec.chromosome, rec.intron_first, rec.intron_last
+                )
+            )
+        last = pos
+        yield pos, rec
+
+
+def merge_sorted_records(records):
+    """
+    Generator of merged records from position-sorted records. Records sharing
+    a key are summed; records at the same position are emitted in the order
+    their key was first seen.
+    :param records: iterable of (position, `StarJunctionRecord`) sorted by
+    position
+    :return: merged `StarJunctionRecord` instances
+    """
+    group_pos = None
+    group = dict()
+    for pos, rec in records:
+        if pos != group_pos:
+            yield from group.values()
+            group = dict()
+            group_pos = pos
+        if rec.key not in group:
+            group[rec.key] = rec
+        else:
+            group[rec.key] += rec
+    yield from group.values()
+
+
+def stream_merge_junctions(files, chrom_ranks=None, filters=None):
+    """
+    Generator of merged records from STAR junction files that are each sorted
+    by chromosome, intron start and intron end, as STAR writes them. The files
+    are merged with a heap so memory does not grow with the number of
+    junctions. With a chromosome order, output is in the order of
+    `position_key`, as in the in-memory merge with the same order. Without
+    one, chromosomes are ranked as the merge first reaches them, which
+    follows the order the inputs share, as when STAR writes them with the
+    same genome.
+    :param files: list of paths to STAR junction files
+    :param chrom_ranks: optional dict of chromosome to rank that the inputs
+    follow
+    :param filters: optional `JunctionFilter` whose per-record filters are
+    applied while reading
+    :return: merged `StarJunctionRecord` instances in sorted order
+    :raises UnsortedInputError: if an input is not sorted or the inputs
+    disagree on chromosome order
+    """
+    add_ranks = chrom_ranks is None
+    if add_ranks:
+        chrom_ranks = dict()
+    streams = [
+        iter_sorted_junction_file(fil, chrom_ranks, filters, add_ranks) for fil in files
+    ]
+    yield from merge_sorted_records(heapq.merge(*streams, key=itemgetter(0)))
+
+
+def position_key(rec, chrom_ranks=None):
+    """
+    Sort key of a record's position. Without a chromosome order chromosomes
+    sort by name. With one, chromosomes sort by rank and those missing from
+    the order sort by name after all ranked chromosomes.
+    :param rec: `StarJunctionRecord`
+    :param chrom_ranks: optional dict of chromosome to rank
+    :return: tuple of chromosome rank, chromosome, intron start and intron end
+    """
+    rank = 0
+    if chrom_ranks is not None:
+        rank = chrom_ranks.get(rec.chromosome, len(chrom_ranks))
+    return (rank, rec.chromosome, rec.intron_first, rec.intron_last)
+
+
+def write_run(dic, first_seq, tmp_dir, chrom_ranks=None):
+    """
+    Write the records of a dictionary to a temporary file sorted by position.
+    Each line is prefixed with the order its key was first seen so that
+    records at the same position can be merged back in that order.
+    :param dic: dict of key to `StarJunctionRecord` in first seen order
+    :param first_seq: sequence number of the first record in `dic`
+    :param tmp_dir: directory to write the run to
+    :param chrom_ranks: optional dict of chromosome to rank
+    :returns: path to the sorted run
+    """
+    fd, path = tempfile.mkstemp(suffix=".run.tsv", dir=tmp_dir)
+    with os.fdopen(fd, "wt") as o:
+        for seq, rec in sort_run(dic, first_seq, chrom_ranks):
+            o.write("{0}\t{1}\n".format(seq, rec))
+    return path
+
+
+def sort_run(dic, first_seq, chrom_ranks=None):
+    """
+    Sort the records of a dictionary by position, keeping first seen order
+    for records at the same position.
+    :param dic: dict of key to `StarJunctionRecord` in first seen order
+    :param first_seq: sequence number of the first record in `dic`
+    :param chrom_ranks: optional dict of chromosome to rank
+    :returns: list of (sequence number, `StarJunctionRecord`)
+    """
+    key = partial(position_key, chrom_ranks=chrom_ranks)
+    return sorted(enumerate(dic.values(), first_seq), key=lambda item: key(item[1]))
+
+
+def iter_run(path, chrom_ranks=None):
+    """
+    Generator of records from a sorted run written by `write_run`.
+    :param path: path to the sorted run
+    :param chrom_ranks: optional dict of chromosome to rank
+    :return: tuples of position, sequence number and `StarJunctionRecord`
+    """
+    with open(path, "rt") as fh:
+        for line in fh:
+            seq, rest = line.split("\t", 1)
+            rec = StarJunctionRecord.from_line(rest)
+            yield position_key(rec, chrom_ranks), int(seq), rec
+
+
+def merge_runs(paths, run_dir, chrom_ranks=None):
+    """
+    Merge sorted runs into a single sorted run and remove them. Records keep
+    their sequence numbers and are not summed, so the result merges back
+    like the runs it replaces.
+    :param paths: list of paths to sorted runs written by `write_run`
+    :param run_dir: directory to write the merged run to
+    :param chrom_ranks: optional dict of chromosome to rank
+    :returns: path to the merged run
+    """
+    fd, path = tempfile.mkstemp(suffix=".run.tsv", dir=run_dir)
+    with os.fdopen(fd, "wt") as o:
+        merged = heapq.merge(
+            *[iter_run(run, chrom_ranks) for run in paths], key=itemgetter(0, 1)
+        )
+        for _, seq, rec in merged:
+            o.write("{0}\t{1}\n".format(seq, rec))
+    for run in paths:
+        os.remove(run)
+    return path
+
+
+def external_merge_junctions(
+    files, max_memory, chrom_ranks=None, tmp_dir=None, filters=None, fan_in=None
+):
+    """
+    Generator of merged records sorted by position, holding at most about
+    `max_memory` bytes of records in memory. When the budget is exceeded the
+    records loaded so far are spilled to a sorted run in a temporary
+    directory. While there are more than `fan_in` runs, groups of `fan_in`
+    runs are merged into one, then the remaining runs are merged back with a
+    heap at the end, so at most `fan_in` runs are open at a time. Output is
+    identical to the in-memory merge.
+    :param files: list of paths to STAR junction files
+    :param max_memory: memory budget in bytes
+    :param chrom_ranks: optional dict of chromosome to rank
+    :param tmp_dir: optional parent directory for the sorted runs
+    :param filters: optional `JunctionFilter` whose per-record filters are
+    applied while reading
+    :param fan_in: maximum number of runs merged at a time, `RUN_FAN_IN` by
+    default
+    :return: merged `StarJunctionRecord` instances in sorted order
+    """
+    fan_in = max(2, fan_in or RUN_FAN_IN)
+    max_records = max(1, max_memory // RECORD_BYTES)
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+        runs = []
+        dic = dict()
+        seq = 0
+        for fil in files:
+            for rec in iter_junction_file(fil, filters):
+                if rec.key in dic:
+                    dic[rec.key] += rec
+                    continue
+                dic[rec.key] = rec
+                if len(dic) >= max_records:
+                    runs.append(write_run(dic, seq, run_dir, chrom_ranks))
+                    seq += len(dic)
+                    dic = dict()
+
+        while len(runs) > fan_in:
+            runs = [
+                merge_runs(runs[i : i + fan_in], run_dir, chrom_ranks)
+                for i in range(0, len(runs), fan_in)
+            ]
+
+        last = (
+            (position_key(rec, chrom_ranks), i, rec)
+            for i, rec in sort_run(dic, seq, chrom_ranks)
+        )
+        merged = heapq.merge(
+            *[iter_run(path, chrom_ranks) for path in runs],
+            last,
+            key=itemgetter(0, 1),
+        )
+        yield from merge_sorted_records((pos, rec) for pos, _, rec in merged)
+
+
 def main(args):
     """
     Main entrypoint for merge_star_gene_counts.
@@ -172,4 +756,24 @@ def main(args):
         "Merging/Formatting {0} STAR junction counts files.".format(len(args.input))
     )
 
-    process_files(args, logger)
+    cache = result_cache(args)
+    key = None
+    outputs = [args.output]
+    if getattr(args, "index", False):
+        outputs.append(args.output + ".tbi")
+    if cache is not None:
+        chrom_order = getattr(args, "chrom_order", None)
+        options = {
+            "gzip": args.output.endswith(".gz"),
+            "stream": bool(getattr(args, "stream", False)),
+            "chrom_order": bool(chrom_order),
+            "index": bool(getattr(args, "index", False)),
+            "min_unique": getattr(args, "min_unique", 0) or 0,
+            "annotation": getattr(args, "annotation", None),
+            "canonical_only": bool(getattr(args, "canonical_only", False)),
+            "exclude_contig": list(getattr(args, "exclude_contig", None) or []),
+        }
+        inputs = list(args.input) + ([chrom_order] if chrom_order else [])
+        key = result_key("merge_star_junctions", options, inputs)
+    if cached_run(cache, key, outputs, lambda: process_files(args, logger)):
+        logger.info("Served {0} from the result cache.".format(args.output))
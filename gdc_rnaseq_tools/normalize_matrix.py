@@ -0,0 +1,164 @@
+"""A gdc-rnaseq-tools subcommand to compute TPM, FPKM and FPKM-UQ for a
+whole cohort from a genes-by-samples raw counts matrix, such as one written
+by build_counts_matrix.
+
+Samples are normalized a chunk at a time with
+`augment_star_counts.calc_normalized`, so the numbers are exactly those
+`augment_star_counts` writes for each sample, including the protein coding
+and autosome selection rules. Genes are joined to the gene info as in
+`augment_star_counts`: output rows are the gene info genes found in the
+matrix, in gene info order. The chunk size is chosen to fit a memory budget,
+and a memory-mapped input is only read one chunk at a time.
+
+Each measure is written to ``<prefix>.<measure>.npy`` as a float64 matrix in
+Fortran (column-major) order with one column per sample. Gene IDs, sample
+IDs and the counts column are kept in a JSON sidecar, ``<prefix>.index.json``.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from gdc_rnaseq_tools.augment_star_counts import (
+    GeneAlignment,
+    GeneInfoColumns,
+    calc_normalized,
+    load_gene_info,
+)
+from gdc_rnaseq_tools.counts_matrix import load_counts_matrix
+from gdc_rnaseq_tools.utils import DataError, get_logger, parse_size
+
+MEASURES = ["tpm", "fpkm", "fpkm_uq"]
+
+# Default memory budget of the arrays of one chunk of samples
+DEFAULT_MAX_MEMORY = "1G"
+
+# float64 arrays of one gene per sample held while normalizing a chunk: the
+# gathered counts, the three results and the temporaries of calc_normalized
+ARRAYS_PER_SAMPLE = 6
+
+
+def chunk_samples(n_genes, max_memory):
+    """
+    Number of samples to normalize at a time.
+    :param n_genes: number of genes of the matrix
+    :param max_memory: memory budget in bytes
+    :returns: number of samples, at least one
+    """
+    return max(1, max_memory // max(1, n_genes * 8 * ARRAYS_PER_SAMPLE))
+
+
+def normalize_matrix(
+    counts, genes, gene_info, allocate=None, max_memory=None, logger=None
+):
+    """
+    Compute TPM, FPKM and FPKM-UQ of every sample of a counts matrix.
+    :param counts: genes by samples array of raw counts, in memory or
+    memory-mapped
+    :param genes: gene ID of each row of the matrix
+    :param gene_info: gene info table, see `augment_star_counts.load_gene_info`
+    :param allocate: optional function returning the genes by samples
+    float64 array to fill for a measure and shape, such as a memory-mapped
+    file; arrays are allocated in memory otherwise
+    :param max_memory: memory budget of a chunk of samples in bytes
+    :param logger: optional `logging.Logger` instance
+    :returns: tuple of the gene IDs of the output rows and a dict of measure
+    to array
+    :raises DataError: if gene IDs repeat
+    """
+    alignment = GeneAlignment(gene_info)
+    rows = alignment.align(np.array(genes, dtype=object)) if alignment.unique else None
+    if rows is None:
+        raise DataError("Gene IDs of the matrix or the gene info are not unique")
+    info_rows, counts_rows = rows
+    protein_coding, autosomal_protein_coding = alignment.masks
+    length = gene_info[GeneInfoColumns.TOTAL_EXON_LENGTH.value].to_numpy()[info_rows]
+    gene_ids = alignment.gene_ids[info_rows].tolist()
+
+    n_samples = counts.shape[1]
+    allocate = allocate or (lambda measure, shape: np.empty(shape, order="F"))
+    outputs = {
+        measure: allocate(measure, (len(gene_ids), n_samples)) for measure in MEASURES
+    }
+    step = chunk_samples(len(gene_ids), max_memory or parse_size(DEFAULT_MAX_MEMORY))
+    for start in range(0, n_samples, step):
+        stop = min(start + step, n_samples)
+        # samples by genes, so that each sample's counts are contiguous
+        expression = np.ascontiguousarray(counts[counts_rows, start:stop].T)
+        results = calc_normalized(
+            expression, length, protein_coding, autosomal_protein_coding
+        )
+        for measure, result in zip(MEASURES, results):
+            outputs[measure][:, start:stop] = result.T
+        if logger:
+            logger.info("Normalized {0} of {1} samples.".format(stop, n_samples))
+    return gene_ids, outputs
+
+
+def output_path(prefix, measure):
+    """
+    Path of the matrix of one measure.
+    """
+    return "{0}.{1}.npy".format(prefix, measure)
+
+
+def save_index(prefix, index):
+    """
+    Write the sidecar of the normalized matrices, replacing any previous one
+    atomically.
+    """
+    path = prefix + ".index.json"
+    tmp = path + ".tmp"
+    with open(tmp, "wt") as o:
+        json.dump(index, o)
+    os.replace(tmp, path)
+
+
+def main(args):
+    """
+    Main entrypoint for normalize_counts_matrix.
+    """
+    logger = get_logger("normalize_counts_matrix")
+    counts, index = load_counts_matrix(args.input)
+    gene_info = load_gene_info(args.gene_info)
+    max_memory = getattr(args, "max_memory", None) or DEFAULT_MAX_MEMORY
+    logger.info(
+        "Normalizing {0} samples of counts matrix {1}.".format(
+            counts.shape[1], args.input
+        )
+    )
+
+    def allocate(measure, shape):
+        return np.lib.format.open_memmap(
+            output_path(args.output, measure),
+            mode="w+",
+            dtype=np.float64,
+            shape=shape,
+            fortran_order=True,
+        )
+
+    gene_ids, outputs = normalize_matrix(
+        counts,
+        index["genes"],
+        gene_info,
+        allocate=allocate,
+        max_memory=parse_size(max_memory),
+        logger=logger,
+    )
+    for output in outputs.values():
+        output.flush()
+    save_index(
+        args.output,
+        {
+            "genes": gene_ids,
+            "samples": index["samples"],
+            "column": index["column"],
+            "measures": MEASURES,
+        },
+    )
+    logger.info(
+        "Wrote {0} genes by {1} samples to {2}.*.npy.".format(
+            len(gene_ids), counts.shape[1], args.output
+        )
+    )
@@ -0,0 +1,52 @@
+"""A gdc-rnaseq-tools subcommand to query junctions in regions of a merged
+STAR junction counts file written with ``merge_star_junctions --index``.
+"""
+
+import sys
+
+from gdc_rnaseq_tools.bgzf import BgzfReader
+from gdc_rnaseq_tools.tabix import TabixIndex, query
+from gdc_rnaseq_tools.utils import get_logger
+
+
+def query_junctions(path, regions, out, header=False):
+    """
+    Write the junctions overlapping each region.
+    :param path: path to the BGZF-compressed junction file
+    :param regions: list of region strings such as ``chr1:1000-2000``
+    :param out: text file object to write to
+    :param header: whether to write the header line first
+    :returns: number of junctions written
+    """
+    index = TabixIndex.load(path + ".tbi")
+    if header:
+        with BgzfReader(path) as fh:
+            line = fh.readline().decode()
+            if line.startswith(index.meta):
+                out.write(line)
+
+    count = 0
+    for region in regions:
+        for line in query(path, region, index=index):
+            out.write(line)
+            count += 1
+    return count
+
+
+def main(args):
+    """
+    Main entrypoint for query_junctions.
+    """
+    logger = get_logger("query_junctions")
+    logger.info("Querying {0} region(s) of {1}.".format(len(args.region), args.input))
+
+    output = getattr(args, "output", None)
+    out = open(output, "wt") if output else sys.stdout
+    try:
+        count = query_junctions(
+            args.input, args.region, out, header=getattr(args, "header", False)
+        )
+    finally:
+        if output:
+            out.close()
+    logger.info("Found {0} junction(s).".format(count))
@@ -0,0 +1,347 @@
+"""Tabix-compatible (.tbi) indexing of BGZF-compressed, coordinate-sorted
+tab-separated files, and region queries against them.
+
+Indexes written here can be used with `tabix` and htslib, and indexes written
+by `tabix` can be queried here. Positions in the indexed columns are 1-based
+and inclusive, as in STAR junction files.
+"""
+
+import re
+import struct
+from collections import OrderedDict
+from itertools import accumulate
+
+from gdc_rnaseq_tools.bgzf import (
+    BLOCK_SIZE,
+    COMPRESS_LEVEL,
+    BgzfReader,
+    BgzfWriter,
+    ParallelBgzfWriter,
+)
+from gdc_rnaseq_tools.utils import DataFormatError, UnsortedInputError
+
+MAGIC = b"TBI\x01"
+LINEAR_SHIFT = 14
+MAX_BIN = 37450
+TBX_GENERIC = 0
+
+
+def reg2bin(beg, end):
+    """
+    Returns the smallest bin of the UCSC binning scheme containing a 0-based,
+    half-open interval.
+    """
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+
+def reg2bins(beg, end):
+    """
+    Returns all bins that may contain records overlapping a 0-based,
+    half-open interval.
+    """
+    end -= 1
+    bins = [0]
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+
+class TabixIndex:
+    """Bins, chunks and linear index of each sequence in a .tbi index"""
+
+    def __init__(self, col_seq=1, col_beg=2, col_end=3, meta="#", skip=0):
+        self.col_seq = col_seq
+        self.col_beg = col_beg
+        self.col_end = col_end
+        self.meta = meta
+        self.skip = skip
+        self.refs = OrderedDict()
+
+    def add(self, name, beg, end, voff_beg, voff_end):
+        """
+        Add a record in sorted order.
+
+        :param name: sequence name
+        :param beg: 0-based start of the record
+        :param end: 0-based, exclusive end of the record
+        :param voff_beg: virtual offset of the start of the record
+        :param voff_end: virtual offset just past the end of the record
+        :raises UnsortedInputError: if records are not sorted by sequence
+        and start
+        """
+        if name not in self.refs:
+            self.refs[name] = {"bins": OrderedDict(), "linear": [], "last": -1}
+        elif name != next(reversed(self.refs)):
+            raise UnsortedInputError("Records for {0} are not contiguous".format(name))
+        ref = self.refs[name]
+        if beg < ref["last"]:
+            raise UnsortedInputError("Records for {0} are not sorted".format(name))
+        ref["last"] = beg
+
+        chunks = ref["bins"].setdefault(reg2bin(beg, max(end, beg + 1)), [])
+        if chunks and chunks[-1][1] == voff_beg:
+            chunks[-1][1] = voff_end
+        else:
+            chunks.append([voff_beg, voff_end])
+
+        linear = ref["linear"]
+        last_window = (max(end, beg + 1) - 1) >> LINEAR_SHIFT
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> LINEAR_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = voff_beg
+
+    def map_offsets(self, func):
+        """
+        Replace each offset of the index with ``func(offset)``.
+        """
+        for ref in self.refs.values():
+            for chunks in ref["bins"].values():
+                for chunk in chunks:
+                    chunk[:] = map(func, chunk)
+            ref["linear"] = [
+                None if voff is None else func(voff) for voff in ref["linear"]
+            ]
+
+    def to_bytes(self):
+        """
+        Returns the uncompressed bytes of the .tbi index.
+        """
+        names = b"".join(name.encode() + b"\x00" for name in self.refs)
+        out = [
+            MAGIC,
+            struct.pack(
+                "<8i",
+                len(self.refs),
+                TBX_GENERIC,
+                self.col_seq,
+                self.col_beg,
+                self.col_end,
+                ord(self.meta),
+                self.skip,
+                len(names),
+            ),
+            names,
+        ]
+        for ref in self.refs.values():
+            out.append(struct.pack("<i", len(ref["bins"])))
+            for bin_id, chunks in ref["bins"].items():
+                out.append(struct.pack("<Ii", bin_id, len(chunks)))
+                out.extend(struct.pack("<QQ", *chunk) for chunk in chunks)
+            # windows without records start at the previous window's offset
+            linear = []
+            previous = 0
+            for voff in ref["linear"]:
+                previous = previous if voff is None else voff
+                linear.append(previous)
+            out.append(struct.pack("<i", len(linear)))
+            out.append(struct.pack("<{0}Q".format(len(linear)), *linear))
+        return b"".join(out)
+
+    def write(self, path):
+        """
+        Write the BGZF-compressed index.
+        """
+        with BgzfWriter(path) as o:
+            o.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a .tbi index.
+        """
+        with BgzfReader(path) as fh:
+            data = b"".join(iter(fh))
+        if data[:4] != MAGIC:
+            raise DataFormatError("{0} is not a tabix index".format(path))
+        n_ref, _, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack_from(
+            "<8i", data, 4
+        )
+        pos = 36
+        names = data[pos : pos + l_nm].split(b"\x00")[:n_ref]
+        pos += l_nm
+
+        index = cls(col_seq, col_beg, col_end, chr(meta), skip)
+        for name in names:
+            (n_bin,) = struct.unpack_from("<i", data, pos)
+            pos += 4
+            bins = OrderedDict()
+            for _ in range(n_bin):
+                bin_id, n_chunk = struct.unpack_from("<Ii", data, pos)
+                pos += 8
+                chunks = [
+                    list(struct.unpack_from("<QQ", data, pos + 16 * i))
+                    for i in range(n_chunk)
+                ]
+                pos += 16 * n_chunk
+                if bin_id != MAX_BIN:
+                    bins[bin_id] = chunks
+            (n_intv,) = struct.unpack_from("<i", data, pos)
+            pos += 4
+            linear = list(struct.unpack_from("<{0}Q".format(n_intv), data, pos))
+            pos += 8 * n_intv
+            index.refs[name.decode()] = {"bins": bins, "linear": linear, "last": -1}
+        return index
+
+    def chunks(self, name, beg, end):
+        """
+        Returns the merged chunks of virtual offsets that may hold records
+        overlapping a 0-based, half-open interval.
+        """
+        ref = self.refs.get(name)
+        if ref is None:
+            return []
+        linear = ref["linear"]
+        window = min(beg >> LINEAR_SHIFT, len(linear) - 1)
+        min_offset = linear[window] if linear else 0
+
+        found = []
+        for bin_id in reg2bins(beg, end):
+            for voff_beg, voff_end in ref["bins"].get(bin_id, []):
+                if voff_end > min_offset:
+                    found.append([max(voff_beg, min_offset), voff_end])
+        found.sort()
+        merged = []
+        for chunk in found:
+            if merged and chunk[0] <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], chunk[1])
+            else:
+                merged.append(chunk)
+        return merged
+
+
+class TabixWriter:
+    """
+    Text file-like writer of a coordinate-sorted, tab-separated file as BGZF
+    that builds a .tbi index as lines are written. Blocks are compressed by a
+    `ParallelBgzfWriter`, so lines are indexed by their uncompressed offset,
+    which is turned into a virtual offset once the sizes of all blocks are
+    known. The index is written to `path` + ".tbi" on close.
+    """
+
+    def __init__(
+        self,
+        path,
+        col_seq=1,
+        col_beg=2,
+        col_end=3,
+        meta="#",
+        threads=None,
+        level=COMPRESS_LEVEL,
+    ):
+        """
+        :param path: output path
+        :param col_seq: 1-based column of the sequence name
+        :param col_beg: 1-based column of the 1-based start
+        :param col_end: 1-based column of the inclusive end
+        :param meta: prefix of lines that are not indexed
+        :param threads: number of compression threads, defaults to the
+        number of CPUs
+        :param level: zlib compression level
+        """
+        self.path = path
+        self.handle = ParallelBgzfWriter(path, threads=threads, level=level)
+        self.index = TabixIndex(col_seq, col_beg, col_end, meta)
+        self.pending = ""
+        self.offset = 0
+
+    def write(self, text):
+        """
+        Write text, indexing each complete line.
+        """
+        text = self.pending + text
+        lines = text.split("\n")
+        self.pending = lines.pop()
+        for line in lines:
+            self._write_line(line + "\n")
+        return len(text)
+
+    def close(self, write_index=True):
+        """
+        Write any incomplete last line, close the file and write the index.
+        """
+        if self.pending:
+            self._write_line(self.pending)
+            self.pending = ""
+        self.handle.close()
+        if write_index:
+            addresses = [0] + list(accumulate(self.handle.block_sizes))
+            self.index.map_offsets(
+                lambda offset: (
+                    addresses[offset // BLOCK_SIZE] << 16 | offset % BLOCK_SIZE
+                )
+            )
+            self.index.write(self.path + ".tbi")
+
+    def _write_line(self, line):
+        offset_beg = self.offset
+        data = line.encode()
+        self.handle.write(data)
+        self.offset += len(data)
+        if line.startswith(self.index.meta):
+            return
+        cols = line.rstrip("\r\n").split("\t")
+        self.index.add(
+            cols[self.index.col_seq - 1],
+            int(cols[self.index.col_beg - 1]) - 1,
+            int(cols[self.index.col_end - 1]),
+            offset_beg,
+            self.offset,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(write_index=exc_type is None)
+
+
+def parse_region(region):
+    """
+    Parses a region string such as ``chr1``, ``chr1:1000`` or
+    ``chr1:1,000-2,000`` with 1-based, inclusive coordinates.
+
+    :param region: region string
+    :return: tuple of sequence name, 0-based start and exclusive end
+    :raises ValueError: if the region cannot be parsed
+    """
+    match = re.match(r"^(.+?)(?::([\d,]+)(?:-([\d,]+))?)?$", region.strip())
+    if not match:
+        raise ValueError("Invalid region {0}".format(region))
+    name, beg, end = match.groups()
+    beg = int(beg.replace(",", "")) if beg else 1
+    end = int(end.replace(",", "")) if end else (1 << 29)
+    if beg < 1 or end < beg:
+        raise ValueError("Invalid region {0}".format(region))
+    return name, beg - 1, end
+
+
+def query(path, region, index=None):
+    """
+    Generator of the lines of an indexed file that overlap a region.
+
+    :param path: path to the BGZF-compressed file
+    :param region: region string, see `parse_region`
+    :param index: optional loaded `TabixIndex`, otherwise `path` + ".tbi"
+    :return: lines as text, including the newline
+    """
+    name, beg, end = parse_region(region)
+    index = index or TabixIndex.load(path + ".tbi")
+    with BgzfReader(path) as fh:
+        for voff_beg, voff_end in index.chunks(name, beg, end):
+            fh.seek(voff_beg)
+            while fh.tell() < voff_end:
+                line = fh.readline()
+                if not line:
+                    break
+                cols = line.decode().rstrip("\r\n").split("\t")
+                rec_beg = int(cols[index.col_beg - 1]) - 1
+                if cols[index.col_seq - 1] != name or rec_beg >= end:
+                    break
+                if int(cols[index.col_end - 1]) > beg:
+                    yield line.decode()
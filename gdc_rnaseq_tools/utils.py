@@ -4,7 +4,33 @@
 """
 
 import gzip
+import io
 import logging
+import os
+import queue
+import shutil
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+COPY_BUFFER = 1 << 20
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Decompressed chunk size and number of chunks queued ahead of the parser
+# by `ReadAheadReader`
+READ_AHEAD_CHUNK = 4 << 20
+READ_AHEAD_DEPTH = 4
+
+# Bytes of lines parsed at a time by `iter_star_columns`
+PARSE_CHUNK = 1 << 20
+
+# Columns of a STAR SJ.out.tab file
+JUNCTION_COLUMNS = 9
+
+# Settings of the gzip reader and of the BGZF writer used for .gz files, see
+# `configure_gzip`. No thread count means one thread per CPU, and no
+# read-ahead setting means read-ahead only with more than one CPU.
+_gzip_options = {"threads": None, "level": 6, "read_ahead": None}
 
 
 def get_logger(name):
@@ -35,11 +61,490 @@ def get_open_function(fil):
     :return: open function
     """
     if fil.endswith(".gz"):
-        return gzip.open
+        return open_gzip
     else:
         return open
 
 
+def configure_gzip(threads=None, level=None, read_ahead=None):
+    """
+    Sets how .gz files are compressed and decompressed.
+
+    :param threads: number of threads compressing outputs and decompressing
+    BGZF inputs, or None for one per CPU
+    :param level: zlib compression level, or None to keep the current one
+    :param read_ahead: whether inputs are decompressed in a background
+    thread, or None to do so only with more than one CPU
+    """
+    _gzip_options["threads"] = threads
+    if level is not None:
+        _gzip_options["level"] = level
+    _gzip_options["read_ahead"] = read_ahead
+
+
+def gzip_settings():
+    """
+    The compression settings of `configure_gzip`, for writers of BGZF
+    outputs that are not opened with `open_gzip`.
+
+    :return: dict of the number of compression threads and zlib level
+    """
+    return {"threads": _gzip_options["threads"], "level": _gzip_options["level"]}
+
+
+def open_gzip(fil, mode="rb", encoding=None, errors=None, newline=None):
+    """
+    Opens a gzip file like `gzip.open`, with the settings of
+    `configure_gzip`. Files opened for reading are decompressed ahead of the
+    caller by a `ReadAheadReader`. Files opened for writing are written as
+    BGZF by a multi-threaded writer, which standard gzip readers can read.
+
+    :param fil: file path
+    :param mode: file mode, with ``t`` for text
+    :return: file object
+    """
+    if "r" in mode:
+        read_ahead = _gzip_options["read_ahead"]
+        if read_ahead is None:
+            read_ahead = (os.cpu_count() or 1) > 1
+        if not read_ahead:
+            return gzip.open(
+                fil, mode, encoding=encoding, errors=errors, newline=newline
+            )
+        reader = io.BufferedReader(
+            ReadAheadReader(fil, threads=_gzip_options["threads"]), COPY_BUFFER
+        )
+        if "t" in mode:
+            return io.TextIOWrapper(
+                reader,
+                encoding=encoding,
+                errors=errors,
+                newline=newline,
+            )
+        return reader
+
+    from gdc_rnaseq_tools.bgzf import ParallelBgzfWriter
+
+    writer = ParallelBgzfWriter(
+        fil,
+        threads=_gzip_options["threads"],
+        level=_gzip_options["level"],
+        mode=mode.replace("t", "").replace("b", "") + "b",
+    )
+    if "t" in mode:
+        return io.TextIOWrapper(
+            writer, encoding=encoding, errors=errors, newline=newline
+        )
+    return writer
+
+
+class ReadAheadReader(io.RawIOBase):
+    """
+    Binary file-like reader of a gzip file that is decompressed in a
+    background thread while the caller parses the data already read. The
+    thread hands chunks of `READ_AHEAD_CHUNK` bytes to the reader through a
+    queue of at most `READ_AHEAD_DEPTH` chunks. BGZF blocks are decompressed
+    in parallel, other gzip files as one stream. Errors of the background
+    thread are raised by `read`.
+    """
+
+    def __init__(self, fil, threads=None, chunk_size=READ_AHEAD_CHUNK):
+        """
+        :param fil: gzip file path
+        :param threads: number of threads decompressing BGZF blocks, or None
+        for one per CPU
+        :param chunk_size: size of the decompressed chunks
+        """
+        # imported here, bgzf imports this module
+        from gdc_rnaseq_tools.bgzf import is_bgzf
+
+        super().__init__()
+        self.name = fil
+        self.bgzf = is_bgzf(fil)
+        self.threads = threads
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(READ_AHEAD_DEPTH)
+        self.chunk = memoryview(b"")
+        self.eof = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._decompress, daemon=True)
+        self.thread.start()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        """
+        Copy the next decompressed bytes into `b`.
+
+        :return: number of bytes copied, 0 at end of file
+        """
+        while not self.chunk:
+            if self.eof:
+                return 0
+            self.chunk = memoryview(self._next_chunk())
+        size = min(len(b), len(self.chunk))
+        b[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+    def readall(self):
+        """
+        Read the rest of the file.
+        """
+        parts = [bytes(self.chunk)]
+        self.chunk = memoryview(b"")
+        while not self.eof:
+            parts.append(self._next_chunk())
+        return b"".join(parts)
+
+    def close(self):
+        """
+        Stop the background thread and close the file.
+        """
+        if self.closed:
+            return
+        self.stopped.set()
+        while self.thread.is_alive():
+            try:
+                self.chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.chunk = memoryview(b"")
+        super().close()
+
+    def _next_chunk(self):
+        chunk = self.chunks.get()
+        if chunk is None or isinstance(chunk, Exception):
+            self.eof = True
+            if chunk is not None:
+                raise chunk
+            return b""
+        return chunk
+
+    def _decompress(self):
+        try:
+            for chunk in self._chunks():
+                if not self._put(chunk):
+                    return
+        except Exception as e:
+            self._put(e)
+        else:
+            self._put(None)
+
+    def _chunks(self):
+        from gdc_rnaseq_tools.bgzf import inflate_chunks
+
+        if self.bgzf:
+            yield from inflate_chunks(self.name, self.chunk_size, self.threads)
+            return
+        with gzip.open(self.name, "rb") as fh:
+            while True:
+                chunk = fh.read(self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _put(self, item):
+        # give up once the reader is closed, rather than wait on a full queue
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+def is_gzip(fil):
+    """
+    Checks whether a file starts with the gzip magic bytes.
+
+    :param fil: file path
+    :return: bool
+    """
+    with open(fil, "rb") as fh:
+        return fh.read(2) == GZIP_MAGIC
+
+
+def copy_with_header(fil, output, header):
+    """
+    Copies a file to `output` after a header line without parsing or
+    re-encoding its lines. Files are streamed as raw bytes in large blocks.
+    When both files are gzip-compressed, the header is written as its own
+    gzip member and the compressed input is appended as-is, which gzip
+    readers see as one continuous stream.
+
+    :param fil: input file path
+    :param output: output file path, compressed if it ends with ``.gz``
+    :param header: header text, including the newline
+    """
+    header = header.encode()
+    if output.endswith(".gz") and fil.endswith(".gz") and is_gzip(fil):
+        with open(output, "wb") as o, open(fil, "rb") as fh:
+            o.write(gzip.compress(header, mtime=0))
+            shutil.copyfileobj(fh, o, COPY_BUFFER)
+        return
+
+    reader = get_open_function(fil)
+    writer = get_open_function(output)
+    with writer(output, "wb") as o, reader(fil, "rb") as fh:
+        o.write(header)
+        shutil.copyfileobj(fh, o, COPY_BUFFER)
+
+
+def parse_size(size):
+    """
+    Parses a human readable size such as ``512M`` or ``2G`` into bytes.
+    Sizes without a suffix are bytes.
+
+    :param size: size string with an optional K, M, G or T suffix
+    :return: number of bytes
+    """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size = str(size).strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def peak_rss():
+    """
+    Peak resident set size of the current process so far.
+
+    :return: number of bytes, or None where the ``resource`` module is not
+    available
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def load_chrom_order(fil):
+    """
+    Loads a chromosome order from a ``.fai`` index or a list of chromosome
+    names, using the first column of each line.
+
+    :param fil: path to the ``.fai`` or chromosome list
+    :return: dict of chromosome name to rank
+    """
+    ranks = dict()
+    reader = get_open_function(fil)
+    with reader(fil, "rt") as fh:
+        for line in fh:
+            cols = line.split()
+            if cols and not cols[0].startswith("#") and cols[0] not in ranks:
+                ranks[cols[0]] = len(ranks)
+    return ranks
+
+
+def iter_line_chunks(fil, chunk_size=PARSE_CHUNK):
+    """
+    Generator of the lines of a file in chunks of about `chunk_size` bytes
+    of complete lines, read in binary mode.
+
+    :param fil: file path, gzip-compressed if it ends with ``.gz``
+    :param chunk_size: number of bytes read at a time
+    :return: tuples of the number of the first line of the chunk, the bytes
+    of its lines, each ending with a newline, and whether the last line of
+    the file was missing its newline
+    """
+    reader = get_open_function(fil)
+    line_number = 1
+    rest = b""
+    with reader(fil, "rb") as fh:
+        while True:
+            data = fh.read(chunk_size)
+            if not data:
+                break
+            end = data.rfind(b"\n") + 1
+            if not end:
+                rest += data
+                continue
+            chunk = rest + data[:end]
+            rest = data[end:]
+            yield line_number, chunk, False
+            line_number += chunk.count(b"\n")
+    if rest:
+        yield line_number, rest + b"\n", True
+
+
+def iter_star_columns(fil, n_strings=1, width=None, chunk_size=PARSE_CHUNK):
+    """
+    Generator of the columns of a tab-separated STAR table, such as a
+    ReadsPerGene or SJ.out.tab file, a chunk of lines at a time. Each chunk
+    of bytes is split on tab and newline bytes, and each of its columns is
+    converted at once. The leading string columns are decoded and interned,
+    so rows share one string per distinct value, and the other columns are
+    parsed as integers.
+
+    :param fil: file path, gzip-compressed if it ends with ``.gz``
+    :param n_strings: number of leading string columns
+    :param width: number of columns, or None to use that of the first line
+    :param chunk_size: number of bytes parsed at a time
+    :return: list of the value lists of each column of a chunk
+    :raises DataFormatError: if a line has another number of columns or a
+    value is not an integer
+    :raises DataError: if the file ends with a truncated line
+    """
+    for line_number, chunk, unterminated in iter_line_chunks(fil, chunk_size):
+        if width is None:
+            width = chunk.count(b"\t", 0, chunk.index(b"\n")) + 1
+        if width <= n_strings:
+            raise DataFormatError(
+                "Expected more than {0} columns in {1}".format(n_strings, fil)
+            )
+        try:
+            columns = _split_columns(chunk, width)
+            columns[:n_strings] = [
+                _intern_strings(column) for column in columns[:n_strings]
+            ]
+            columns[n_strings:] = [
+                list(map(int, column)) for column in columns[n_strings:]
+            ]
+        except (ValueError, UnicodeDecodeError):
+            _raise_line_error(fil, line_number, chunk, width, n_strings, unterminated)
+            raise DataFormatError("Cannot parse {0}".format(fil))
+        yield columns
+
+
+def _split_columns(chunk, width):
+    # With a tab before each newline, splitting on tabs makes every newline
+    # the first byte of the first field of a line. Counting the newlines of
+    # the first fields then checks in one go that every line has `width`
+    # columns.
+    n_lines = chunk.count(b"\n")
+    fields = chunk[:-1].replace(b"\n", b"\t\n").split(b"\t")
+    if len(fields) != n_lines * width:
+        raise ValueError()
+    firsts = b"".join(fields[::width])
+    if firsts.count(b"\n") != n_lines - 1 or firsts.startswith(b"\n"):
+        raise ValueError()
+    return [firsts.split(b"\n")] + [fields[i::width] for i in range(1, width)]
+
+
+def _intern_strings(values):
+    # decode the whole column at once, values cannot hold newlines
+    return list(map(sys.intern, b"\n".join(values).decode().split("\n")))
+
+
+def _raise_line_error(fil, line_number, chunk, width, n_strings, unterminated):
+    # find the first bad line of a chunk that failed to parse and report it
+    lines = chunk.split(b"\n")[:-1]
+    for i, line in enumerate(lines):
+        cols = line.split(b"\t")
+        where = "line {0} of {1}".format(line_number + i, fil)
+        if len(cols) != width:
+            if unterminated and i == len(lines) - 1:
+                raise DataError("{0} ends with a truncated line".format(fil))
+            raise DataFormatError(
+                "Expected {0} columns but found {1} on {2}".format(
+                    width, len(cols), where
+                )
+            )
+        try:
+            [col.decode() for col in cols[:n_strings]]
+            [int(col) for col in cols[n_strings:]]
+        except UnicodeDecodeError:
+            raise DataFormatError("Cannot decode {0}".format(where))
+        except ValueError:
+            raise DataFormatError("Expected integer counts on {0}".format(where))
+
+
+def iter_star_counts(fil, chunk_size=PARSE_CHUNK):
+    """
+    Generator of the rows of a STAR ReadsPerGene file, or of a merged gene
+    counts file without its header, with `iter_star_columns`.
+
+    :param fil: file path
+    :param chunk_size: number of bytes parsed at a time
+    :return: tuples of the gene ID and list of counts
+    :raises DataFormatError: if lines have different numbers of columns or
+    the counts are not integers
+    :raises DataError: if the file ends with a truncated line
+    """
+    for columns in iter_star_columns(fil, chunk_size=chunk_size):
+        yield from zip(columns[0], map(list, zip(*columns[1:])))
+
+
+def iter_star_junctions(fil, chunk_size=PARSE_CHUNK):
+    """
+    Generator of the rows of a STAR SJ.out.tab file with `iter_star_columns`.
+
+    :param fil: file path
+    :param chunk_size: number of bytes parsed at a time
+    :return: tuples of the chromosome and the eight integer columns
+    :raises DataFormatError: if a line does not have nine columns or the
+    numeric columns are not integers
+    :raises DataError: if the file ends with a truncated line
+    """
+    for columns in iter_star_columns(
+        fil, width=JUNCTION_COLUMNS, chunk_size=chunk_size
+    ):
+        yield from zip(*columns)
+
+
+def parallel_map(func, items, processes=1):
+    """
+    Applies a function to each item, in worker processes when more than
+    one process is requested. Results are returned in the order of `items`
+    so callers can combine them deterministically.
+
+    :param func: picklable function of one argument
+    :param items: list of arguments
+    :param processes: maximum number of worker processes
+    :return: list of results
+    """
+    if not processes or processes < 2 or len(items) < 2:
+        return [func(item) for item in items]
+    with ProcessPoolExecutor(max_workers=min(processes, len(items))) as pool:
+        return list(pool.map(func, items))
+
+
+def tree_reduce(load_group, merge_group, items, processes=1, fan_in=8):
+    """
+    Reduces items in a tree. Consecutive groups of `fan_in` items are loaded
+    into partial results with `load_group`, then consecutive groups of
+    partial results are combined with `merge_group` until one remains.
+    Groups keep the order of `items`, so the result matches a serial merge
+    whenever merging is associative. With more than one process each group
+    is handled by a worker process, so at most `processes` groups, and with
+    a `load_group` that reads one item at a time at most `processes` input
+    files, are open at once.
+
+    :param load_group: picklable function of a list of items
+    :param merge_group: picklable function of a list of partial results
+    :param items: list of items
+    :param processes: maximum number of worker processes
+    :param fan_in: number of items or partial results merged per group
+    :return: the final result
+    """
+    fan_in = max(2, fan_in)
+
+    def groups(values):
+        return [values[i : i + fan_in] for i in range(0, len(values), fan_in)]
+
+    if not items:
+        return load_group([])
+    if not processes or processes < 2 or len(items) <= fan_in:
+        parts = [load_group(group) for group in groups(items)]
+        while len(parts) > 1:
+            parts = [merge_group(group) for group in groups(parts)]
+        return parts[0]
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        parts = list(pool.map(load_group, groups(items)))
+        while len(parts) > fan_in:
+            parts = list(pool.map(merge_group, groups(parts)))
+    # the last merge runs here rather than sending its result back from a
+    # worker
+    return merge_group(parts) if len(parts) > 1 else parts[0]
+
+
 class Error(Exception):
     """
     Base Exception class
@@ -65,3 +570,20 @@ class DataError(Error):
 
     def __init__(self, message):
         self.message = message
+
+
+class UnsortedInputError(DataError):
+    """
+    Raised when an input file is expected to be sorted but is not
+    """
+
+    pass
+
+
+class GeneOrderError(DataError):
+    """
+    Raised when gene counts files expected to list genes in the same order
+    do not
+    """
+
+    pass
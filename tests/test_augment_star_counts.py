@@ -1,23 +1,41 @@
+import gzip
+import importlib.util
+import io
 import os
+import tempfile
 import unittest
 
+import numpy as np
 import pandas as pd
 
 from gdc_rnaseq_tools.augment_star_counts import (
+    CountsColumns,
+    GeneAlignment,
+    GeneInfoColumns,
     augment,
+    augment_batch,
     calc_fpkm,
     calc_fpkm_uq,
+    calc_normalized,
     calc_tpm,
+    gene_info_cache_key,
+    gene_selections,
     get_extras,
+    load_batch_jobs,
+    load_gene_info,
     load_table,
     main,
     merge_tables,
     save_result,
     validate_table,
+    write_table,
 )
-from gdc_rnaseq_tools.utils import DataFormatError, get_logger
+from gdc_rnaseq_tools.cache import DiskCache
+from gdc_rnaseq_tools.utils import DataFormatError, Error, get_logger
 from tests.fakearg import FakeArgs
 
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
 
 class TestAugmentStarCounts(unittest.TestCase):
     df1_raw = pd.DataFrame(
@@ -116,6 +134,30 @@ class TestAugmentStarCounts(unittest.TestCase):
         # print(self.df1_tpm)
         self.assertTrue((tpm == self.df1_tpm).all())
 
+    def test_calc_normalized(self) -> None:
+        """
+        Tests that `calc_normalized` equals the per column functions for
+        every counts column
+        """
+        strands = ["unstranded", "stranded_first", "stranded_second"]
+        tpm, fpkm, fpkm_uq = calc_normalized(
+            np.stack([self.df1_raw[strand].to_numpy() for strand in strands]),
+            self.df1_raw.total_exon_length.to_numpy(),
+            *gene_selections(self.df1_raw.gene_type, self.df1_raw.chromosome),
+        )
+        for i, strand in enumerate(strands):
+            expression = self.df1_raw[strand]
+            length = self.df1_raw.total_exon_length
+            gene_type = self.df1_raw.gene_type
+            np.testing.assert_array_equal(tpm[i], calc_tpm(expression, length))
+            np.testing.assert_array_equal(
+                fpkm[i], calc_fpkm(expression, length, gene_type)
+            )
+            np.testing.assert_array_equal(
+                fpkm_uq[i],
+                calc_fpkm_uq(expression, length, gene_type, self.df1_raw.chromosome),
+            )
+
     def test_load_table(self) -> None:
         """
         Tests the `load_tables` function
@@ -123,6 +165,44 @@ class TestAugmentStarCounts(unittest.TestCase):
         df1 = load_table(self.simple_file)
         pd.testing.assert_frame_equal(df1, self.df1_raw)
 
+    def test_load_table_typed(self) -> None:
+        """
+        Tests typed loading of the schema columns with `load_table`
+        """
+        df1 = load_table(self.simple_file, dtypes=GeneInfoColumns.dtypes())
+        self.assertEqual(list(df1.columns), GeneInfoColumns.cols())
+        self.assertIsInstance(df1.chromosome.dtype, pd.CategoricalDtype)
+        pd.testing.assert_frame_equal(
+            df1.astype({"gene_type": str, "chromosome": str}),
+            self.df1_raw[GeneInfoColumns.cols()],
+        )
+
+        with self.assertRaises(DataFormatError):
+            load_table(self.simple_file, dtypes={"gene_name": "int64"})
+        with self.assertRaises(DataFormatError):
+            load_table(self.ts1_counts_file, dtypes=GeneInfoColumns.dtypes())
+
+    @unittest.skipUnless(HAS_PYARROW, "pyarrow is not installed")
+    def test_load_table_typed_pyarrow(self) -> None:
+        """
+        Tests that the pyarrow engine loads the same tables as the default
+        engine, with and without column headers.
+        """
+        for args in [
+            (self.simple_file, None, GeneInfoColumns.dtypes()),
+            (self.ts1_counts_file, CountsColumns.cols(), CountsColumns.dtypes()),
+        ]:
+            pd.testing.assert_frame_equal(
+                load_table(*args, engine="pyarrow"), load_table(*args)
+            )
+        with self.assertRaises(DataFormatError):
+            load_table(
+                self.ts1_counts_file,
+                CountsColumns.cols()[:3],
+                dtypes=CountsColumns.dtypes(),
+                engine="pyarrow",
+            )
+
     def test_validate_table_good(self) -> None:
         """
         Tests the `validate_tables` function
@@ -155,6 +235,39 @@ class TestAugmentStarCounts(unittest.TestCase):
         )
         pd.testing.assert_frame_equal(merge_tables(df1, df2, on="id"), res)
 
+    def test_gene_alignment(self) -> None:
+        """
+        Tests that `GeneAlignment` gives the same table as `merge_tables` for
+        counts in gene info order, in another order with missing and extra
+        genes, and with repeated gene IDs.
+        """
+        gene_info = load_table(self.ts1_gene_info_file)
+        counts = load_table(self.ts1_counts_file, CountsColumns.cols())
+        alignment = GeneAlignment(gene_info)
+
+        merged = alignment.merge(counts)
+        self.assertIsInstance(alignment.rows[0], slice)
+        pd.testing.assert_frame_equal(
+            merge_tables(gene_info, counts, on="gene_id"), merged
+        )
+        # the same gene order reuses the rows found for the first table
+        rows = alignment.rows
+        alignment.merge(counts)
+        self.assertIs(rows, alignment.rows)
+
+        shuffled = counts.sample(frac=0.9, random_state=1).reset_index(drop=True)
+        shuffled.loc[0, "gene_id"] = "ENSG_NOT_IN_GENE_INFO"
+        pd.testing.assert_frame_equal(
+            merge_tables(gene_info, shuffled, on="gene_id"),
+            alignment.merge(shuffled),
+        )
+
+        repeated = pd.concat([counts, counts.iloc[[10]]], ignore_index=True)
+        pd.testing.assert_frame_equal(
+            merge_tables(gene_info, repeated, on="gene_id"),
+            alignment.merge(repeated),
+        )
+
     def test_get_extras(self) -> None:
         """
         Tests the `get_extras` function
@@ -184,6 +297,62 @@ class TestAugmentStarCounts(unittest.TestCase):
         )
         self.assertEqual(expected, res_lines)
 
+    def test_save_result_gzip(self) -> None:
+        """
+        Test that `save_result` compresses outputs named .gz
+        """
+        outfile = "save_results_output.tsv.gz"
+        self.to_remove.append(outfile)
+
+        testdf = pd.DataFrame({"id": [1, 2], "A": ["one", "two"]})
+        save_result(df=testdf, outfile=outfile, gencode_version=36)
+
+        with gzip.open(outfile, "rt") as result:
+            res_lines = result.read()
+        self.assertEqual(
+            "# gene-model: GENCODE v36\nid\tA\n1\tone\n2\ttwo\n", res_lines
+        )
+
+    def test_write_table(self) -> None:
+        """
+        Tests that `write_table` writes the same bytes as `DataFrame.to_csv`,
+        including missing values and cells that need quoting
+        """
+        df = pd.concat(
+            [get_extras(self.df1_raw), self.df1_raw], axis=0, ignore_index=True
+        )
+        df = df.drop(columns=["total_exon_length", "chromosome"])
+        df.loc[4:, "tpm_unstranded"] = self.df1_tpm.to_numpy() / 3
+        df.loc[5, "gene_name"] = 'with "quotes"'
+        df.loc[9, "gene_name"] = "with\ttab"
+
+        for rows in [2, 100]:
+            expected = io.StringIO()
+            df.to_csv(expected, sep="\t", index=False, float_format="%.4f")
+            result = io.StringIO()
+            write_table(df, result, float_format="%.4f", chunk_rows=rows)
+            self.assertEqual(expected.getvalue(), result.getvalue())
+
+    def test_write_table_nullable(self) -> None:
+        """
+        Tests that `write_table` writes nullable number columns with missing
+        values like `DataFrame.to_csv`
+        """
+        df = pd.DataFrame(
+            {
+                "gene_id": ["g1", "g2", "g3", "g4"],
+                "unstranded": pd.array([1, None, 3, 4], dtype="Int64"),
+                "stranded": pd.array([2, 5, None, 7], dtype="UInt32"),
+                "tpm": pd.array([0.5, 1.25, None, 2.0], dtype="Float64"),
+            }
+        )
+        for rows in [2, 100]:
+            expected = io.StringIO()
+            df.to_csv(expected, sep="\t", index=False, float_format="%.4f")
+            result = io.StringIO()
+            write_table(df, result, float_format="%.4f", chunk_rows=rows)
+            self.assertEqual(expected.getvalue(), result.getvalue())
+
     def test_augment(self) -> None:
         """
         Tests `augment` function
@@ -199,6 +368,116 @@ class TestAugmentStarCounts(unittest.TestCase):
             logger=self.logger,
         )
 
+    def test_augment_all_strands(self) -> None:
+        """
+        Tests that `augment` adds normalized stranded counts after the
+        default columns when asked
+        """
+        outfile = "augment_all_strands.tsv"
+        self.to_remove.append(outfile)
+
+        augment(
+            counts_file=self.ts1_counts_file,
+            gene_info_file=self.ts1_gene_info_file,
+            outfile=outfile,
+            gencode_version=36,
+            logger=self.logger,
+            all_strands=True,
+        )
+        result = pd.read_table(outfile, comment="#")
+        expected = pd.read_table(self.ts1_final_file, comment="#")
+        pd.testing.assert_frame_equal(result[expected.columns], expected)
+        self.assertEqual(
+            list(result.columns[len(expected.columns) :]),
+            [
+                "tpm_stranded_first",
+                "tpm_stranded_second",
+                "fpkm_stranded_first",
+                "fpkm_stranded_second",
+                "fpkm_uq_stranded_first",
+                "fpkm_uq_stranded_second",
+            ],
+        )
+
+    def test_augment_report_memory(self) -> None:
+        """
+        Tests that `augment` logs the peak RSS of each stage
+        """
+        outfile = "augment_report_memory.tsv"
+        self.to_remove.append(outfile)
+
+        with self.assertLogs(self.logger, level="INFO") as logs:
+            augment(
+                counts_file=self.ts1_counts_file,
+                gene_info_file=self.ts1_gene_info_file,
+                outfile=outfile,
+                gencode_version=36,
+                logger=self.logger,
+                report_memory=True,
+            )
+        stages = [
+            line.split("Peak RSS after ")[1].split(":")[0]
+            for line in logs.output
+            if "Peak RSS after " in line
+        ]
+        self.assertEqual(
+            stages,
+            [
+                "reading counts",
+                "reading gene info",
+                "merging",
+                "normalizing",
+                "assembling output",
+                "saving results",
+            ],
+        )
+        result = pd.read_table(outfile, comment="#")
+        expected = pd.read_table(self.ts1_final_file, comment="#")
+        pd.testing.assert_frame_equal(result, expected)
+
+    def test_augment_batch_report_memory(self) -> None:
+        """
+        Tests that a batch in worker processes logs the peak RSS of the
+        worker after each sample
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            jobs = [
+                (self.ts1_counts_file, os.path.join(tmp, "1.tsv")),
+                (self.ts1_counts_file, os.path.join(tmp, "2.tsv")),
+            ]
+            with self.assertLogs(self.logger, level="INFO") as logs:
+                failures = augment_batch(
+                    jobs,
+                    self.ts1_gene_info_file,
+                    36,
+                    self.logger,
+                    processes=2,
+                    report_memory=True,
+                )
+        self.assertEqual([], failures)
+        peaks = [
+            line for line in logs.output if "Peak RSS of the worker after " in line
+        ]
+        self.assertEqual(2, len(peaks))
+        self.assertTrue(all(self.ts1_counts_file in line for line in peaks))
+
+    def test_load_gene_info_cache(self) -> None:
+        """
+        Tests that cached gene info tables equal freshly parsed ones and are
+        keyed by gencode version.
+        """
+        expected = load_table(self.ts1_gene_info_file, dtypes=GeneInfoColumns.dtypes())
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DiskCache(tmp)
+            key = gene_info_cache_key(self.ts1_gene_info_file, 36)
+            self.assertNotEqual(key, gene_info_cache_key(self.ts1_gene_info_file, 38))
+
+            parsed = load_gene_info(self.ts1_gene_info_file, 36, cache)
+            self.assertIsNotNone(cache.get(key))
+            cached = load_gene_info(self.ts1_gene_info_file, 36, cache)
+            pd.testing.assert_frame_equal(expected, parsed)
+            pd.testing.assert_frame_equal(expected, cached)
+
     def test_full_run(self) -> None:
         """
         Full end-to-end test
@@ -219,6 +498,102 @@ class TestAugmentStarCounts(unittest.TestCase):
         expected = pd.read_table(self.ts1_final_file, comment="#")
         pd.testing.assert_frame_equal(result, expected)
 
+    def test_load_batch_jobs(self) -> None:
+        """
+        Tests pairing counts files with outputs from a list and a directory.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            input_list = os.path.join(tmp, "list.tsv")
+            with open(input_list, "wt") as o:
+                o.write("b.tsv.gz\tout/b.tsv\n# comment\nc.tab\n")
+            jobs = load_batch_jobs(["a.tsv"], input_list, "outdir")
+            self.assertEqual(
+                [
+                    ("a.tsv", os.path.join("outdir", "a.augmented.tsv")),
+                    ("b.tsv.gz", "out/b.tsv"),
+                    ("c.tab", os.path.join("outdir", "c.augmented.tsv")),
+                ],
+                jobs,
+            )
+            with self.assertRaises(ValueError):
+                load_batch_jobs(["a.tsv"], input_list)
+            with self.assertRaises(ValueError):
+                load_batch_jobs(["a.tsv", "x/a.tsv"], output_dir="outdir")
+
+    def test_augment_batch(self) -> None:
+        """
+        Tests that a batch writes the same outputs as single runs and reports
+        a failed sample without stopping the others.
+        """
+        expected = pd.read_table(self.ts1_final_file, comment="#")
+        with tempfile.TemporaryDirectory() as tmp:
+            bad = os.path.join(tmp, "bad.tsv")
+            with open(bad, "wt") as o:
+                o.write("not\ta\tcounts\tfile\tat all\n")
+            jobs = [
+                (self.ts1_counts_file, os.path.join(tmp, "1.tsv")),
+                (bad, os.path.join(tmp, "bad.out.tsv")),
+                (self.ts1_counts_file, os.path.join(tmp, "2.tsv")),
+            ]
+            for processes in [1, 2]:
+                failures = augment_batch(
+                    jobs, self.ts1_gene_info_file, 36, self.logger, processes
+                )
+                self.assertEqual([bad], [fil for fil, _ in failures])
+                for name in ["1.tsv", "2.tsv"]:
+                    result = pd.read_table(os.path.join(tmp, name), comment="#")
+                    pd.testing.assert_frame_equal(result, expected)
+                    os.remove(os.path.join(tmp, name))
+
+            args = FakeArgs()
+            args.input = [self.ts1_counts_file, bad]
+            args.gene_info = self.ts1_gene_info_file
+            args.output_dir = os.path.join(tmp, "batch")
+            args.gencode_version = 36
+            args.processes = 2
+            with self.assertRaises(Error):
+                main(args)
+            result = pd.read_table(
+                os.path.join(tmp, "batch", "test_set_1.counts.augmented.tsv"),
+                comment="#",
+            )
+            pd.testing.assert_frame_equal(result, expected)
+
+    def test_full_run_cached(self) -> None:
+        """
+        Tests that reruns with a result cache serve the outputs of samples
+        augmented before, and report failed samples, including missing
+        inputs, without caching them.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            bad = os.path.join(tmp, "bad.tsv")
+            with open(bad, "wt") as o:
+                o.write("not\ta\tcounts\tfile\tat all\n")
+            missing = os.path.join(tmp, "missing.tsv")
+            args = FakeArgs()
+            args.input = [missing, self.ts1_counts_file, bad]
+            args.gene_info = self.ts1_gene_info_file
+            args.output_dir = os.path.join(tmp, "batch")
+            args.gencode_version = 36
+            args.cache_dir = os.path.join(tmp, "cache")
+            output = os.path.join(tmp, "batch", "test_set_1.counts.augmented.tsv")
+            for _ in range(2):
+                with self.assertRaisesRegex(Error, "2 of 3 samples failed") as e:
+                    main(args)
+                self.assertIn(missing + ", " + bad, str(e.exception))
+                self.assertEqual(1, len(os.listdir(args.cache_dir)))
+            with open(output, "rb") as fh:
+                expected = fh.read()
+
+            args.input = self.ts1_counts_file
+            args.output_dir = None
+            args.output = output
+            with self.assertLogs(level="INFO") as logs:
+                main(args)
+            self.assertTrue(any("result cache" in line for line in logs.output))
+            with open(output, "rb") as fh:
+                self.assertEqual(expected, fh.read())
+
     def setUp(self) -> None:
         pass
 
@@ -0,0 +1,149 @@
+import gzip
+import os
+import unittest
+
+from gdc_rnaseq_tools.bgzf import (
+    BLOCK_SIZE,
+    BgzfReader,
+    BgzfWriter,
+    ParallelBgzfWriter,
+)
+from gdc_rnaseq_tools.utils import (
+    DataFormatError,
+    ReadAheadReader,
+    configure_gzip,
+    get_open_function,
+)
+
+
+class TestBgzf(unittest.TestCase):
+    out_test_pfx = os.path.join(os.path.dirname(__file__), "etc/test_bgzf_out")
+    to_remove = []
+
+    def test_round_trip(self) -> None:
+        """
+        Tests that BGZF output is readable by gzip and by `BgzfReader`.
+        """
+        path = self.out_test_pfx + ".txt.gz"
+        self.to_remove.append(path)
+        lines = ["line {0}\t{1}\n".format(i, "x" * (i % 50)) for i in range(5000)]
+        offsets = []
+        with BgzfWriter(path) as o:
+            for line in lines:
+                offsets.append(o.tell())
+                o.write(line.encode())
+
+        self.assertGreater(o.block_address, 0)
+        with gzip.open(path, "rt") as fh:
+            self.assertEqual("".join(lines), fh.read())
+
+        with BgzfReader(path) as fh:
+            self.assertEqual(lines, [line.decode() for line in fh])
+            for i in [4999, 0, 2500, 1234]:
+                fh.seek(offsets[i])
+                self.assertEqual(offsets[i], fh.tell())
+                self.assertEqual(lines[i], fh.readline().decode())
+
+    def test_block_boundary(self) -> None:
+        """
+        Tests offsets of a line that starts exactly at a block boundary.
+        """
+        path = self.out_test_pfx + ".boundary.gz"
+        self.to_remove.append(path)
+        with BgzfWriter(path) as o:
+            o.write(b"a" * (BLOCK_SIZE - 1) + b"\n")
+            offset = o.tell()
+            o.write(b"next\n")
+
+        self.assertEqual(0, offset & 0xFFFF)
+        with BgzfReader(path) as fh:
+            fh.readline()
+            self.assertEqual(offset, fh.tell())
+            self.assertEqual(b"next\n", fh.readline())
+            self.assertEqual(b"", fh.readline())
+
+    def test_parallel_writer(self) -> None:
+        """
+        Tests that the threaded writer writes the blocks of `BgzfWriter`,
+        whatever the number of threads and the size of the writes.
+        """
+        serial = self.out_test_pfx + ".serial.gz"
+        self.to_remove.append(serial)
+        data = b"".join(
+            "line {0}\t{1}\n".format(i, "x" * (i % 50)).encode() for i in range(20000)
+        )
+        with BgzfWriter(serial) as o:
+            o.write(data)
+        with open(serial, "rb") as fh:
+            expected = fh.read()
+
+        path = self.out_test_pfx + ".parallel.gz"
+        self.to_remove.append(path)
+        for threads in [1, 3]:
+            for size in [1000, BLOCK_SIZE, 3 * BLOCK_SIZE + 7]:
+                with ParallelBgzfWriter(path, threads=threads) as o:
+                    for start in range(0, len(data), size):
+                        o.write(data[start : start + size])
+                        o.flush()
+                with open(path, "rb") as fh:
+                    self.assertEqual(expected, fh.read())
+
+    def test_open_function(self) -> None:
+        """
+        Tests that .gz outputs of `get_open_function` are BGZF and
+        readable by gzip, with and without read-ahead.
+        """
+        path = self.out_test_pfx + ".text.gz"
+        self.to_remove.append(path)
+        lines = ["gene{0}\t{1}\n".format(i, i * 3) for i in range(30000)]
+        try:
+            for read_ahead in [True, False]:
+                configure_gzip(threads=2, level=1, read_ahead=read_ahead)
+                with get_open_function(path)(path, "wt") as o:
+                    o.writelines(lines)
+                with get_open_function(path)(path, "rt") as fh:
+                    self.assertEqual(lines, fh.readlines())
+        finally:
+            configure_gzip(level=6)
+
+        with BgzfReader(path) as fh:
+            self.assertEqual(lines, [line.decode() for line in fh])
+
+    def test_read_ahead(self) -> None:
+        """
+        Tests that `ReadAheadReader` reads gzip and BGZF files, reports
+        truncated files and stops its thread when closed early.
+        """
+        data = b"".join(
+            "chr{0}\t{1}\t{2}\n".format(i % 22, i, i * 7).encode() for i in range(50000)
+        )
+        plain = self.out_test_pfx + ".plain.gz"
+        bgzf = self.out_test_pfx + ".blocked.gz"
+        truncated = self.out_test_pfx + ".truncated.gz"
+        self.to_remove.extend([plain, bgzf, truncated])
+        with gzip.open(plain, "wb") as o:
+            o.write(data)
+        with ParallelBgzfWriter(bgzf, threads=2) as o:
+            o.write(data)
+
+        for path in [plain, bgzf]:
+            for threads in [1, 3]:
+                with ReadAheadReader(path, threads, chunk_size=100000) as fh:
+                    self.assertEqual(data, fh.read())
+            with ReadAheadReader(path, chunk_size=1000) as fh:
+                self.assertEqual(data[:10], fh.read(10))
+            self.assertFalse(fh.thread.is_alive())
+
+            with open(path, "rb") as fh, open(truncated, "wb") as o:
+                o.write(fh.read()[:-1000])
+            with ReadAheadReader(truncated) as fh:
+                with self.assertRaises((EOFError, DataFormatError)):
+                    fh.read()
+
+    def setUp(self) -> None:
+        pass
+
+    def tearDown(self) -> None:
+        for fil in self.to_remove:
+            if os.path.exists(fil):
+                os.remove(fil)
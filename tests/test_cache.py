@@ -0,0 +1,151 @@
+import os
+import tempfile
+import time
+import unittest
+
+from gdc_rnaseq_tools.cache import (
+    TMP_PREFIX,
+    DiskCache,
+    cached_run,
+    file_digest,
+    result_key,
+)
+
+
+def write_bytes(path):
+    with open(path, "wb") as o:
+        o.write(b"x" * 10)
+
+
+class TestDiskCache(unittest.TestCase):
+    def test_put_get(self) -> None:
+        """
+        Tests publishing and reading entries.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DiskCache(os.path.join(tmp, "cache"))
+            self.assertIsNone(cache.get("a"))
+
+            def write(path):
+                with open(path, "wt") as o:
+                    o.write("value")
+
+            path = cache.put("a", write)
+            self.assertEqual(path, cache.get("a"))
+            with open(path, "rt") as fh:
+                self.assertEqual("value", fh.read())
+            self.assertEqual(["a"], os.listdir(cache.directory))
+
+    def test_put_failure(self) -> None:
+        """
+        Tests that a failed write leaves no entry or temporary file.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DiskCache(tmp)
+
+            def write(path):
+                with open(path, "wt") as o:
+                    o.write("partial")
+                raise ValueError("failed")
+
+            with self.assertRaises(ValueError):
+                cache.put("a", write)
+            self.assertEqual([], os.listdir(tmp))
+
+    def test_evict_least_recently_used(self) -> None:
+        """
+        Tests that the least recently used entries are evicted first, and
+        stale temporary files are removed.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DiskCache(tmp, max_size=25)
+            for i, key in enumerate(["a", "b"]):
+                path = cache.put(key, write_bytes)
+                os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+            stale = os.path.join(tmp, TMP_PREFIX + "old")
+            open(stale, "wb").close()
+            os.utime(stale, (0, 0))
+
+            # reading a makes b the least recently used entry
+            cache.get("a")
+            cache.put("c", write_bytes)
+            self.assertEqual(["a", "c"], sorted(os.listdir(tmp)))
+
+    def test_file_digest(self) -> None:
+        """
+        Tests hashing file content.
+        """
+        with tempfile.NamedTemporaryFile() as fh:
+            fh.write(b"abc")
+            fh.flush()
+            self.assertEqual(
+                "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad",
+                file_digest(fh.name, chunk_size=2).hexdigest(),
+            )
+
+    def test_result_key(self) -> None:
+        """
+        Tests that result keys depend on options and input content, not on
+        input names.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            first = os.path.join(tmp, "first")
+            second = os.path.join(tmp, "second")
+            write_bytes(first)
+            write_bytes(second)
+            key = result_key("tool", {"a": 1}, [first])
+            self.assertEqual(key, result_key("tool", {"a": 1}, [second]))
+            self.assertNotEqual(key, result_key("tool", {"a": 2}, [first]))
+            self.assertNotEqual(key, result_key("other", {"a": 1}, [first]))
+            with open(second, "ab") as o:
+                o.write(b"y")
+            self.assertNotEqual(key, result_key("tool", {"a": 1}, [second]))
+
+    def test_cached_run(self) -> None:
+        """
+        Tests that a cached run serves all its outputs without running, and
+        runs again once one of them is evicted.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = DiskCache(os.path.join(tmp, "cache"))
+            outputs = [os.path.join(tmp, "out"), os.path.join(tmp, "out.idx")]
+            runs = []
+
+            def run():
+                runs.append(True)
+                for i, output in enumerate(outputs):
+                    with open(output, "wt") as o:
+                        o.write("output {0}".format(i))
+
+            self.assertFalse(cached_run(cache, "key", outputs, run))
+            for output in outputs:
+                os.remove(output)
+            self.assertTrue(cached_run(cache, "key", outputs, run))
+            self.assertEqual(1, len(runs))
+            for i, output in enumerate(outputs):
+                with open(output, "rt") as fh:
+                    self.assertEqual("output {0}".format(i), fh.read())
+
+            os.remove(cache.path("key.1"))
+            self.assertFalse(cached_run(cache, "key", outputs, run))
+            self.assertEqual(2, len(runs))
+            self.assertEqual(["key", "key.1"], sorted(os.listdir(cache.directory)))
+
+            # a run with another key does not write through links to entries
+            def rerun():
+                for output in outputs:
+                    with open(output, "wt") as o:
+                        o.write("changed")
+
+            self.assertFalse(cached_run(cache, "other", outputs, rerun))
+            with open(cache.path("key"), "rt") as fh:
+                self.assertEqual("output 0", fh.read())
+
+            # outputs served from the cache and then rewritten in place by a
+            # run without the cache leave the entries unchanged
+            self.assertTrue(cached_run(cache, "key", outputs, run))
+            rerun()
+            self.assertTrue(cached_run(cache, "key", outputs, run))
+            for i, output in enumerate(outputs):
+                with open(output, "rt") as fh:
+                    self.assertEqual("output {0}".format(i), fh.read())
@@ -0,0 +1,133 @@
+import gzip
+import os
+import random
+import unittest
+
+from gdc_rnaseq_tools.count_arrays import (
+    GeneCounts,
+    merge_count_files,
+    merge_gene_counts,
+)
+from gdc_rnaseq_tools.merge_counts import main
+from gdc_rnaseq_tools.utils import DataFormatError
+from tests.fakearg import FakeArgs
+
+
+class TestCountArrays(unittest.TestCase):
+    star_counts_1 = os.path.join(
+        os.path.dirname(__file__), "etc/test_star_counts_input_1.tsv.gz"
+    )
+    star_counts_2 = os.path.join(
+        os.path.dirname(__file__), "etc/test_star_counts_input_2.tsv.gz"
+    )
+    exp_star_1_2 = os.path.join(
+        os.path.dirname(__file__), "etc/exp_star_counts_output_1_2.tsv.gz"
+    )
+    out_test_pfx = os.path.join(os.path.dirname(__file__), "etc/test_count_arrays_out")
+    to_remove = []
+
+    def test_from_bytes(self) -> None:
+        """
+        Tests parsing lines into gene names and a counts array.
+        """
+        table = GeneCounts.from_bytes(b"N_noFeature\t5\t6\t7\nGENE1\t0\t12\t3\n")
+        self.assertEqual([b"N_noFeature", b"GENE1"], table.genes)
+        self.assertEqual(3, table.width)
+        self.assertEqual([[5, 6, 7], [0, 12, 3]], table.counts.tolist())
+
+        with self.assertRaises(DataFormatError):
+            GeneCounts.from_bytes(b"GENE1\t1\t2\t3\nGENE2\t1\t2\n")
+        with self.assertRaises(DataFormatError):
+            GeneCounts.from_bytes(b"GENE1\t1\tx\t3\n")
+
+    def test_merge_gene_counts(self) -> None:
+        """
+        Tests summing tables with shared, new and reordered genes and any
+        number of columns.
+        """
+        merged = merge_gene_counts(
+            [
+                GeneCounts.from_bytes(b"B\t1\t2\t3\t4\t5\nA\t1\t1\t1\t1\t1\n"),
+                GeneCounts.from_bytes(b"B\t1\t0\t0\t0\t0\nA\t0\t0\t0\t0\t2\n"),
+                GeneCounts.from_bytes(b"C\t9\t9\t9\t9\t9\nB\t1\t1\t1\t1\t1\n"),
+            ]
+        )
+        self.assertEqual([b"B", b"A", b"C"], merged.genes)
+        self.assertEqual(
+            [[3, 3, 4, 5, 6], [1, 1, 1, 1, 3], [9, 9, 9, 9, 9]],
+            merged.counts.tolist(),
+        )
+
+        with self.assertRaises(DataFormatError):
+            merge_gene_counts(
+                [GeneCounts.from_bytes(b"A\t1\t2\n"), GeneCounts.from_bytes(b"A\t1\n")]
+            )
+
+    def test_merge_count_files_parallel(self) -> None:
+        """
+        Tests that parsing in worker processes gives the same result.
+        """
+        files = [self.star_counts_1, self.star_counts_2]
+        serial = merge_count_files(files)
+        parallel = merge_count_files(files, processes=2)
+        self.assertEqual(serial.genes, parallel.genes)
+        self.assertEqual(serial.counts.tolist(), parallel.counts.tolist())
+
+    def test_full_numpy_engine(self) -> None:
+        """
+        Tests from main() entry with the numpy engine.
+        """
+        args = FakeArgs()
+        args.input = [self.star_counts_1, self.star_counts_2]
+        args.output = self.out_test_pfx + ".1_2.tsv.gz"
+        args.engine = "numpy"
+        self.to_remove.append(args.output)
+        main(args)
+        with gzip.open(self.exp_star_1_2, "rt") as fh, gzip.open(
+            args.output, "rt"
+        ) as ofh:
+            self.assertEqual(fh.read(), ofh.read())
+
+    def test_numpy_engine_matches_python(self) -> None:
+        """
+        Tests that both engines write identical output for inputs with
+        summary rows, differing gene sets and four count columns.
+        """
+        rng = random.Random(5)
+        inputs = []
+        for i in range(3):
+            fil = self.out_test_pfx + ".random_{0}.tsv".format(i)
+            self.to_remove.append(fil)
+            inputs.append(fil)
+            genes = ["N_unmapped", "N_multimapping"] + [
+                "ENSG{0:011d}.{1}".format(j, j % 7)
+                for j in range(200)
+                if rng.random() < 0.9
+            ]
+            with open(fil, "wt") as o:
+                for gene in genes:
+                    row = [gene] + [rng.randint(0, 10**6) for _ in range(4)]
+                    o.write("\t".join(map(str, row)) + "\n")
+
+        outputs = []
+        for engine in ["python", "numpy"]:
+            args = FakeArgs()
+            args.input = inputs
+            args.output = self.out_test_pfx + ".{0}.tsv".format(engine)
+            args.engine = engine
+            self.to_remove.append(args.output)
+            main(args)
+            with open(args.output, "rt") as fh:
+                outputs.append(fh.read())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertTrue(
+            outputs[0].startswith("#gene\t") and "\tcount_4\n" in outputs[0]
+        )
+
+    def setUp(self) -> None:
+        pass
+
+    def tearDown(self) -> None:
+        for fil in self.to_remove:
+            if os.path.exists(fil):
+                os.remove(fil)
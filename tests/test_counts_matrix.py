@@ -0,0 +1,102 @@
+import os
+import unittest
+
+import numpy as np
+
+from gdc_rnaseq_tools.augment_star_counts import load_table
+from gdc_rnaseq_tools.counts_matrix import (
+    build_counts_matrix,
+    index_path,
+    load_counts_matrix,
+    main,
+    read_sample_counts,
+)
+from gdc_rnaseq_tools.utils import DataError
+from tests.fakearg import FakeArgs
+
+
+class TestCountsMatrix(unittest.TestCase):
+    counts = os.path.join(os.path.dirname(__file__), "etc/test_set_1.counts.tsv.gz")
+    final = os.path.join(os.path.dirname(__file__), "etc/test_set_1.final.tsv.gz")
+    star_counts_1 = os.path.join(
+        os.path.dirname(__file__), "etc/test_star_counts_input_1.tsv.gz"
+    )
+    out_test_pfx = os.path.join(os.path.dirname(__file__), "etc/test_counts_matrix_out")
+    to_remove = []
+
+    def test_read_sample_counts(self) -> None:
+        """
+        Tests reading headerless and headed tables like `load_table`.
+        """
+        genes, counts = read_sample_counts(self.counts, "stranded_second")
+        df = load_table(self.counts, ["gene_id", "u", "f", "stranded_second"])
+        self.assertEqual(df["gene_id"].tolist(), genes)
+        self.assertEqual(df["stranded_second"].tolist(), counts.tolist())
+        self.assertEqual("int64", counts.dtype.name)
+
+        genes, counts = read_sample_counts(self.final)
+        df = load_table(self.final)
+        self.assertEqual(df["gene_id"].tolist(), genes)
+        self.assertEqual(df["unstranded"].tolist(), counts.tolist())
+
+    def test_build_and_append(self) -> None:
+        """
+        Tests building a matrix, appending samples in another gene order and
+        that a failed append leaves the matrix unchanged.
+        """
+        output = self.out_test_pfx + ".npy"
+        self.to_remove.extend([output, index_path(output)])
+        build_counts_matrix([self.counts, self.counts], ["a", "b"], output)
+        matrix, index = load_counts_matrix(output)
+        self.assertEqual((100, 2), matrix.shape)
+        self.assertEqual(["a", "b"], index["samples"])
+        self.assertEqual("N_unmapped", index["genes"][0])
+
+        build_counts_matrix([self.final], ["c"], output, append=True)
+        matrix, index = load_counts_matrix(output)
+        self.assertEqual((100, 3), matrix.shape)
+        self.assertEqual(["a", "b", "c"], index["samples"])
+        self.assertEqual(matrix[:, 0].tolist(), matrix[:, 2].tolist())
+        genes, counts = read_sample_counts(self.counts)
+        self.assertEqual(counts.tolist(), matrix[:, 1].tolist())
+        del matrix
+
+        size = os.path.getsize(output)
+        with self.assertRaises(DataError):
+            build_counts_matrix([self.star_counts_1], ["d"], output, append=True)
+        with self.assertRaises(DataError):
+            build_counts_matrix([self.counts], ["a"], output, append=True)
+        self.assertEqual(size, os.path.getsize(output))
+        matrix, index = load_counts_matrix(output)
+        self.assertEqual((100, 3), matrix.shape)
+
+    def test_full(self) -> None:
+        """
+        Tests from main() entry with an input list.
+        """
+        input_list = self.out_test_pfx + ".list.tsv"
+        output = self.out_test_pfx + ".main.npy"
+        self.to_remove.extend([input_list, output, index_path(output)])
+        with open(input_list, "wt") as o:
+            o.write("{0}\tsample1\n{1}\n".format(self.counts, self.final))
+
+        args = FakeArgs()
+        args.input = None
+        args.input_list = input_list
+        args.output = output
+        args.column = "stranded_first"
+        main(args)
+        matrix = np.load(output)
+        self.assertEqual((100, 2), matrix.shape)
+        self.assertTrue(np.isfortran(matrix))
+        _, index = load_counts_matrix(output)
+        self.assertEqual(["sample1", "test_set_1.final"], index["samples"])
+        self.assertEqual("stranded_first", index["column"])
+
+    def setUp(self) -> None:
+        pass
+
+    def tearDown(self) -> None:
+        for fil in self.to_remove:
+            if os.path.exists(fil):
+                os.remove(fil)
@@ -0,0 +1,127 @@
+import gzip
+import os
+import random
+import unittest
+
+from gdc_rnaseq_tools.junction_arrays import JunctionArrays, merge_junction_files
+from gdc_rnaseq_tools.merge_junctions import main
+from gdc_rnaseq_tools.utils import DataFormatError
+from tests.fakearg import FakeArgs
+
+
+class TestJunctionArrays(unittest.TestCase):
+    star_junctions_1 = os.path.join(
+        os.path.dirname(__file__), "etc/test_star_junctions_input_1.tsv.gz"
+    )
+    star_junctions_2 = os.path.join(
+        os.path.dirname(__file__), "etc/test_star_junctions_input_2.tsv.gz"
+    )
+    exp_star_1_2 = os.path.join(
+        os.path.dirname(__file__), "etc/exp_star_junctions_output_1_2.tsv.gz"
+    )
+    out_test_pfx = os.path.join(
+        os.path.dirname(__file__), "etc/test_junction_arrays_out"
+    )
+    to_remove = []
+
+    def test_from_bytes(self) -> None:
+        """
+        Tests parsing lines into typed arrays.
+        """
+        data = b"chr2\t100\t200\t1\t1\t1\t1\t0\t23\nchr1\t5\t9\t2\t0\t0\t3\t2\t20\n"
+        table = JunctionArrays.from_bytes(data)
+        self.assertEqual(2, len(table))
+        self.assertEqual(["chr1", "chr2"], table.chromosomes)
+        self.assertEqual([1, 0], table.chrom.tolist())
+        self.assertEqual([100, 5], table.intron_first.tolist())
+        self.assertEqual([0, 2], table.n_multi_mapped.tolist())
+        self.assertEqual("int8", table.strand.dtype.name)
+        self.assertEqual("int32", table.intron_last.dtype.name)
+
+    def test_from_bytes_bad(self) -> None:
+        """
+        Tests that malformed lines raise `DataFormatError`.
+        """
+        with self.assertRaises(DataFormatError):
+            JunctionArrays.from_bytes(b"chr1\t100\t200\t1\n")
+        with self.assertRaises(DataFormatError):
+            JunctionArrays.from_bytes(b"chr1\t100\t200\t1\t1\t1\tx\t0\t23\n")
+
+    def test_merge_junction_files(self) -> None:
+        """
+        Tests merging junction files into sorted, summed arrays.
+        """
+        merged = merge_junction_files([self.star_junctions_1, self.star_junctions_2])
+        self.assertEqual(["chr1", "chr10", "chr12"], merged.chromosomes)
+        self.assertEqual([2, 3, 1], merged.n_unique_mapped.tolist())
+        self.assertEqual([0, 6, 3], merged.n_multi_mapped.tolist())
+        self.assertEqual([23, 23, 23], merged.max_splice_overhang.tolist())
+
+        parallel = merge_junction_files(
+            [self.star_junctions_1, self.star_junctions_2], processes=2
+        )
+        self.assertEqual(
+            merged.n_multi_mapped.tolist(), parallel.n_multi_mapped.tolist()
+        )
+
+    def test_full_numpy_engine(self) -> None:
+        """
+        Tests from main() entry with the numpy engine.
+        """
+        args = FakeArgs()
+        args.input = [self.star_junctions_1, self.star_junctions_2]
+        args.output = self.out_test_pfx + ".1_2.tsv.gz"
+        args.engine = "numpy"
+        self.to_remove.append(args.output)
+        main(args)
+        with gzip.open(self.exp_star_1_2, "rt") as fh, gzip.open(
+            args.output, "rt"
+        ) as ofh:
+            self.assertEqual(fh.read(), ofh.read())
+
+    def test_numpy_engine_matches_python(self) -> None:
+        """
+        Tests that both engines write identical output for overlapping,
+        unsorted inputs with ties on position.
+        """
+        rng = random.Random(7)
+        inputs = []
+        for i in range(3):
+            fil = self.out_test_pfx + ".random_{0}.tsv".format(i)
+            self.to_remove.append(fil)
+            inputs.append(fil)
+            with open(fil, "wt") as o:
+                for _ in range(500):
+                    start = rng.randint(1, 40) * 10
+                    row = [
+                        "chr{0}".format(rng.choice([1, 2, 10, "X"])),
+                        start,
+                        start + rng.choice([50, 60]),
+                        rng.randint(0, 2),
+                        rng.randint(0, 1),
+                        rng.randint(0, 1),
+                        rng.randint(0, 30),
+                        rng.randint(0, 30),
+                        rng.randint(1, 60),
+                    ]
+                    o.write("\t".join(map(str, row)) + "\n")
+
+        outputs = []
+        for engine in ["python", "numpy"]:
+            args = FakeArgs()
+            args.input = inputs
+            args.output = self.out_test_pfx + ".{0}.tsv".format(engine)
+            args.engine = engine
+            self.to_remove.append(args.output)
+            main(args)
+            with open(args.output, "rt") as fh:
+                outputs.append(fh.read())
+        self.assertEqual(outputs[0], outputs[1])
+
+    def setUp(self) -> None:
+        pass
+
+    def tearDown(self) -> None:
+        for fil in self.to_remove:
+            if os.path.exists(fil):
+                os.remove(fil)
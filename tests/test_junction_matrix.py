@@ -0,0 +1,138 @@
+import os
+import random
+import unittest
+
+import numpy as np
+
+from gdc_rnaseq_tools.junction_arrays import JunctionArrays
+from gdc_rnaseq_tools.junction_matrix import (
+    JunctionCatalog,
+    build_junction_matrix,
+    main,
+    sample_id,
+)
+from tests.fakearg import FakeArgs
+
+
+class TestJunctionMatrix(unittest.TestCase):
+    exp_star_1 = os.path.join(
+        os.path.dirname(__file__), "etc/exp_star_junctions_output_1.tsv.gz"
+    )
+    exp_star_1_2 = os.path.join(
+        os.path.dirname(__file__), "etc/exp_star_junctions_output_1_2.tsv.gz"
+    )
+    out_test_pfx = os.path.join(
+        os.path.dirname(__file__), "etc/test_junction_matrix_out"
+    )
+    to_remove = []
+
+    def test_catalog_lookup(self) -> None:
+        """
+        Tests that IDs are assigned in order of first appearance.
+        """
+        catalog = JunctionCatalog()
+        table1 = JunctionArrays.from_bytes(
+            b"chr2\t5\t9\t1\t1\t1\t1\t0\t1\nchr1\t5\t9\t1\t1\t1\t1\t0\t1\n"
+        )
+        table2 = JunctionArrays.from_bytes(
+            b"chr1\t5\t9\t1\t1\t1\t1\t0\t1\nchr1\t5\t9\t2\t1\t1\t1\t0\t1\n"
+            b"chr3\t1\t2\t1\t1\t1\t1\t0\t1\nchr1\t5\t9\t2\t1\t1\t1\t0\t1\n"
+        )
+        self.assertEqual([0, 1], catalog.lookup(table1).tolist())
+        self.assertEqual([1, 2, 3, 2], catalog.lookup(table2).tolist())
+        self.assertEqual(4, len(catalog))
+
+        columns = catalog.columns()
+        names = [catalog.chromosomes[i] for i in columns["chromosome"]]
+        self.assertEqual(["chr2", "chr1", "chr1", "chr3"], names)
+        self.assertEqual([1, 1, 2, 1], columns["strand"].tolist())
+
+    def test_build_junction_matrix(self) -> None:
+        """
+        Tests building the matrix from merged junction files.
+        """
+        output = self.out_test_pfx + ".npz"
+        self.to_remove.append(output)
+        build_junction_matrix(
+            [self.exp_star_1, self.exp_star_1_2], ["s1", "s12"], output, multi=True
+        )
+        with np.load(output) as npz:
+            self.assertEqual("csc", str(npz["format"]))
+            self.assertEqual([3, 2], npz["shape"].tolist())
+            self.assertEqual(["s1", "s12"], npz["samples"].tolist())
+            self.assertEqual([0, 2, 5], npz["indptr"].tolist())
+            self.assertEqual([0, 1, 0, 1, 2], npz["indices"].tolist())
+            self.assertEqual([1, 1, 2, 3, 1], npz["n_unique_map"].tolist())
+            self.assertEqual([0, 3, 0, 6, 3], npz["n_multi_map"].tolist())
+            self.assertEqual([100, 400, 100], npz["intron_start"].tolist())
+            chroms = npz["chromosomes"][npz["chromosome"]].tolist()
+            self.assertEqual(["chr1", "chr10", "chr12"], chroms)
+
+    def test_full_random(self) -> None:
+        """
+        Tests from main() entry against a dense matrix built in Python.
+        """
+        rng = random.Random(5)
+        keys = [
+            ("chr{0}".format(rng.randint(1, 3)), start, start + 100, 1, 1, 0)
+            for start in range(1, 2000, 10)
+        ]
+        input_list = self.out_test_pfx + ".list.tsv"
+        self.to_remove.append(input_list)
+        dense = dict()
+        with open(input_list, "wt") as lst:
+            for i in range(6):
+                fil = self.out_test_pfx + ".sample_{0}.tsv".format(i)
+                self.to_remove.append(fil)
+                lst.write("{0}\tsample_{1}\n".format(fil, i))
+                with open(fil, "wt") as o:
+                    o.write("#chromosome\tintron_start\n")
+                    for key in rng.sample(keys, 50):
+                        count = rng.randint(0, 20)
+                        dense[(key, i)] = count
+                        o.write("\t".join(map(str, key + (count, 0, 1))) + "\n")
+
+        args = FakeArgs()
+        args.input = None
+        args.input_list = input_list
+        args.output = self.out_test_pfx + ".random.npz"
+        args.multi = False
+        self.to_remove.append(args.output)
+        main(args)
+
+        with np.load(args.output) as npz:
+            self.assertNotIn("n_multi_map", npz.files)
+            chroms = npz["chromosomes"][npz["chromosome"]]
+            found = dict()
+            for col in range(6):
+                start, stop = npz["indptr"][col], npz["indptr"][col + 1]
+                for row, count in zip(
+                    npz["indices"][start:stop], npz["n_unique_map"][start:stop]
+                ):
+                    key = (
+                        str(chroms[row]),
+                        int(npz["intron_start"][row]),
+                        int(npz["intron_end"][row]),
+                        int(npz["strand"][row]),
+                        int(npz["intron_motif"][row]),
+                        int(npz["annotation"][row]),
+                    )
+                    found[(key, col)] = int(count)
+            self.assertEqual(dense, found)
+            self.assertEqual(
+                ["sample_{0}".format(i) for i in range(6)], npz["samples"].tolist()
+            )
+
+    def test_sample_id(self) -> None:
+        """
+        Tests default sample IDs.
+        """
+        self.assertEqual("abc.SJ", sample_id("/path/to/abc.SJ.tsv.gz"))
+
+    def setUp(self) -> None:
+        pass
+
+    def tearDown(self) -> None:
+        for fil in self.to_remove:
+            if os.path.exists(fil):
+                os.remove(fil)
@@ -0,0 +1,85 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from gdc_rnaseq_tools.__main__ import COUNTS_COLUMNS, TOOLS, load_args, load_tool
+from gdc_rnaseq_tools.augment_star_counts import CountsColumns
+
+# Modules the pure Python tools must not import at startup
+HEAVY_MODULES = ["numpy", "pandas"]
+
+STARTUP_SCRIPT = """
+import sys
+from gdc_rnaseq_tools.__main__ import main
+main(sys.argv[1:])
+print(" ".join(name for name in {0!r} if name in sys.modules))
+"""
+
+
+class TestMain(unittest.TestCase):
+    etc = os.path.join(os.path.dirname(__file__), "etc")
+    star_counts = [
+        os.path.join(etc, "test_star_counts_input_1.tsv.gz"),
+        os.path.join(etc, "test_star_counts_input_2.tsv.gz"),
+    ]
+    star_junctions = [
+        os.path.join(etc, "test_star_junctions_input_1.tsv.gz"),
+        os.path.join(etc, "test_star_junctions_input_2.tsv.gz"),
+    ]
+
+    def run_tool(self, argv):
+        """
+        Runs the CLI in a new interpreter and returns the heavy modules it
+        imported.
+        """
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join(
+            [root] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT.format(HEAVY_MODULES)] + argv,
+            capture_output=True,
+            env=env,
+            text=True,
+            check=True,
+        )
+        return result.stdout.split()
+
+    def test_load_args(self) -> None:
+        """
+        Tests that every registered tool parses its arguments and can be
+        loaded.
+        """
+        args = load_args(["merge_star_gene_counts", "-i", "a", "-o", "b"])
+        self.assertEqual(args.choice, "merge_star_gene_counts")
+        self.assertEqual(args.input, ["a"])
+        self.assertEqual(args.gzip_read_ahead, "auto")
+        args = load_args(
+            ["--gzip-read-ahead", "off", "merge_star_gene_counts", "-i", "a", "-o", "b"]
+        )
+        self.assertEqual(args.gzip_read_ahead, "off")
+        for tool in TOOLS:
+            self.assertTrue(callable(load_tool(tool.name).main))
+        self.assertEqual(COUNTS_COLUMNS, CountsColumns.cols()[1:])
+
+    def test_startup_imports(self) -> None:
+        """
+        Tests that the merge tools run without importing NumPy or pandas.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "counts.tsv")
+            argv = ["merge_star_gene_counts", "-o", output]
+            for fil in self.star_counts:
+                argv += ["-i", fil]
+            self.assertEqual(self.run_tool(argv), [])
+            self.assertTrue(os.path.exists(output))
+
+            output = os.path.join(tmp, "junctions.tsv")
+            argv = ["merge_star_junctions", "-o", output]
+            for fil in self.star_junctions:
+                argv += ["-i", fil]
+            self.assertEqual(self.run_tool(argv), [])
+            self.assertTrue(os.path.exists(output))
@@ -1,9 +1,24 @@
 import gzip
 import os
+import random
 import unittest
 from collections import OrderedDict
 
-from gdc_rnaseq_tools.merge_counts import load_star_file, main, merge_star_counts
+from gdc_rnaseq_tools.merge_counts import (
+    gene_order_fingerprint,
+    load_star_file,
+    load_star_files,
+    lockstep_merge_counts,
+    main,
+    merge_star_counts,
+    reduce_star_files,
+)
+from gdc_rnaseq_tools.utils import (
+    DataError,
+    DataFormatError,
+    GeneOrderError,
+    iter_star_counts,
+)
 from tests.fakearg import FakeArgs
 
 
@@ -64,6 +79,47 @@ class TestMergeStarGeneCounts(unittest.TestCase):
         expected["CCCC"] = [[10, 10, 10], [10, 0, 20]]
         self.assertEqual(expected, dic)
 
+    def test_iter_star_counts(self) -> None:
+        """
+        Tests parsing gene counts in chunks and reporting malformed and
+        truncated files.
+        """
+        path = self.out_test_pfx + ".parse.tsv"
+        self.to_remove.append(path)
+        lines = [
+            "GENE{0}\t{1}\t{2}\t{3}\n".format(i % 50, i, 0, i * 3) for i in range(500)
+        ]
+        with open(path, "wt") as o:
+            o.writelines(lines)
+        expected = [
+            (line.split("\t")[0], list(map(int, line.split("\t")[1:])))
+            for line in lines
+        ]
+        for chunk_size in [7, 100, 1 << 20]:
+            self.assertEqual(expected, list(iter_star_counts(path, chunk_size)))
+        genes = [gene for gene, _ in iter_star_counts(path)]
+        self.assertIs(genes[0], genes[50])
+
+        cases = [
+            ("AAAA\t1\t2\t3\nCCCC\t1\t2\n", DataFormatError),
+            ("AAAA\t1\t2\t3\nCCCC\t1\tx\t3\n", DataFormatError),
+            ("AAAA\t1\t2\t3\nCCCC\t1", DataError),
+        ]
+        for content, error in cases:
+            with open(path, "wt") as o:
+                o.write(content)
+            with self.assertRaises(error):
+                load_star_file(path, OrderedDict())
+
+    def test_load_star_files_parallel(self) -> None:
+        """
+        Tests that parallel loading matches serial loading.
+        """
+        files = [self.star_counts_1, self.star_counts_2]
+        serial = load_star_files(files)
+        parallel = load_star_files(files, processes=2)
+        self.assertEqual(list(serial.items()), list(parallel.items()))
+
     def test_full_single(self) -> None:
         """
         Tests from main() entry for single star file.
@@ -98,6 +154,180 @@ class TestMergeStarGeneCounts(unittest.TestCase):
             self.assertEqual(exp, found)
         os.remove(args.output)
 
+    def test_full_merge_parallel(self) -> None:
+        """
+        Tests from main() entry with parallel parsing.
+        """
+        args = FakeArgs()
+        args.input = [self.star_counts_1, self.star_counts_2]
+        args.output = self.out_test_pfx + ".parallel.1_2.tsv.gz"
+        args.processes = 2
+        self.to_remove.append(args.output)
+        main(args)
+        with gzip.open(self.exp_star_1_2, "rt") as fh, gzip.open(
+            args.output, "rt"
+        ) as ofh:
+            self.assertEqual(fh.read(), ofh.read())
+
+    def test_full_single_compression(self) -> None:
+        """
+        Tests from main() entry for a single star file with every
+        combination of compressed and plain input and output.
+        """
+        plain_input = self.out_test_pfx + ".input_1.tsv"
+        self.to_remove.append(plain_input)
+        with gzip.open(self.star_counts_1, "rb") as fh, open(plain_input, "wb") as o:
+            o.write(fh.read())
+        with gzip.open(self.exp_star_1, "rb") as fh:
+            exp = fh.read()
+
+        for fil in [self.star_counts_1, plain_input]:
+            for ext in [".tsv.gz", ".tsv"]:
+                args = FakeArgs()
+                args.input = [fil]
+                args.output = self.out_test_pfx + ".single" + ext
+                self.to_remove.append(args.output)
+                main(args)
+                reader = gzip.open if ext.endswith(".gz") else open
+                with reader(args.output, "rb") as ofh:
+                    self.assertEqual(exp, ofh.read())
+
+    def test_reduce_star_files(self) -> None:
+        """
+        Tests that the tree reduction matches the serial merge for inputs
+        with differing gene sets.
+        """
+        rng = random.Random(3)
+        inputs = []
+        for i in range(7):
+            fil = self.out_test_pfx + ".random_{0}.tsv".format(i)
+            self.to_remove.append(fil)
+            inputs.append(fil)
+            with open(fil, "wt") as o:
+                for j in range(50):
+                    if rng.random() < 0.7:
+                        row = ["G{0}".format(j)] + [
+                            rng.randint(0, 99) for _ in range(3)
+                        ]
+                        o.write("\t".join(map(str, row)) + "\n")
+
+        expected = list(merge_star_counts(load_star_files(inputs)))
+        for processes, fan_in in [(1, 2), (2, 2), (2, 3)]:
+            found = reduce_star_files(inputs, processes=processes, fan_in=fan_in)
+            self.assertEqual(expected, list(found.items()))
+
+        args = FakeArgs()
+        args.input = [self.star_counts_1, self.star_counts_2]
+        args.output = self.out_test_pfx + ".fan_in.1_2.tsv.gz"
+        args.fan_in = 2
+        self.to_remove.append(args.output)
+        main(args)
+        with gzip.open(self.exp_star_1_2, "rt") as fh, gzip.open(
+            args.output, "rt"
+        ) as ofh:
+            self.assertEqual(fh.read(), ofh.read())
+
+        args.engine = "numpy"
+        with self.assertRaisesRegex(ValueError, "numpy engine"):
+            main(args)
+
+    def test_lockstep_merge_counts(self) -> None:
+        """
+        Tests the `lockstep_merge_counts` function and gene order checks.
+        """
+        found = list(lockstep_merge_counts([self.star_counts_1, self.star_counts_2]))
+        self.assertEqual(
+            [("ZZZZ", [110, 20, 100]), ("AAAA", [0, 55, 780]), ("CCCC", [20, 10, 30])],
+            found,
+        )
+        self.assertEqual(
+            gene_order_fingerprint(self.star_counts_1),
+            gene_order_fingerprint(self.star_counts_2),
+        )
+
+        swapped = self.out_test_pfx + ".swapped.tsv"
+        self.to_remove.append(swapped)
+        with open(swapped, "wt") as o:
+            o.write("AAAA\t1\t1\t1\nZZZZ\t1\t1\t1\nCCCC\t1\t1\t1\n")
+        self.assertNotEqual(
+            gene_order_fingerprint(self.star_counts_1), gene_order_fingerprint(swapped)
+        )
+        with self.assertRaises(GeneOrderError):
+            list(lockstep_merge_counts([self.star_counts_1, swapped]))
+
+    def test_full_merge_stream(self) -> None:
+        """
+        Tests from main() entry with the lockstep merge and its fallback to
+        the keyed merge when gene order differs.
+        """
+        args = FakeArgs()
+        args.input = [self.star_counts_1, self.star_counts_2]
+        args.output = self.out_test_pfx + ".stream.1_2.tsv.gz"
+        args.stream = True
+        self.to_remove.append(args.output)
+        main(args)
+        with gzip.open(self.exp_star_1_2, "rt") as fh, gzip.open(
+            args.output, "rt"
+        ) as ofh:
+            self.assertEqual(fh.read(), ofh.read())
+
+        extra = self.out_test_pfx + ".extra.tsv"
+        self.to_remove.append(extra)
+        with open(extra, "wt") as o:
+            o.write("AAAA\t1\t1\t1\nBBBB\t2\t2\t2\n")
+        args.input = [self.star_counts_1, extra]
+        main(args)
+        with gzip.open(args.output, "rt") as ofh:
+            self.assertEqual(
+                [
+                    "#gene\tunstranded\tstranded_first\tstranded_second\n",
+                    "ZZZZ\t100\t0\t50\n",
+                    "AAAA\t1\t51\t76\n",
+                    "CCCC\t10\t10\t10\n",
+                    "BBBB\t2\t2\t2\n",
+                ],
+                ofh.readlines(),
+            )
+
+    def test_full_merge_widths(self) -> None:
+        """
+        Tests that every merge path rejects inputs with different numbers of
+        count columns instead of truncating rows.
+        """
+        narrow = self.out_test_pfx + ".narrow.tsv"
+        wide = self.out_test_pfx + ".wide.tsv"
+        self.to_remove.extend([narrow, wide])
+        with open(narrow, "wt") as o:
+            o.write("AAAA\t1\t1\t1\nBBBB\t2\t2\t2\n")
+        with open(wide, "wt") as o:
+            o.write("AAAA\t1\t1\t1\t1\nCCCC\t3\t3\t3\t3\n")
+
+        options = [
+            {},
+            {"processes": 2},
+            {"fan_in": 2},
+            {"fan_in": 2, "processes": 2},
+            {"stream": True},
+            {"engine": "numpy"},
+        ]
+        for inputs in [[wide, narrow], [narrow, wide], [wide, wide, narrow]]:
+            for option in options:
+                args = FakeArgs()
+                args.input = inputs
+                args.output = self.out_test_pfx + ".widths.tsv"
+                self.to_remove.append(args.output)
+                for name, value in option.items():
+                    setattr(args, name, value)
+                with self.subTest(inputs=inputs, **option):
+                    with self.assertRaises(DataFormatError):
+                        main(args)
+
+        # lockstep merge of files with the same genes in the same order
+        with open(wide, "wt") as o:
+            o.write("AAAA\t1\t1\t1\t1\nBBBB\t3\t3\t3\t3\n")
+        with self.assertRaises(DataFormatError):
+            list(lockstep_merge_counts([narrow, wide]))
+
     def setUp(self) -> None:
         pass
 
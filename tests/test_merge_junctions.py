@@ -1,11 +1,27 @@
 import gzip
 import os
+import random
+import tempfile
 import unittest
 
+from gdc_rnaseq_tools import merge_junctions
 from gdc_rnaseq_tools.merge_junctions import (
+    JunctionFilter,
     StarJunctionRecord,
+    external_merge_junctions,
+    iter_run,
     load_junction_file,
+    load_junction_files,
     main,
+    position_key,
+    reduce_junction_files,
+    stream_merge_junctions,
+)
+from gdc_rnaseq_tools.utils import (
+    DataError,
+    DataFormatError,
+    UnsortedInputError,
+    iter_star_junctions,
 )
 from tests.fakearg import FakeArgs
 
@@ -87,6 +103,35 @@ class TestMergeStarJunctions(unittest.TestCase):
         found = dic[tuple(dat2[:6])]
         self.assertEqual(tuple(dat2[:6]), found.key)
 
+    def test_iter_star_junctions(self) -> None:
+        """
+        Tests parsing junctions in chunks and reporting malformed and
+        truncated files.
+        """
+        path = self.out_test_pfx + ".parse.tsv"
+        self.to_remove.append(path)
+        rows = [
+            ("chr{0}".format(i % 3 + 1), i * 10, i * 10 + 5, 1, 2, i % 2, i, 0, 30)
+            for i in range(300)
+        ]
+        with open(path, "wt") as o:
+            o.writelines("\t".join(map(str, row)) + "\n" for row in rows)
+        for chunk_size in [5, 1000]:
+            self.assertEqual(rows, list(iter_star_junctions(path, chunk_size)))
+        found = list(iter_star_junctions(path))
+        self.assertIs(found[0][0], found[3][0])
+
+        cases = [
+            ("chr1\t1\t2\t1\t1\t1\t1\t0\n", DataFormatError),
+            ("chr1\t1\t2\t1\t1\t1\t1\t0\t1.5\n", DataFormatError),
+            ("chr1\t1\t2\t1\t1\t1\t1\t0\t3\nchr1\t5\t9\t1", DataError),
+        ]
+        for content, error in cases:
+            with open(path, "wt") as o:
+                o.write(content)
+            with self.assertRaises(error):
+                load_junction_file(path, dict())
+
     def test_load_multi_junction_file(self) -> None:
         """
         Tests the load_junction_file function for multiple inputs.
@@ -116,6 +161,17 @@ class TestMergeStarJunctions(unittest.TestCase):
         self.assertEqual(3, dic[dat2_3].n_multi_mapped)
         self.assertEqual(23, dic[dat2_3].max_splice_overhang)
 
+    def test_load_junction_files_parallel(self) -> None:
+        """
+        Tests that parallel loading matches serial loading.
+        """
+        files = [self.star_junctions_2, self.star_junctions_1]
+        serial = load_junction_files(files)
+        parallel = load_junction_files(files, processes=2)
+        self.assertEqual(list(serial), list(parallel))
+        for key in serial:
+            self.assertEqual(str(serial[key]), str(parallel[key]))
+
     def test_full_junction_single(self) -> None:
         """
         Tests the the whole main() function of junction merge for
@@ -151,6 +207,393 @@ class TestMergeStarJunctions(unittest.TestCase):
             self.assertEqual(exp, found)
         os.remove(args.output)
 
+    def test_full_junction_merge_cached(self) -> None:
+        """
+        Tests that a rerun with a result cache serves the output and its
+        index, and that options changing the output are part of the key.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            args = FakeArgs()
+            args.input = [self.star_junctions_1, self.star_junctions_2]
+            args.output = os.path.join(tmp, "merged.tsv.gz")
+            args.index = True
+            args.cache_dir = os.path.join(tmp, "cache")
+            main(args)
+            with open(args.output, "rb") as fh:
+                expected = fh.read()
+            with open(args.output + ".tbi", "rb") as fh:
+                expected_index = fh.read()
+            self.assertEqual(2, len(os.listdir(args.cache_dir)))
+
+            os.remove(args.output)
+            os.remove(args.output + ".tbi")
+            main(args)
+            with open(args.output, "rb") as fh:
+                self.assertEqual(expected, fh.read())
+            with open(args.output + ".tbi", "rb") as fh:
+                self.assertEqual(expected_index, fh.read())
+            self.assertEqual(2, len(os.listdir(args.cache_dir)))
+
+            args.min_unique = 2
+            main(args)
+            self.assertEqual(4, len(os.listdir(args.cache_dir)))
+
+    def test_full_junction_merge_parallel(self) -> None:
+        """
+        Tests from main() entry with parallel parsing.
+        """
+        args = FakeArgs()
+        args.input = [self.star_junctions_1, self.star_junctions_2]
+        args.output = self.out_test_pfx + ".parallel.1_2.tsv.gz"
+        args.processes = 2
+        self.to_remove.append(args.output)
+        main(args)
+        with gzip.open(self.exp_star_1_2, "rt") as fh, gzip.open(
+            args.output, "rt"
+        ) as ofh:
+            self.assertEqual(fh.read(), ofh.read())
+
+    def test_stream_merge_junctions(self) -> None:
+        """
+        Tests the streaming merge of sorted junction files.
+        """
+        recs = list(
+            stream_merge_junctions([self.star_junctions_1, self.star_junctions_2])
+        )
+        self.assertEqual(
+            [
+                ("chr1", 100, 200, 1, 1, 1),
+                ("chr10", 400, 700, 1, 1, 1),
+                ("chr12", 100, 700, 1, 1, 1),
+            ],
+            [rec.key for rec in recs],
+        )
+        self.assertEqual([2, 3, 1], [rec.n_unique_mapped for rec in recs])
+        self.assertEqual([0, 6, 3], [rec.n_multi_mapped for rec in recs])
+        self.assertEqual([23, 23, 23], [rec.max_splice_overhang for rec in recs])
+
+    def test_stream_merge_junctions_unsorted(self) -> None:
+        """
+        Tests that the streaming merge detects unsorted inputs and inputs
+        that disagree on the chromosome order.
+        """
+        unsorted = self.out_test_pfx + ".unsorted.tsv"
+        other = self.out_test_pfx + ".other.tsv"
+        self.to_remove.extend([unsorted, other])
+        cases = [
+            (["chr1\t500\t600", "chr1\t100\t200"], ["chr1\t100\t200"]),
+            (["chr1\t100\t200", "chr2\t1\t9", "chr1\t300\t400"], ["chr1\t1\t9"]),
+            (["chr2\t500\t600", "chr1\t100\t200"], ["chr1\t1\t9", "chr2\t1\t9"]),
+        ]
+        for lines, other_lines in cases:
+            for path, rows in [(unsorted, lines), (other, other_lines)]:
+                with open(path, "wt") as o:
+                    for row in rows:
+                        o.write(row + "\t1\t1\t1\t1\t0\t10\n")
+            with self.assertRaises(UnsortedInputError):
+                list(stream_merge_junctions([other, unsorted]))
+
+    def test_stream_merge_missing_chromosomes(self) -> None:
+        """
+        Tests that sorted inputs that each lack some chromosomes stream in
+        the order of --chrom-order, and that without it the chromosomes are
+        ranked as the merge reaches them.
+        """
+        chromosomes = ["chr1", "chr2", "chr3", "chr3_decoy", "chr10"]
+        lanes = [self.out_test_pfx + ".lane{0}.tsv".format(i) for i in range(2)]
+        chrom_order = self.out_test_pfx + ".chrom_order.txt"
+        self.to_remove.extend(lanes + [chrom_order])
+        with open(chrom_order, "wt") as o:
+            o.write("\n".join(chromosomes) + "\n")
+        for lane, skip in zip(lanes, ["chr3_decoy", "chr2"]):
+            with open(lane, "wt") as o:
+                for chromosome in chromosomes:
+                    if chromosome != skip:
+                        o.write(chromosome + "\t100\t200\t1\t1\t1\t1\t0\t10\n")
+
+        ranks = {chromosome: i for i, chromosome in enumerate(chromosomes)}
+        recs = list(stream_merge_junctions(lanes, ranks))
+        self.assertEqual(chromosomes, [rec.chromosome for rec in recs])
+        self.assertEqual([2, 1, 2, 1, 2], [rec.n_unique_mapped for rec in recs])
+
+        # lane 0 reaches chr10 before lane 1 reaches chr3_decoy
+        with self.assertRaises(UnsortedInputError):
+            list(stream_merge_junctions(lanes))
+
+        # missing last chromosomes are reached in the order the inputs share
+        head = self.out_test_pfx + ".head.tsv"
+        self.to_remove.append(head)
+        with open(head, "wt") as o:
+            for chromosome in chromosomes[:2]:
+                o.write(chromosome + "\t100\t200\t1\t1\t1\t1\t0\t10\n")
+        recs = list(stream_merge_junctions([lanes[0], head]))
+        self.assertEqual(
+            ["chr1", "chr2", "chr3", "chr10"], [rec.chromosome for rec in recs]
+        )
+        self.assertEqual([2, 2, 1, 1], [rec.n_unique_mapped for rec in recs])
+
+        for order, expected in [(chrom_order, chromosomes), (None, None)]:
+            args = FakeArgs()
+            args.input = lanes
+            args.output = self.out_test_pfx + ".lanes.tsv"
+            args.stream = True
+            args.chrom_order = order
+            self.to_remove.append(args.output)
+            with self.assertLogs(level="INFO") as logs:
+                main(args)
+            fallback = any("Falling back" in line for line in logs.output)
+            self.assertEqual(order is None, fallback)
+            with open(args.output, "rt") as fh:
+                found = [line.split("\t")[0] for line in fh if line[0] != "#"]
+            self.assertEqual(expected or sorted(chromosomes), found)
+
+    def test_full_junction_stream_merge(self) -> None:
+        """
+        Tests from main() entry with the streaming merge.
+        """
+        args = FakeArgs()
+        args.input = [self.star_junctions_1, self.star_junctions_2]
+        args.output = self.out_test_pfx + ".stream.1_2.tsv.gz"
+        args.stream = True
+        self.to_remove.append(args.output)
+        main(args)
+        with gzip.open(self.exp_star_1_2, "rt") as fh, gzip.open(
+            args.output, "rt"
+        ) as ofh:
+            self.assertEqual(fh.read(), ofh.read())
+
+    def test_full_junction_stream_fallback(self) -> None:
+        """
+        Tests that main() falls back to the in-memory merge for unsorted inputs.
+        """
+        unsorted = self.out_test_pfx + ".unsorted.tsv"
+        self.to_remove.append(unsorted)
+        with gzip.open(self.star_junctions_2, "rt") as fh:
+            lines = fh.readlines()
+        with open(unsorted, "wt") as o:
+            o.writelines(reversed(lines))
+
+        args = FakeArgs()
+        args.input = [self.star_junctions_1, unsorted]
+        args.output = self.out_test_pfx + ".fallback.1_2.tsv.gz"
+        args.stream = True
+        self.to_remove.append(args.output)
+        main(args)
+        with gzip.open(self.exp_star_1_2, "rt") as fh, gzip.open(
+            args.output, "rt"
+        ) as ofh:
+            self.assertEqual(fh.read(), ofh.read())
+
+    def write_random_inputs(self, n_files, n_lines, seed=11):
+        """
+        Writes unsorted junction files with shared keys and position ties.
+        """
+        rng = random.Random(seed)
+        inputs = []
+        for i in range(n_files):
+            fil = self.out_test_pfx + ".random_{0}.tsv".format(i)
+            self.to_remove.append(fil)
+            inputs.append(fil)
+            with open(fil, "wt") as o:
+                for _ in range(n_lines):
+                    start = rng.randint(1, 30) * 10
+                    row = [
+                        rng.choice(["chr1", "chr2", "chr10", "chrX"]),
+                        start,
+                        start + 50,
+                        rng.randint(0, 2),
+                        rng.randint(0, 1),
+                        1,
+                        rng.randint(0, 9),
+                        rng.randint(0, 9),
+                        rng.randint(1, 60),
+                    ]
+                    o.write("\t".join(map(str, row)) + "\n")
+        return inputs
+
+    def test_external_merge_junctions(self) -> None:
+        """
+        Tests that spilling sorted runs gives the same result as the
+        in-memory merge.
+        """
+        inputs = self.write_random_inputs(3, 300)
+        dic = load_junction_files(inputs)
+        expected = [str(rec) for rec in sorted(dic.values(), key=position_key)]
+        found = [str(rec) for rec in external_merge_junctions(inputs, 20 * 512)]
+        self.assertEqual(expected, found)
+
+    def test_external_merge_junctions_fan_in(self) -> None:
+        """
+        Tests that merging many spilled runs in passes with a small fan-in
+        gives the same result as the in-memory merge, with no more than
+        `fan_in` runs open at a time.
+        """
+        inputs = self.write_random_inputs(3, 300)
+        dic = load_junction_files(inputs)
+        expected = [str(rec) for rec in sorted(dic.values(), key=position_key)]
+        open_runs = [0, 0]
+
+        def counting_iter_run(path, chrom_ranks=None):
+            open_runs[0] += 1
+            open_runs[1] = max(open_runs)
+            try:
+                yield from iter_run(path, chrom_ranks)
+            finally:
+                open_runs[0] -= 1
+
+        merge_junctions.iter_run = counting_iter_run
+        try:
+            found = [
+                str(rec) for rec in external_merge_junctions(inputs, 4 * 512, fan_in=3)
+            ]
+        finally:
+            merge_junctions.iter_run = iter_run
+        self.assertEqual(expected, found)
+        self.assertEqual(open_runs, [0, 3])
+
+    def test_full_junction_chrom_order(self) -> None:
+        """
+        Tests from main() entry with a chromosome order, spilled runs and
+        both engines.
+        """
+        chrom_order = self.out_test_pfx + ".fai"
+        self.to_remove.append(chrom_order)
+        with open(chrom_order, "wt") as o:
+            o.write("chr1\t1000\t6\t60\t61\n")
+            o.write("chr2\t1000\t1024\t60\t61\n")
+            o.write("chr10\t1000\t2048\t60\t61\n")
+
+        inputs = self.write_random_inputs(3, 300)
+        outputs = []
+        for engine, max_memory in [
+            ("python", None),
+            ("python", "10K"),
+            ("numpy", None),
+        ]:
+            args = FakeArgs()
+            args.input = inputs
+            args.output = self.out_test_pfx + ".ordered.{0}.tsv".format(len(outputs))
+            args.chrom_order = chrom_order
+            args.engine = engine
+            args.max_memory = max_memory
+            args.run_fan_in = 2
+            self.to_remove.append(args.output)
+            main(args)
+            with open(args.output, "rt") as fh:
+                outputs.append(fh.read())
+
+        chroms = [line.split("\t")[0] for line in outputs[0].splitlines()[1:]]
+        self.assertEqual(
+            ["chr1", "chr2", "chr10", "chrX"],
+            sorted(set(chroms), key=chroms.index),
+        )
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+
+    def test_reduce_junction_files(self) -> None:
+        """
+        Tests that the tree reduction gives the same records in the same
+        order as the serial load.
+        """
+        inputs = self.write_random_inputs(7, 100)
+        expected = [str(rec) for rec in load_junction_files(inputs).values()]
+        for processes, fan_in in [(1, 2), (2, 2), (2, 3), (3, 8)]:
+            found = reduce_junction_files(inputs, processes=processes, fan_in=fan_in)
+            self.assertEqual(expected, [str(rec) for rec in found.values()])
+
+    def test_full_junction_fan_in(self) -> None:
+        """
+        Tests from main() entry that the tree reduction writes the same output
+        as the serial merge.
+        """
+        inputs = self.write_random_inputs(5, 200)
+        outputs = []
+        for fan_in in [None, 2]:
+            args = FakeArgs()
+            args.input = inputs
+            args.output = self.out_test_pfx + ".fan_in.{0}.tsv".format(fan_in)
+            args.fan_in = fan_in
+            args.processes = 2
+            self.to_remove.append(args.output)
+            main(args)
+            with open(args.output, "rt") as fh:
+                outputs.append(fh.read())
+        self.assertEqual(outputs[0], outputs[1])
+
+        args.max_memory = "10K"
+        with self.assertRaisesRegex(ValueError, "--run-fan-in"):
+            main(args)
+
+        args.engine = "numpy"
+        for fan_in, max_memory in [(2, None), (None, "10K")]:
+            args.fan_in = fan_in
+            args.max_memory = max_memory
+            with self.assertRaisesRegex(ValueError, "numpy engine"):
+                main(args)
+
+    def test_junction_filter(self) -> None:
+        """
+        Tests the per-record filters of `JunctionFilter`.
+        """
+        filters = JunctionFilter(
+            annotation="unannotated",
+            canonical_only=True,
+            exclude_contigs=["chrM", "*_decoy"],
+        )
+        self.assertTrue(filters.keep_columns(["chr1", "1", "9", "1", "1", "0"]))
+        self.assertFalse(filters.keep_columns(["chr1", "1", "9", "1", "0", "0"]))
+        self.assertFalse(filters.keep_columns(["chr1", "1", "9", "1", "1", "1"]))
+        self.assertFalse(filters.keep_columns(["chrM", "1", "9", "1", "1", "0"]))
+        self.assertFalse(
+            filters.keep_columns(["chrEBV_decoy", "1", "9", "1", "1", "0"])
+        )
+        self.assertIsNone(JunctionFilter.from_args(FakeArgs()))
+
+    def test_full_junction_filters(self) -> None:
+        """
+        Tests from main() entry that filters match post-filtering the merged
+        output for all merge modes, with the minimum unique reads applied to
+        the merged totals.
+        """
+        inputs = self.write_random_inputs(3, 300)
+        args = FakeArgs()
+        args.input = inputs
+        args.output = self.out_test_pfx + ".unfiltered.tsv"
+        self.to_remove.append(args.output)
+        main(args)
+        with open(args.output, "rt") as fh:
+            lines = fh.readlines()
+        expected = lines[:1] + [
+            line
+            for line in lines[1:]
+            if line.split("\t")[0] not in ("chrX", "chr10")
+            and line.split("\t")[4] != "0"
+            and int(line.split("\t")[6]) >= 12
+        ]
+        # per-input counts are at most 9, so kept records were summed
+        self.assertTrue(len(expected) > 10)
+
+        for engine, max_memory, processes in [
+            ("python", None, 1),
+            ("python", None, 2),
+            ("python", "10K", 1),
+            ("numpy", None, 1),
+        ]:
+            args = FakeArgs()
+            args.input = inputs
+            args.output = self.out_test_pfx + ".filtered.tsv"
+            args.engine = engine
+            args.max_memory = max_memory
+            args.processes = processes
+            args.min_unique = 12
+            args.annotation = "annotated"
+            args.canonical_only = True
+            args.exclude_contig = ["chrX", "chr1?"]
+            self.to_remove.append(args.output)
+            main(args)
+            with open(args.output, "rt") as fh:
+                self.assertEqual(expected, fh.readlines())
+
     def setUp(self) -> None:
         pass
 
@@ -0,0 +1,116 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from gdc_rnaseq_tools.augment_star_counts import (
+    CountsColumns,
+    calc_fpkm,
+    calc_fpkm_uq,
+    calc_tpm,
+    load_gene_info,
+    load_table,
+    merge_tables,
+)
+from gdc_rnaseq_tools.counts_matrix import build_counts_matrix, load_counts_matrix
+from gdc_rnaseq_tools.normalize_matrix import (
+    MEASURES,
+    main,
+    normalize_matrix,
+    output_path,
+)
+from tests.fakearg import FakeArgs
+
+
+class TestNormalizeMatrix(unittest.TestCase):
+    counts = os.path.join(os.path.dirname(__file__), "etc/test_set_1.counts.tsv.gz")
+    gene_info = os.path.join(
+        os.path.dirname(__file__), "etc/test_set_1.gene_info.tsv.gz"
+    )
+
+    def build_matrix(self, tmp):
+        """
+        Builds a matrix of the test counts and of shifted and reordered
+        copies, and returns it with the counts table of each sample.
+        """
+        base = load_table(self.counts, CountsColumns.cols())
+        tables = [base]
+        for shift in [1, 7]:
+            table = base.copy()
+            table["unstranded"] = (table["unstranded"] * shift + shift) % 997
+            tables.append(table)
+        tables.append(
+            tables[1].iloc[list(range(4)) + list(range(len(base) - 1, 3, -1))]
+        )
+
+        files = []
+        for i, table in enumerate(tables):
+            files.append(os.path.join(tmp, "sample{0}.tsv".format(i)))
+            table.to_csv(files[-1], sep="\t", header=False, index=False)
+        output = os.path.join(tmp, "matrix.npy")
+        build_counts_matrix(files, ["s0", "s1", "s2", "s3"], output)
+        return output, tables
+
+    def expected(self, table, gene_info):
+        """
+        Normalized counts of one sample as computed by augment_star_counts.
+        """
+        merged = merge_tables(gene_info, table, on="gene_id")
+        expression = merged.unstranded
+        length = merged.total_exon_length
+        return (
+            merged.gene_id.tolist(),
+            {
+                "tpm": calc_tpm(expression, length),
+                "fpkm": calc_fpkm(expression, length, merged.gene_type),
+                "fpkm_uq": calc_fpkm_uq(
+                    expression, length, merged.gene_type, merged.chromosome
+                ),
+            },
+        )
+
+    def test_normalize_matrix(self) -> None:
+        """
+        Tests that every sample gets exactly the numbers of `calc_tpm`,
+        `calc_fpkm` and `calc_fpkm_uq`, whatever the chunk size.
+        """
+        gene_info = load_gene_info(self.gene_info)
+        with tempfile.TemporaryDirectory() as tmp:
+            output, tables = self.build_matrix(tmp)
+            matrix, index = load_counts_matrix(output)
+            for max_memory in [1, None]:
+                genes, outputs = normalize_matrix(
+                    matrix, index["genes"], gene_info, max_memory=max_memory
+                )
+                for sample, table in enumerate(tables):
+                    expected_genes, expected = self.expected(table, gene_info)
+                    self.assertEqual(expected_genes, genes)
+                    for measure in MEASURES:
+                        np.testing.assert_array_equal(
+                            outputs[measure][:, sample], expected[measure]
+                        )
+            del matrix
+
+    def test_main(self) -> None:
+        """
+        Tests writing the memory-mapped matrices and their sidecar.
+        """
+        gene_info = load_gene_info(self.gene_info)
+        with tempfile.TemporaryDirectory() as tmp:
+            output, tables = self.build_matrix(tmp)
+            args = FakeArgs()
+            args.input = output
+            args.gene_info = self.gene_info
+            args.output = os.path.join(tmp, "cohort")
+            args.max_memory = "4K"
+            main(args)
+
+            expected_genes, expected = self.expected(tables[2], gene_info)
+            for measure in MEASURES:
+                result = np.load(output_path(args.output, measure), mmap_mode="r")
+                self.assertEqual((len(expected_genes), 4), result.shape)
+                self.assertTrue(result.flags.f_contiguous)
+                np.testing.assert_array_equal(result[:, 2], expected[measure])
+                del result
+            self.assertTrue(os.path.exists(args.output + ".index.json"))
@@ -0,0 +1,87 @@
+import gzip
+import io
+import os
+import unittest
+
+from gdc_rnaseq_tools import merge_junctions
+from gdc_rnaseq_tools.query_junctions import main, query_junctions
+from tests.fakearg import FakeArgs
+
+
+class TestQueryJunctions(unittest.TestCase):
+    star_junctions_1 = os.path.join(
+        os.path.dirname(__file__), "etc/test_star_junctions_input_1.tsv.gz"
+    )
+    star_junctions_2 = os.path.join(
+        os.path.dirname(__file__), "etc/test_star_junctions_input_2.tsv.gz"
+    )
+    exp_star_1_2 = os.path.join(
+        os.path.dirname(__file__), "etc/exp_star_junctions_output_1_2.tsv.gz"
+    )
+    out_test_pfx = os.path.join(
+        os.path.dirname(__file__), "etc/test_query_junctions_out"
+    )
+    to_remove = []
+
+    def merge_indexed(self) -> str:
+        args = FakeArgs()
+        args.input = [self.star_junctions_1, self.star_junctions_2]
+        args.output = self.out_test_pfx + ".merged.tsv.gz"
+        args.index = True
+        self.to_remove.extend([args.output, args.output + ".tbi"])
+        merge_junctions.main(args)
+        return args.output
+
+    def test_merge_indexed(self) -> None:
+        """
+        Tests that indexed merge output matches the gzip output.
+        """
+        path = self.merge_indexed()
+        self.assertTrue(os.path.exists(path + ".tbi"))
+        with gzip.open(self.exp_star_1_2, "rt") as fh, gzip.open(path, "rt") as ofh:
+            self.assertEqual(fh.read(), ofh.read())
+
+    def test_query_junctions(self) -> None:
+        """
+        Tests querying junctions overlapping regions.
+        """
+        path = self.merge_indexed()
+        out = io.StringIO()
+        count = query_junctions(path, ["chr10:650-800", "chr1:50-99"], out)
+        self.assertEqual(1, count)
+        self.assertEqual("chr10\t400\t700\t1\t1\t1\t3\t6\t23\n", out.getvalue())
+
+        out = io.StringIO()
+        query_junctions(path, ["chr12"], out, header=True)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith("#chromosome"))
+        self.assertEqual(["chr12\t100\t700\t1\t1\t1\t1\t3\t23"], lines[1:])
+
+    def test_full_query(self) -> None:
+        """
+        Tests from main() entry.
+        """
+        path = self.merge_indexed()
+        args = FakeArgs()
+        args.input = path
+        args.region = ["chr1:200", "chr12:1-100"]
+        args.output = self.out_test_pfx + ".query.tsv"
+        args.header = False
+        self.to_remove.append(args.output)
+        main(args)
+        with open(args.output, "rt") as fh:
+            self.assertEqual(
+                [
+                    "chr1\t100\t200\t1\t1\t1\t2\t0\t23\n",
+                    "chr12\t100\t700\t1\t1\t1\t1\t3\t23\n",
+                ],
+                fh.readlines(),
+            )
+
+    def setUp(self) -> None:
+        pass
+
+    def tearDown(self) -> None:
+        for fil in self.to_remove:
+            if os.path.exists(fil):
+                os.remove(fil)
@@ -0,0 +1,112 @@
+import os
+import unittest
+
+from gdc_rnaseq_tools.tabix import (
+    TabixIndex,
+    TabixWriter,
+    parse_region,
+    query,
+    reg2bin,
+    reg2bins,
+)
+from gdc_rnaseq_tools.utils import UnsortedInputError
+
+
+class TestTabix(unittest.TestCase):
+    out_test_pfx = os.path.join(os.path.dirname(__file__), "etc/test_tabix_out")
+    to_remove = []
+
+    def test_reg2bin(self) -> None:
+        """
+        Tests the UCSC binning scheme.
+        """
+        self.assertEqual(4681, reg2bin(0, 1))
+        self.assertEqual(4682, reg2bin(1 << 14, (1 << 14) + 10))
+        self.assertEqual(585, reg2bin(100, (1 << 14) + 10))
+        self.assertEqual(0, reg2bin(0, 1 << 29))
+        self.assertIn(reg2bin(100, 200), reg2bins(150, 160))
+
+    def test_parse_region(self) -> None:
+        """
+        Tests parsing region strings.
+        """
+        self.assertEqual(("chr1", 999, 2000), parse_region("chr1:1,000-2,000"))
+        self.assertEqual(("chr1", 99, 1 << 29), parse_region("chr1:100"))
+        self.assertEqual(
+            ("chrUn_KI270302v1", 0, 1 << 29), parse_region("chrUn_KI270302v1")
+        )
+        with self.assertRaises(ValueError):
+            parse_region("chr1:200-100")
+
+    def write_table(self, path, rows, **kwargs):
+        with TabixWriter(path, **kwargs) as o:
+            o.write("#chromosome\tstart\tend\n")
+            for row in rows:
+                o.write("\t".join(map(str, row)) + "\n")
+
+    def test_write_and_query(self) -> None:
+        """
+        Tests region queries against an index written by `TabixWriter`.
+        """
+        path = self.out_test_pfx + ".tsv.gz"
+        self.to_remove.extend([path, path + ".tbi"])
+        rows = []
+        for chrom in ["chr1", "chr2"]:
+            for start in range(1, 400000, 97):
+                rows.append((chrom, start, start + 5000))
+        self.write_table(path, rows)
+
+        index = TabixIndex.load(path + ".tbi")
+        self.assertEqual(["chr1", "chr2"], list(index.refs))
+
+        for region in ["chr1:1-10", "chr2:250000-250100", "chr1:399990", "chr3"]:
+            name, beg, end = parse_region(region)
+            expected = [
+                "\t".join(map(str, row)) + "\n"
+                for row in rows
+                if row[0] == name and row[1] - 1 < end and row[2] > beg
+            ]
+            self.assertEqual(expected, list(query(path, region, index=index)))
+
+    def test_write_threads_level(self) -> None:
+        """
+        Tests that the file and index written by `TabixWriter` do not depend
+        on the number of compression threads, and follow the level.
+        """
+        rows = [("chr1", start, start + 300) for start in range(1, 900000, 53)]
+        found = dict()
+        for threads, level in [(1, 6), (4, 6), (1, 9), (4, 9)]:
+            path = self.out_test_pfx + ".{0}_{1}.tsv.gz".format(threads, level)
+            self.to_remove.extend([path, path + ".tbi"])
+            self.write_table(path, rows, threads=threads, level=level)
+            with open(path, "rb") as fh, open(path + ".tbi", "rb") as ifh:
+                found[threads, level] = (fh.read(), ifh.read())
+            self.assertEqual(
+                ["chr1\t{0}\t{1}\n".format(*row[1:]) for row in rows[7542:7548]],
+                list(query(path, "chr1:400000-400000")),
+            )
+        self.assertEqual(found[1, 6], found[4, 6])
+        self.assertEqual(found[1, 9], found[4, 9])
+        self.assertNotEqual(found[1, 6][0], found[1, 9][0])
+
+    def test_write_unsorted(self) -> None:
+        """
+        Tests that unsorted records cannot be indexed.
+        """
+        path = self.out_test_pfx + ".unsorted.tsv.gz"
+        self.to_remove.extend([path, path + ".tbi"])
+        with self.assertRaises(UnsortedInputError):
+            self.write_table(path, [("chr1", 200, 300), ("chr1", 100, 300)])
+        with self.assertRaises(UnsortedInputError):
+            self.write_table(
+                path, [("chr1", 100, 300), ("chr2", 100, 300), ("chr1", 400, 500)]
+            )
+        self.assertFalse(os.path.exists(path + ".tbi"))
+
+    def setUp(self) -> None:
+        pass
+
+    def tearDown(self) -> None:
+        for fil in self.to_remove:
+            if os.path.exists(fil):
+                os.remove(fil)